@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end throughput of download_papers.py against a local stand-in Sci-Hub mirror (mirror_server.py)
+# Use: python3 benchmarks/bench_download.py [-n PAPERS] [-w WORKERS ...] [-l LAYOUT ...] [-f {xlsx,csv,txt}] [-a {zip,tar}] [--latency SECONDS] ...
+#
+# For each layout (Item + DOI, Title + DOI, Title + DOI + Repository) and number of workers, an input file is generated
+# (-f txt: the txt layout as a list of DOIs, one per line)
+# and download_papers.py runs in a child process with the native backend, so the peak RSS is the one of the run.
+# The time of each phase is summed over the worker threads: read (input file), index (output folder and state store),
+# download (Sci-Hub page and pdf transfer), verify (integrity check) and summary (.xlsx).
+
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import functools
+
+import mirror_server
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAYOUTS = ['txt', 'title', 'repository']
+PHASES = ['read', 'index', 'download', 'verify', 'summary']
+DOCUMENT_TYPES = ['Article', 'Review', 'Conference Paper']
+
+def get_columns(layout):
+    if layout == 'txt':
+        return ['Item', 'DOI']
+    columns = ['Item', 'Title', 'Abstract', 'Year', 'DOI', 'Document Type', 'Language', 'Cited By', 'Author(s)']
+    if layout == 'repository':
+        columns.append('Repository')
+    return columns
+
+def get_row(layout, index):
+    values = {'Item': index,
+              'Title': 'Benchmark paper number %s about fungal biology' % index,
+              'Abstract': 'Abstract of the benchmark paper %s. ' % index * 10,
+              'Year': 2000 + index % 25,
+              'DOI': '10.5555/bench.%s' % index,
+              'Document Type': DOCUMENT_TYPES[index % len(DOCUMENT_TYPES)],
+              'Language': 'English',
+              'Cited By': index % 97,
+              'Author(s)': 'Author A.; Author B.',
+              'Repository': 'Scopus' if index % 2 else 'WoS'}
+    return [values[column] for column in get_columns(layout)]
+
+def write_input(path, layout, count, file_format):
+    if file_format == 'txt':
+        with open(path, 'w', encoding = 'utf-8') as f:
+            for index in range(1, count + 1):
+                f.write('%s\n' % get_row(layout, index)[-1])
+    elif file_format == 'xlsx':
+        import xlsxwriter
+
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Unique')
+        worksheet.write_row(0, 0, get_columns(layout))
+        for index in range(1, count + 1):
+            worksheet.write_row(index, 0, get_row(layout, index))
+        workbook.close()
+    else:
+        with open(path, 'w', newline = '', encoding = 'utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(get_columns(layout))
+            for index in range(1, count + 1):
+                writer.writerow(get_row(layout, index))
+
+class PhaseTimer:
+
+    def __init__(self):
+        self.totals = {phase: 0.0 for phase in PHASES}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self):
+        # A phase called from another one (the summary reads the abstracts of the input file) is not counted twice
+        if getattr(self.local, 'active', False):
+            return None
+        self.local.active = True
+        return time.perf_counter()
+
+    def stop(self, phase, start):
+        if start is None:
+            return
+        self.local.active = False
+        with self.lock:
+            self.totals[phase] += time.perf_counter() - start
+
+    def wrap(self, owner, name, phase):
+        function = getattr(owner, name)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = self.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(phase, start)
+        setattr(owner, name, timed)
+
+    def wrap_generator(self, owner, name, phase):
+        function = getattr(owner, name)
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            items = function(*args, **kwargs)
+            while True:
+                start = self.start()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    self.stop(phase, start)
+                yield item
+        setattr(owner, name, timed)
+
+def get_peak_rss():
+    # Kilobytes, None where the resource module doesn't exist (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run_child(config):
+    # Runs download_papers.main() in this process, with timers around the methods of each phase
+    import sqlite3
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import download_papers
+
+    timer = PhaseTimer()
+    timer.wrap(download_papers.SCIhub, 'read_input_file', 'read')
+    timer.wrap_generator(download_papers.SCIhub, 'iter_papers', 'read')
+    timer.wrap(download_papers.SCIhub, 'get_downloaded_files', 'index')
+    timer.wrap(download_papers.NativeBackend, 'download', 'download')
+    timer.wrap(download_papers.SCIhub, 'check_integrity', 'verify')
+    timer.wrap(download_papers.SCIhub, 'save_summary_xls', 'summary')
+
+    oscihub = download_papers.SCIhub()
+    oscihub.RETRY_BASE_DELAY = config['retry_delay']
+    oscihub.RETRY_MAX_DELAY = config['retry_delay'] * 8
+    oscihub.MIRROR_COOLDOWN = config['mirror_cooldown']
+    download_papers.oscihub = oscihub
+    sys.argv = [os.path.join(SCRIPT_DIR, 'download_papers.py'),
+                '-i', config['input_file'],
+                '-o', config['output'],
+                '-b', 'native',
+                '-m', config['mirror'],
+                '-w', str(config['workers']),
+                '--max_per_host', str(config['workers']),
+                '--rate', '0',
+                '--checkpoint', '0',
+                '-r', str(config['retries']),
+                '--no_cache',
+                '-q']
+    if config['archive'] is not None:
+        sys.argv.extend(['--archive', config['archive']])
+
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            _start = time.perf_counter()
+            download_papers.main()
+            elapsed = time.perf_counter() - _start
+        finally:
+            sys.stdout = stdout
+
+    connection = sqlite3.connect(os.path.join(config['output'], 'summary_control.sqlite'))
+    rows = connection.execute('SELECT status, bytes, duration FROM papers').fetchall()
+    connection.close()
+    durations = [duration for _, _, duration in rows if duration is not None]
+    downloaded = [size for status, size, duration in rows if status == 'Ok' and duration is not None]
+    return {'elapsed': elapsed,
+            'papers': config['papers'],
+            'downloaded': len(downloaded),
+            'bytes': sum(downloaded),
+            'p50': percentile(durations, 0.5),
+            'p99': percentile(durations, 0.99),
+            'peak_rss_kb': get_peak_rss(),
+            'phases': timer.totals}
+
+def run_case(args, server, workdir, layout, workers):
+    name = '%s_w%s' % (layout, workers)
+    input_file = os.path.join(workdir, 'papers_%s.%s' % (layout, args.format))
+    if not os.path.exists(input_file):
+        write_input(input_file, layout, args.papers, args.format)
+    output = os.path.join(workdir, 'output_%s' % name)
+    shutil.rmtree(output, ignore_errors = True)
+
+    config = {'input_file': input_file,
+              'output': output,
+              'mirror': 'http://127.0.0.1:%s' % server.server_port,
+              'workers': workers,
+              'retries': args.retries,
+              'retry_delay': args.retry_delay,
+              'mirror_cooldown': args.mirror_cooldown,
+              'archive': args.archive,
+              'papers': args.papers}
+    metrics_file = os.path.join(workdir, 'metrics_%s.json' % name)
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config), '--metrics', metrics_file], check = True)
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    metrics.update({'layout': layout, 'workers': workers})
+    return metrics
+
+def show_results(results):
+    print('%-10s %7s %7s %9s %8s %8s %8s %9s %s' % ('layout', 'workers', 'papers', 'papers/s', 'MB/s', 'p50', 'p99', 'peak RSS', ' '.join(['%8s' % phase for phase in PHASES])))
+    for metrics in results:
+        elapsed = max(metrics['elapsed'], 1e-9)
+        print('%-10s %7s %7s %9.1f %8.2f %8s %8s %9s %s' % (metrics['layout'],
+                                                            metrics['workers'],
+                                                            metrics['papers'],
+                                                            metrics['papers'] / elapsed,
+                                                            metrics['bytes'] / elapsed / 1024 / 1024,
+                                                            '-' if metrics['p50'] is None else '%.0fms' % (metrics['p50'] * 1000),
+                                                            '-' if metrics['p99'] is None else '%.0fms' % (metrics['p99'] * 1000),
+                                                            '-' if metrics['peak_rss_kb'] is None else '%.0fMB' % (metrics['peak_rss_kb'] / 1024),
+                                                            ' '.join(['%7.2fs' % metrics['phases'][phase] for phase in PHASES])))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'End-to-end benchmark for download_papers.py with a local Sci-Hub stand-in')
+    parser.add_argument('-n', '--papers', type = int, default = 500, help = 'Papers of each input file (default: 500)')
+    parser.add_argument('-w', '--workers', type = int, nargs = '+', default = [1, 8], help = 'Numbers of workers to run (default: 1 8)')
+    parser.add_argument('-l', '--layouts', choices = LAYOUTS, nargs = '+', default = LAYOUTS, help = 'Layouts of the input files (default: all)')
+    parser.add_argument('-f', '--format', choices = ['xlsx', 'csv', 'txt'], default = 'xlsx', help = 'Format of the input files, txt only for the txt layout (default: xlsx)')
+    parser.add_argument('-r', '--retries', type = int, default = 2, help = 'Retries of download_papers.py (default: 2)')
+    parser.add_argument('--retry_delay', type = float, default = 0.1, help = 'First retry delay in seconds (default: 0.1)')
+    parser.add_argument('--mirror_cooldown', type = float, default = 0.05, help = 'Seconds before the mirror is tried again after an open circuit breaker (default: 0.05)')
+    parser.add_argument('-a', '--archive', choices = ['zip', 'tar'], help = 'Write the pdfs into a .zip or .tar archive (default: folders)')
+    parser.add_argument('--json', help = 'Also write the results to this .json file')
+    parser.add_argument('--keep', action = 'store_true', help = "Don't delete the generated input and output files")
+    parser.add_argument('--child', help = argparse.SUPPRESS)
+    parser.add_argument('--metrics', help = argparse.SUPPRESS)
+    mirror_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.format == 'txt' and args.layouts != ['txt']:
+        parser.error('-f txt needs -l txt, a .txt input file only has DOIs')
+
+    if args.child is not None:
+        with open(args.metrics, 'w') as f:
+            json.dump(run_child(json.loads(args.child)), f)
+        return
+
+    config = mirror_server.get_config(args)
+    server = mirror_server.start_server(config)
+    workdir = tempfile.mkdtemp(prefix = 'bench_download_')
+    results = []
+    try:
+        for layout in args.layouts:
+            for workers in args.workers:
+                results.append(run_case(args, server, workdir, layout, workers))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print('Files kept in: %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    show_results(results)
+    print('Mirror: %s' % ', '.join(['%s: %s' % (name, value) for name, value in config.counters.items()]))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the startup time of download_papers.py (--help and --version)
+# Use: python3 benchmarks/bench_startup.py [-n RUNS]
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'download_papers.py')
+
+def run_command(args, runs):
+    times = []
+    for _ in range(runs):
+        _start = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT] + args, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+        times.append(time.perf_counter() - _start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Startup benchmark for download_papers.py')
+    parser.add_argument('-n', '--runs', type = int, default = 20, help = 'Number of runs per command (default: 20)')
+    args = parser.parse_args()
+
+    print('%-12s %8s %8s %8s' % ('command', 'min', 'median', 'max'))
+    for command in (['--help'], ['--version']):
+        times = [t * 1000 for t in run_command(command, args.runs)]
+        print('%-12s %6.1fms %6.1fms %6.1fms' % (command[0], min(times), statistics.median(times), max(times)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for a Sci-Hub mirror, used by the benchmarks and to try the distributed mode
+# Use: python3 benchmarks/mirror_server.py [-p PORT] [--latency SECONDS] [--bandwidth BYTES] [--error_rate RATE] ...
+#
+# POST / (request=DOI)  -> page with <embed id="pdf" src="/pdf/DOI.pdf">, a captcha page or a page without the paper
+# GET /pdf/DOI.pdf      -> a generated pdf of about --pdf_size bytes, some of them corrupted or truncated, Range and If-Range requests allowed
+# GET /                 -> home page (mirror probe)
+
+import re
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import parse_qs, quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MirrorConfig:
+
+    def __init__(self, latency = 0.0, bandwidth = 0, error_rate = 0.0, captcha_rate = 0.0, missing_rate = 0.0,
+                 corrupt_rate = 0.0, truncated_rate = 0.0, pdf_size = 200 * 1024, seed = 0):
+        self.LATENCY = latency           # Seconds added to every request
+        self.BANDWIDTH = bandwidth       # Bytes per second of each pdf transfer, 0 for no limit
+        self.ERROR_RATE = error_rate     # Requests answered with a 503
+        self.CAPTCHA_RATE = captcha_rate # Sci-Hub pages replaced by a captcha
+        self.MISSING_RATE = missing_rate # DOIs that are never in the mirror (always the same DOIs)
+        self.CORRUPT_RATE = corrupt_rate # Transfers without the %PDF- header
+        self.TRUNCATED_RATE = truncated_rate # Transfers without the %%EOF trailer
+        self.PDF_SIZE = pdf_size
+        self.SEED = seed
+        self.CHUNK_SIZE = 16 * 1024
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'pages': 0, 'pdfs': 0, 'errors': 0, 'captchas': 0, 'missing': 0, 'corrupt': 0, 'truncated': 0, 'bytes': 0}
+
+    def draw(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def is_missing(self, doi):
+        # Decided by the DOI, so every run and every retry sees the same missing papers
+        value = int(hashlib.sha256(('%s:%s' % (self.SEED, doi.lower())).encode('utf-8')).hexdigest()[:8], 16)
+        return value / 0xffffffff < self.MISSING_RATE
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def get_pdf(self, doi):
+        # A valid one page pdf with the DOI as text (--deep_check, --full_text), padded with a stream no page uses
+        text = b'BT /F1 12 Tf 72 720 Td (Benchmark paper ' + re.sub(rb'[()\\]', b'_', doi.encode('utf-8')) + b') Tj ET'
+        filler = b'0' * max(0, self.PDF_SIZE - 700 - len(text))
+        objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+                   b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+                   b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+                   b'<< /Length %d >>\nstream\n' % len(text) + text + b'\nendstream',
+                   b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+                   b'<< /Length %d >>\nstream\n' % len(filler) + filler + b'\nendstream']
+
+        pdf = b'%PDF-1.4\n'
+        offsets = []
+        for number, body in enumerate(objects, start = 1):
+            offsets.append(len(pdf))
+            pdf += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+        xref = len(pdf)
+        pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        pdf += b''.join([b'%010d 00000 n \n' % offset for offset in offsets])
+        pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+        return pdf
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are separate writes: with Nagle and delayed ACK each answer would wait ~40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type = 'text/html', headers = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.write_body(body)
+
+    def write_body(self, body):
+        config = self.server.config
+        if config.BANDWIDTH <= 0:
+            self.wfile.write(body)
+            return
+        for start in range(0, len(body), config.CHUNK_SIZE):
+            chunk = body[start:start + config.CHUNK_SIZE]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / config.BANDWIDTH)
+
+    def start_request(self):
+        # Latency and server errors are the same for the Sci-Hub pages and the pdfs
+        config = self.server.config
+        if config.LATENCY > 0:
+            time.sleep(config.LATENCY)
+        if config.draw(config.ERROR_RATE):
+            config.count('errors')
+            self.send_body(503, b'<html><body>Service unavailable</body></html>')
+            return False
+        return True
+
+    def do_GET(self):
+        # The home page always answers, the failures are for the papers
+        match = re.match(r'^/pdf/(.+)\.pdf$', self.path)
+        if match is None:
+            self.send_body(200, b'<html><body>sci-hub stand-in</body></html>')
+            return
+        if not self.start_request():
+            return
+        config = self.server.config
+
+        doi = unquote(match.group(1))
+        pdf = config.get_pdf(doi)
+        etag = '"%s"' % hashlib.sha1(pdf).hexdigest()[:16]
+        if config.draw(config.CORRUPT_RATE):
+            config.count('corrupt')
+            pdf = b'<html>' + pdf[len(b'<html>'):]
+        elif config.draw(config.TRUNCATED_RATE):
+            config.count('truncated')
+            pdf = pdf[:len(pdf) // 2]
+
+        headers = {'Accept-Ranges': 'bytes', 'ETag': etag}
+        start = 0
+        match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+        # If-Range with another ETag: the client has part of another file, it gets the whole one
+        if match is not None and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            if start >= len(pdf):
+                self.send_body(416, b'', headers = {'Content-Range': 'bytes */%s' % len(pdf)})
+                return
+            headers.update({'Content-Range': 'bytes %s-%s/%s' % (start, len(pdf) - 1, len(pdf))})
+        config.count('pdfs')
+        config.count('bytes', len(pdf) - start)
+        self.send_body(206 if start > 0 else 200, pdf[start:], content_type = 'application/pdf', headers = headers)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if not self.start_request():
+            return
+        config = self.server.config
+        doi = form.get('request', [''])[0].strip()
+        config.count('pages')
+
+        if config.draw(config.CAPTCHA_RATE):
+            config.count('captchas')
+            self.send_body(200, b'<html><body><form id="captcha">Please solve the captcha</form></body></html>')
+        elif not doi or config.is_missing(doi):
+            config.count('missing')
+            self.send_body(200, b'<html><body>Sorry, article not found</body></html>')
+        else:
+            page = '<html><body><embed type="application/pdf" id="pdf" src="/pdf/%s.pdf#view=FitH"></body></html>' % quote(doi, safe = '')
+            self.send_body(200, page.encode('utf-8'))
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that close the connection in the middle of a transfer are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_server(config, host = '127.0.0.1', port = 0):
+    # Returns the server, running in a daemon thread; port 0 picks a free port (server.server_port)
+    server = MirrorServer((host, port), MirrorHandler)
+    server.config = config
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'Seconds added to every request (default: 0)')
+    parser.add_argument('--bandwidth', type = int, default = 0, help = 'Bytes per second of each pdf transfer, 0 for no limit (default: 0)')
+    parser.add_argument('--error_rate', type = float, default = 0.0, help = 'Fraction of requests answered with a 503 (default: 0)')
+    parser.add_argument('--captcha_rate', type = float, default = 0.0, help = 'Fraction of Sci-Hub pages replaced by a captcha (default: 0)')
+    parser.add_argument('--missing_rate', type = float, default = 0.0, help = 'Fraction of DOIs that are not in the mirror (default: 0)')
+    parser.add_argument('--corrupt_rate', type = float, default = 0.0, help = 'Fraction of pdfs sent without the %%PDF- header (default: 0)')
+    parser.add_argument('--truncated_rate', type = float, default = 0.0, help = 'Fraction of pdfs sent truncated (default: 0)')
+    parser.add_argument('--pdf_size', type = int, default = 200 * 1024, help = 'Size of the pdfs in bytes (default: 204800)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the random failures (default: 0)')
+
+def get_config(args):
+    return MirrorConfig(latency = args.latency,
+                        bandwidth = args.bandwidth,
+                        error_rate = args.error_rate,
+                        captcha_rate = args.captcha_rate,
+                        missing_rate = args.missing_rate,
+                        corrupt_rate = args.corrupt_rate,
+                        truncated_rate = args.truncated_rate,
+                        pdf_size = args.pdf_size,
+                        seed = args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Local stand-in for a Sci-Hub mirror')
+    parser.add_argument('-p', '--port', type = int, default = 8080, help = 'Port (default: 8080)')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'Address (default: 127.0.0.1)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    config = get_config(args)
+    server = start_server(config, host = args.host, port = args.port)
+    print('Mirror running on http://%s:%s (Ctrl-C to stop)' % (args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(', '.join(['%s: %s' % (name, value) for name, value in config.counters.items()]))
+
+if __name__ == '__main__':
+    main()
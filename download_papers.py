@@ -1,41 +1,166 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import io
 import os
 import re
 import sys
+import mmap
 import time
+import heapq
+import bisect
+import queue
+import atexit
+import json
+import random
+import logging
+import signal
+import socket
 import shutil
+import struct
+import tarfile
+import zipfile
+import hashlib
+import csv
+import sqlite3
 import argparse
+import threading
 import traceback
-import xlsxwriter
-import subprocess
-import numpy as np
-import pandas as pd
-from PyPDF2 import PdfReader
-from scidownl import scihub_download
+import importlib.util
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError, wait, FIRST_COMPLETED
 
 def menu():
     parser = argparse.ArgumentParser(description = "This scripts downloads .pdf files from formatted .xlsx files, via DOI.", epilog = "Thank you!")
-    parser.add_argument("-i", "--input_file", required = True, help = ".xlsx file that contains the DOIs")
+    parser.add_argument("-i", "--input_file", required = True, nargs = '+', help = ".xlsx, .csv, .tsv or .jsonl file that contains the DOIs, or .txt file with one DOI per line. Several files or folders are run as one batch, each file with its own output folder")
     parser.add_argument("-o", "--output", help = "Output folder")
+    parser.add_argument("-w", "--workers", type = int, default = 1, help = "Number of papers downloaded at the same time (default: 1)")
+    parser.add_argument("-b", "--backend", choices = ['native', 'scidownl'], default = 'native', help = "Downloader used to fetch the papers (default: native). With scidownl a failed download can't be told from a missing paper: it isn't retried and doesn't count against the mirror")
+    parser.add_argument("-m", "--mirrors", help = "Comma-separated list of Sci-Hub mirrors (default: %s)" % ','.join(oscihub.SCIHUB_MIRRORS))
+    parser.add_argument("-q", "--quiet", action = "store_true", help = "Don't show the progress of each paper on screen (the log file is still complete)")
+    parser.add_argument("--no_cache", action = "store_true", help = "Don't use the cache of DOIs already resolved by Sci-Hub")
+    parser.add_argument("--content_store", action = "store_true", help = "Keep one copy of each .pdf by content hash and link it to every expected name")
+    parser.add_argument("--layout", choices = ['flat', 'hash', 'year'], default = 'flat', help = "Folders of the .pdf files: one per document type (flat), or files/<hash prefix>/ or files/<year>/ with a manifest of the files (default: flat)")
+    parser.add_argument("--name_links", action = "store_true", help = "With --layout hash or year, also link each .pdf from its document type folder (Article/Year.Title.pdf)")
+    parser.add_argument("--archive", choices = ['zip', 'tar'], help = "Write the .pdf files into the archive papers.zip or papers.tar of the output folder (stored, Article/Year.Title.pdf) instead of the folders")
+    parser.add_argument("--prune", action = "store_true", help = "Delete the files of the document type folders that are not in the input file")
+    parser.add_argument("--deep_check", action = "store_true", help = "Also parse every downloaded .pdf with PyPDF2 (slower)")
+    parser.add_argument("--full_text", action = "store_true", help = "Extract the text and metadata of every downloaded .pdf with PyPDF2 into the full-text index full_text.sqlite of the output folder")
+    parser.add_argument("-r", "--retries", type = int, default = 2, help = "Extra attempts for papers that failed with a temporary error (default: 2)")
+    parser.add_argument("--max_per_host", type = int, default = 4, help = "Maximum number of concurrent requests per host (default: 4)")
+    parser.add_argument("--rate", type = float, default = 0, help = "Maximum papers per second requested to each host, 0 for no limit (default: 0)")
+    parser.add_argument("--checkpoint", type = int, default = 600, help = "Seconds between two updates of the summary .xlsx during the download, 0 to write it only at the end (default: 600)")
+    parser.add_argument("--order", help = "Order of the papers to download, by columns of the input file, e.g. 'Cited By:desc,Year:desc' or 'Document Type:Article|Review' (default: input order)")
+    parser.add_argument("--max_time", type = int, default = 0, help = "Seconds after which no new paper is started, the summary is still written, 0 for no limit (default: 0)")
+    parser.add_argument("--max_bytes", default = '0', help = "Bytes (or 500M, 2G) after which no new paper is started, 0 for no limit (default: 0)")
+    parser.add_argument("--progress", type = int, default = 0, help = "Seconds between two snapshots of the run metrics (metrics.json, metrics.prom) and progress lines, 0 to write them only at the end (default: 0)")
+    parser.add_argument("--queue", metavar = "RUN_NAME", help = "Distributed mode: claim the DOIs from the work queue RUN_NAME of the output folder, shared with the other workers of the run")
+    parser.add_argument("--worker_id", help = "Name of this worker in the work queue (default: host-pid)")
     parser.add_argument("--version", action = "version", version = "%s %s" % ('%(prog)s', oscihub.VERSION))
     args = parser.parse_args()
 
-    # Check scidownl
-    out_scidownl = oscihub.get_command('scidownl -h')
-    if 'Usage: scidownl' not in out_scidownl:
-        oscihub.show_print("It looks like 'scidownl' is not installed, you can install it with: pip3 install -U scidownl", showdate = False, font = oscihub.YELLOW)
+    if args.workers < 1 or args.max_per_host < 1:
+        oscihub.show_print("%s: error: --workers and --max_per_host must be greater than 0" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
         exit()
-
-    file_name = os.path.basename(args.input_file)
-    file_path = os.path.dirname(args.input_file)
-    if file_path is None or file_path == "":
-        file_path = os.getcwd().strip()
-
-    oscihub.INPUT_FILE = os.path.join(file_path, file_name)
-    if not oscihub.check_path(oscihub.INPUT_FILE):
-        oscihub.show_print("%s: error: the file '%s' doesn't exist" % (os.path.basename(__file__), oscihub.INPUT_FILE), showdate = False, font = oscihub.YELLOW)
-        oscihub.show_print("%s: error: the following arguments are required: -i/--input_file" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+    if args.rate < 0:
+        oscihub.show_print("%s: error: --rate can't be negative" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.RATE_PER_HOST = args.rate
+    if args.retries < 0:
+        oscihub.show_print("%s: error: --retries can't be negative" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.RETRIES = args.retries
+    if args.checkpoint < 0:
+        oscihub.show_print("%s: error: --checkpoint can't be negative" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.SUMMARY_CHECKPOINT = args.checkpoint
+    if args.order is not None:
+        oscihub.ORDER = oscihub.parse_order(args.order)
+        if oscihub.ORDER is None:
+            oscihub.show_print("%s: error: --order must be columns of %s, with ':asc', ':desc' or ':Value1|Value2'" % (os.path.basename(__file__), ', '.join(sorted(oscihub.order_attributes))), showdate = False, font = oscihub.YELLOW)
+            exit()
+    oscihub.MAX_BYTES = oscihub.parse_size(args.max_bytes)
+    if args.max_time < 0 or oscihub.MAX_BYTES is None:
+        oscihub.show_print("%s: error: --max_time and --max_bytes must be 0 or greater" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.MAX_TIME = args.max_time
+    if args.progress < 0:
+        oscihub.show_print("%s: error: --progress can't be negative" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.PROGRESS = args.progress
+    oscihub.WORKERS = args.workers
+    oscihub.MAX_PER_HOST = args.max_per_host
+    oscihub.BACKEND = args.backend
+    if args.mirrors is not None:
+        oscihub.SCIHUB_MIRRORS = [mirror.strip().rstrip('/') for mirror in args.mirrors.split(',') if mirror.strip()]
+    oscihub.DEEP_CHECK = args.deep_check
+    oscihub.FULL_TEXT = args.full_text
+    oscihub.PRUNE = args.prune
+    oscihub.QUIET = args.quiet
+    oscihub.USE_CACHE = not args.no_cache
+    oscihub.CONTENT_STORE = args.content_store
+    oscihub.LAYOUT = args.layout
+    if args.name_links and oscihub.LAYOUT == oscihub.LAYOUT_FLAT:
+        oscihub.show_print("%s: error: --name_links needs --layout hash or year" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+        exit()
+    oscihub.NAME_LINKS = args.name_links
+    oscihub.ARCHIVE = args.archive
+    if oscihub.ARCHIVE is not None:
+        # One process appends to the archive, and its members can't be linked, deleted or read by path
+        options = [('--layout', oscihub.LAYOUT != oscihub.LAYOUT_FLAT), ('--content_store', args.content_store), ('--prune', args.prune),
+                   ('--full_text', args.full_text), ('--queue', args.queue is not None)]
+        options = [option for option, used in options if used]
+        if options:
+            oscihub.show_print("%s: error: --archive can't be used with %s" % (os.path.basename(__file__), ', '.join(options)), showdate = False, font = oscihub.YELLOW)
+            exit()
+        if oscihub.ARCHIVE == 'zip' and not has_zipfile_internals():
+            oscihub.show_print("%s: error: --archive zip isn't supported with this version of Python, use --archive tar" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+            exit()
+    if args.queue is not None:
+        oscihub.QUEUE_RUN = re.sub(r'[^\w.-]', '_', args.queue)
+        worker_id = args.worker_id if args.worker_id is not None else '%s-%s' % (socket.gethostname(), os.getpid())
+        oscihub.WORKER_ID = re.sub(r'[^\w.-]', '_', worker_id)
+        # One log per worker, several processes would mix their lines in a shared one
+        oscihub.LOG_NAME = "%s_%s.log" % (os.path.splitext(oscihub.LOG_NAME)[0], oscihub.WORKER_ID)
+
+    oscihub.INPUT_FILES = []
+    for input_file in args.input_file:
+        file_name = os.path.basename(input_file.rstrip(os.sep))
+        file_path = os.path.dirname(input_file.rstrip(os.sep))
+        if file_path is None or file_path == "":
+            file_path = os.getcwd().strip()
+
+        input_file = os.path.join(file_path, file_name)
+        if not oscihub.check_path(input_file):
+            oscihub.show_print("%s: error: the file '%s' doesn't exist" % (os.path.basename(__file__), input_file), showdate = False, font = oscihub.YELLOW)
+            oscihub.show_print("%s: error: the following arguments are required: -i/--input_file" % os.path.basename(__file__), showdate = False, font = oscihub.YELLOW)
+            exit()
+        if os.path.isdir(input_file):
+            # The input files of the folder, not its subfolders
+            oscihub.INPUT_FILES.extend(oscihub.get_folder_inputs(input_file))
+        elif oscihub.get_input_format(input_file) is None:
+            oscihub.show_print("%s: error: the input file must be %s" % (os.path.basename(__file__), ', '.join(sorted(oscihub.INPUT_FORMATS))), showdate = False, font = oscihub.YELLOW)
+            exit()
+        else:
+            oscihub.INPUT_FILES.append(input_file)
+    # The same file given twice is run once
+    oscihub.INPUT_FILES = list(dict.fromkeys(oscihub.INPUT_FILES))
+    if not oscihub.INPUT_FILES:
+        oscihub.show_print("%s: error: there are no %s files in the input folders" % (os.path.basename(__file__), ', '.join(sorted(oscihub.INPUT_FORMATS))), showdate = False, font = oscihub.YELLOW)
+        exit()
+    input_formats = [oscihub.get_input_format(input_file) for input_file in oscihub.INPUT_FILES]
+
+    # Check the libraries this run needs, without importing them
+    modules = ['xlsxwriter', 'requests']
+    if 'xlsx' in input_formats:
+        modules.append('openpyxl')
+    if oscihub.BACKEND == 'scidownl':
+        modules.append('scidownl')
+    if oscihub.DEEP_CHECK or oscihub.FULL_TEXT:
+        modules.append('PyPDF2')
+    missing = oscihub.get_missing_modules(modules)
+    if missing:
+        for module in missing:
+            oscihub.show_print("It looks like '%s' is not installed, you can install it with: pip3 install -U %s" % (module, oscihub.MODULES_PIP[module]), showdate = False, font = oscihub.YELLOW)
         exit()
 
     if args.output is not None:
@@ -44,36 +169,160 @@ def menu():
         if output_path is None or output_path == "":
             output_path = os.getcwd().strip()
 
-        oscihub.OUTPUT_PATH = os.path.join(output_path, output_name)
-        created = oscihub.create_directory(oscihub.OUTPUT_PATH)
+        oscihub.ROOT_OUTPUT_PATH = os.path.join(output_path, output_name)
+        created = oscihub.create_directory(oscihub.ROOT_OUTPUT_PATH)
         if not created:
-            oscihub.show_print("%s: error: Couldn't create folder '%s'" % (os.path.basename(__file__), oscihub.OUTPUT_PATH), showdate = False, font = oscihub.YELLOW)
+            oscihub.show_print("%s: error: Couldn't create folder '%s'" % (os.path.basename(__file__), oscihub.ROOT_OUTPUT_PATH), showdate = False, font = oscihub.YELLOW)
             exit()
     else:
-        oscihub.OUTPUT_PATH = os.getcwd().strip()
-        oscihub.OUTPUT_PATH = os.path.join(oscihub.OUTPUT_PATH, 'output_download')
-        oscihub.create_directory(oscihub.OUTPUT_PATH)
+        oscihub.ROOT_OUTPUT_PATH = os.getcwd().strip()
+        oscihub.ROOT_OUTPUT_PATH = os.path.join(oscihub.ROOT_OUTPUT_PATH, 'output_download')
+        oscihub.create_directory(oscihub.ROOT_OUTPUT_PATH)
 
 class SCIhub:
 
     def __init__(self):
         self.VERSION = 1.0
 
+        # Python libraries: import name -> pip name
+        self.MODULES_PIP = {'openpyxl': 'openpyxl',
+                            'xlsxwriter': 'xlsxwriter',
+                            'requests': 'requests',
+                            'scidownl': 'scidownl',
+                            'PyPDF2': 'pypdf2'}
+
         self.INPUT_FILE = None
+        self.INPUT_FILES = []
         self.OUTPUT_PATH = None
+        self.ROOT_OUTPUT_PATH = None # Output folder of the run, a batch has one subfolder per input file
+
+        # Input file: extension -> format. Only .xlsx is read whole, the others are streamed to the downloads
+        self.INPUT_FORMATS = {'.xlsx': 'xlsx',
+                              '.csv': 'csv',
+                              '.tsv': 'tsv',
+                              '.jsonl': 'jsonl',
+                              '.txt': 'txt'}
+        self.INPUT_FORMAT = None
+        self.input_count = None
 
         self.ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
         self.LOG_NAME = "run_%s_%s.log" % (os.path.splitext(os.path.basename(__file__))[0], time.strftime('%Y%m%d'))
         self.LOG_FILE = None
-        self.SUMMARY_FILE_CONTROL = 'summary_control.txt'
+        self.QUIET = False
+        self.log_writers = {}
+        atexit.register(self.close_logs)
+        self.SUMMARY_FILE_CONTROL = 'summary_control.txt' # Resume file of the older versions, imported into the state store
+        self.STATE_FILE = 'summary_control.sqlite'
+        self.state_store = None
+
+        # DOI cache (native backend): DOI -> pdf url
+        self.USE_CACHE = True
+        self.CACHE_FILE = 'doi_cache.sqlite'
+        self.CACHE_TTL = 30 * 24 * 3600        # Seconds
+        self.CACHE_NEGATIVE_TTL = 1 * 24 * 3600 # Seconds, for papers Sci-Hub doesn't have
+        self.CACHE_MAX_ENTRIES = 200000
+        self.doi_cache = None
 
         # SciHub
-        self.SCIHUB_URL = 'https://sci-hub.tw'
-        self.SCIHUB_ID = 0 # 2
+        self.SCIHUB_MIRRORS = ['https://sci-hub.se',
+                               'https://sci-hub.st',
+                               'https://sci-hub.ru']
+        self.MIRROR_FAILURES = 3   # Consecutive failures that open the circuit breaker of a mirror
+        self.MIRROR_COOLDOWN = 300 # Seconds before a mirror with an open circuit breaker is tried again
+        self.PROBE_TIMEOUT = 10
+        self.mirror_pool = None
+        self.mirrors_probed = False
+
+        # Scheduling: order of the pending papers and budget of the run
+        self.ORDER = None # [(Paper attribute, descending, preferred values or None)]
+        self.MAX_TIME = 0  # Seconds, 0 for no limit
+        self.MAX_BYTES = 0 # 0 for no limit
+        self.deadline = None
+        self.bytes_downloaded = 0
+        self.budget_reason = None
+        self.budget_skipped = set() # Indexes of the papers not attempted
+        self.order_attributes = {'item': 'item', 'title': 'title', 'year': 'year', 'doi': 'doi', 'document type': 'document_type',
+                                 'language': 'language', 'cited by': 'cited_by', 'author(s)': 'authors', 'repository': 'repository'}
+        self.re_size = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE)
+
+        # Distributed mode: workers sharing the output folder claim the DOIs from a queue
+        self.QUEUE_RUN = None
+        self.QUEUE_FILE = 'work_queue_%s.sqlite' # Run name
+        self.WORKER_ID = None
+        self.LEASE_TIME = 300
+        self.QUEUE_POLL = 10 # Seconds between two claims while other workers hold the last DOIs
+        self.work_queue = None
+
+        # Retries
+        self.RETRIES = 2
+        self.RETRY_BASE_DELAY = 5   # Seconds, doubled on every attempt
+        self.RETRY_MAX_DELAY = 300
+        self.retry_queue = None
+
+        # Integrity
+        self.DEEP_CHECK = False
+        self.PDF_MIN_SIZE = 256
+        self.PDF_HEADER_WINDOW = 1024 # The header may come after some junk bytes
+        self.PDF_TRAILER_WINDOW = 2048
+        self.PDF_CONTENT_TYPES = ['application/pdf', 'application/octet-stream', 'binary/octet-stream', 'application/x-pdf']
+        self.verify_pool = None
+        self.TIMEOUT = 60
+
+        # Full-text index: the download threads submit the pdfs, a process pool extracts the text, one thread writes the index
+        self.FULL_TEXT = False
+        self.TEXT_INDEX_FILE = 'full_text.sqlite'
+        self.text_index = None
+        self.text_pool = None
+        self.text_queue = None # Pending extractions, bounded so the downloads wait when the extraction falls behind
+        self.text_thread = None
+        self.text_sizes = {} # DOI -> bytes of the pdf in the index
+        self.text_stats = {'indexed': 0, 'failed': 0, 'skipped': 0}
+        self.lock_text = threading.Lock()
+
+        # Backends
+        self.BACKEND = 'native'
+        self.BACKENDS = {'scidownl': ScidownlBackend,
+                         'native': NativeBackend}
+        self.downloader = None
+
+        # Concurrency
+        self.WORKERS = 1
+        self.MAX_PER_HOST = 4
+        self.RATE_PER_HOST = 0 # Papers per second, 0 for no limit
+        self.host_limiters = {}
+        self.executor = None # Worker pool shared by every input file of a batch
+        self.lock_hosts = threading.Lock()
+        self.lock_probe = threading.Lock()
+        self.lock_print = threading.Lock()
+        self.lock_control = threading.Lock()
 
         # Folder
         self.FOLDER_TXT = 'Papers'
-        self.FOLDER_TEMP = 'temporal_folder'
+        self.FOLDER_PARTIAL = '.partial'
+        self.FOLDER_STORE = '.store'
+        self.CONTENT_STORE = False
+        self.duplicate_count = 0 # Papers whose DOI is downloaded for an earlier paper of the input file
+        self.batch_files = {} # Normalized DOI -> pdf downloaded for an earlier input file of the batch
+        self.batch_reused = 0
+        self.PARTIAL_EXTENSION = '.part'
+        self.PARTIAL_META_EXTENSION = '.json' # Url and ETag/Last-Modified of a .part file, a transfer only resumes from the same ones
+        self.PRUNE = False
+        self.file_index = {}
+
+        # Layout: flat (one folder per document type) or sharded (files/<shard>/<DOI hash>.pdf, found through the manifest)
+        self.LAYOUT_FLAT = 'flat'
+        self.LAYOUT = self.LAYOUT_FLAT
+        self.FOLDER_FILES = 'files'
+        self.MANIFEST_FILE = 'manifest.sqlite'
+        self.NAME_LINKS = False
+        self.manifest = None
+        self.manifest_files = {} # Normalized DOI -> path of the pdf, relative to the output folder
+        self.manifest_index = set() # DOIs in the manifest when the input file started, like file_index for the flat layout
+
+        # Archive: the pdfs are appended to one .zip or .tar of the output folder as they are verified
+        self.ARCHIVE = None
+        self.ARCHIVE_FILE = 'papers.%s'
+        self.archive = None
 
         # Year
         self.STATUS_NO_YEAR = 'NoYear'
@@ -93,6 +342,26 @@ class SCIhub:
         # Xls Summary
         self.XLS_FILE = 'summary_download.xlsx'
         self.XLS_SHEET_UNIQUE = 'Unique'
+        self.CSV_FILE = 'summary_download.csv' # Rows written as the papers are read and finish, the .xlsx is rebuilt from it
+        self.SUMMARY_CHECKPOINT = 600 # Seconds between two rebuilds of the .xlsx, 0 only at the end
+        self.summary_ctrl = None
+        self.summary_attempts = None # Attempts of the papers of every worker of a queue, after the merge
+        self.summary_read = 0 # Papers read from the input file
+        self.summary_input_read = False
+        self.summary_sidecar = None
+        self.checkpoint_stop = None
+        self.checkpoint_thread = None # Rebuilds the .xlsx every SUMMARY_CHECKPOINT seconds, the download workers never do
+        self.SUMMARY_XLS = True # A worker of a queue only writes the .xlsx when it merges the results of every worker
+        self.lock_summary = threading.Lock()
+        self.lock_checkpoint = threading.Lock()
+
+        # Run metrics, written next to the summary
+        self.METRICS_JSON_FILE = 'metrics.json'
+        self.METRICS_PROM_FILE = 'metrics.prom'
+        self.PROGRESS = 0 # Seconds between two snapshots of the metrics, 0 only at the end
+        self.metrics = None
+        self.progress_stop = None
+        self.progress_thread = None
 
         # Xls Columns
         self.xls_col_item = 'Item'
@@ -107,6 +376,12 @@ class SCIhub:
         self.xls_col_authors = 'Author(s)'
         self.xls_col_repository = 'Repository'
         self.xls_col_pdf_name = 'PDF Name'
+        self.xls_col_attempts = 'Attempts'
+        self.xls_numeric_columns = [self.xls_col_item, self.xls_col_year, self.xls_col_cited_by, self.xls_col_attempts]
+
+        # Columns of the summary sidecar after the summary ones
+        self.csv_col_key = 'Control Key'
+        self.csv_col_path = 'PDF Path'
 
         self.xls_columns_csv = [self.xls_col_item,
                                 self.xls_col_title,
@@ -123,7 +398,16 @@ class SCIhub:
                                 self.xls_col_doi,
                                 self.xls_col_download]
 
+        # Column names of the input files, matched without case
+        self.input_columns = {column.lower(): column for column in self.xls_columns_csv + [self.xls_col_repository]}
+
         self.default_document_type = 'Unknown Type'
+        self.default_txt_title = 'Article'
+
+        # Title sanitizer
+        self.re_title_chars = re.compile(r"[\/\\\:\*\?\"\“\”\<\>\|\@\°\'\‘\’\®\–\-\n]") # / \ : * ? " “ ” < > | @ ° ' ‘ ’ ® – - and new lines
+        self.title_deletions = str.maketrans('', '', '()')
+        self.re_doi_prefix = re.compile(r'^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)', re.IGNORECASE)
 
         # Fonts
         self.RED = '\033[31m'
@@ -133,7 +417,23 @@ class SCIhub:
         self.BIGREEN = '\033[1;92m'
         self.END = '\033[0m'
 
-    def show_print(self, message, logs = None, showdate = True, font = None):
+    def show_print(self, message, logs = None, showdate = True, font = None, console = True):
+        msg_print, msg_write = self.format_message(message, showdate, font)
+        with self.lock_print:
+            if console:
+                print(msg_print)
+            self.write_logs([msg_write], logs)
+
+    def show_print_batch(self, messages, logs = None, console = True):
+        # messages: [(message, font, time)], printed together so they are not mixed with other threads
+        formatted = [self.format_message(message, True, font, _time) for message, font, _time in messages]
+        with self.lock_print:
+            if console:
+                for msg_print, _ in formatted:
+                    print(msg_print)
+            self.write_logs([msg_write for _, msg_write in formatted], logs)
+
+    def format_message(self, message, showdate = True, font = None, _time = None):
         msg_print = message
         msg_write = message
 
@@ -141,17 +441,25 @@ class SCIhub:
             msg_print = "%s%s%s" % (font, msg_print, self.END)
 
         if showdate is True:
-            _time = time.strftime('%Y-%m-%d %H:%M:%S')
+            _time = time.strftime('%Y-%m-%d %H:%M:%S') if _time is None else _time
             msg_print = "%s %s" % (_time, msg_print)
             msg_write = "%s %s" % (_time, message)
 
-        print(msg_print)
+        return msg_print, msg_write
+
+    def write_logs(self, lines, logs):
         if logs is not None:
             for log in logs:
                 if log is not None:
-                    with open(log, 'a', encoding = 'utf-8') as f:
-                        f.write("%s\n" % msg_write)
-                        f.close()
+                    if log not in self.log_writers:
+                        self.log_writers.update({log: LogWriter(log)})
+                    self.log_writers[log].write(lines)
+
+    def close_logs(self):
+        with self.lock_print:
+            for _, writer in self.log_writers.items():
+                writer.close()
+            self.log_writers = {}
 
     def start_time(self):
         return time.time()
@@ -180,14 +488,67 @@ class SCIhub:
                 _check = True
         return _check
 
+    def get_input_format(self, file):
+        return self.INPUT_FORMATS.get(os.path.splitext(file)[1].lower())
+
+    def get_folder_inputs(self, folder):
+        # Temporal files of Excel (~$name.xlsx) are skipped
+        files = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('~$') and self.get_input_format(entry.name) is not None:
+                    files.append(entry.path)
+        return sorted(files)
+
+    def get_input_outputs(self):
+        # A single input file writes into the output folder, a batch into one subfolder per input file
+        if len(self.INPUT_FILES) == 1:
+            return [(self.INPUT_FILES[0], self.ROOT_OUTPUT_PATH)]
+        names = [os.path.splitext(os.path.basename(input_file))[0] for input_file in self.INPUT_FILES]
+        outputs = []
+        for input_file, name in zip(self.INPUT_FILES, names):
+            if names.count(name) > 1:
+                # 'papers.csv' and 'papers.xlsx' -> 'papers_csv', 'papers_xlsx'
+                name = os.path.basename(input_file).replace('.', '_')
+            outputs.append((input_file, os.path.join(self.ROOT_OUTPUT_PATH, name)))
+        return outputs
+
+    def set_input(self, input_file, output_path):
+        # The files of an input go to its output folder, the DOI cache stays in the output folder of the run
+        self.INPUT_FILE = input_file
+        self.INPUT_FORMAT = self.get_input_format(input_file)
+        self.input_count = None
+        self.TYPE_INPUT = None
+        self.file_index = {}
+        self.budget_skipped = set()
+        self.OUTPUT_PATH = output_path
+        self.create_directory(self.OUTPUT_PATH)
+        self.LOG_FILE = os.path.join(self.OUTPUT_PATH, self.LOG_NAME)
+        self.XLS_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.XLS_FILE))
+        self.CSV_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.CSV_FILE))
+        self.METRICS_JSON_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.METRICS_JSON_FILE))
+        self.METRICS_PROM_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.METRICS_PROM_FILE))
+        if self.QUEUE_RUN is not None:
+            # Each worker writes its own rows and metrics, the merged summary is the .xlsx
+            self.CSV_FILE = os.path.join(self.OUTPUT_PATH, 'summary_download.%s.csv' % self.WORKER_ID)
+            self.METRICS_JSON_FILE = os.path.join(self.OUTPUT_PATH, 'metrics.%s.json' % self.WORKER_ID)
+            self.METRICS_PROM_FILE = os.path.join(self.OUTPUT_PATH, 'metrics.%s.prom' % self.WORKER_ID)
+            self.SUMMARY_XLS = False
+        self.metrics = RunMetrics()
+        self.SUMMARY_FILE_CONTROL = os.path.join(self.OUTPUT_PATH, os.path.basename(self.SUMMARY_FILE_CONTROL))
+        self.STATE_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.STATE_FILE))
+        self.MANIFEST_FILE = os.path.join(self.OUTPUT_PATH, os.path.basename(self.MANIFEST_FILE))
+        self.manifest_files = {}
+        self.manifest_index = set()
+
+    def get_missing_modules(self, modules):
+        return [module for module in modules if importlib.util.find_spec(module) is None]
+
     def check_title(self, title):
-        rstr = r"[\/\\\:\*\?\"\“\”\<\>\|\@\°\'\‘\’\®\–\-]" # / \ : * ? " “ ” < > | @ ° ' ‘ ’ ® – -
-        new_title = re.sub(rstr, " ", title)
-        new_title = re.sub("\n", " ", new_title)
-        new_title = re.sub("  ", " ", new_title)
-        new_title = re.sub("  ", " ", new_title)
-        new_title = new_title.replace('(', '')
-        new_title = new_title.replace(')', '')
+        new_title = self.re_title_chars.sub(" ", title)
+        new_title = new_title.replace("  ", " ")
+        new_title = new_title.replace("  ", " ")
+        new_title = new_title.translate(self.title_deletions)
 
         if '[' in new_title:
             new_title = new_title.split('[')[0].strip()
@@ -205,66 +566,452 @@ class SCIhub:
             output = False
         return output
 
-    def set_xls_type(self):
-        df = pd.read_excel(io = self.INPUT_FILE, sheet_name = self.XLS_SHEET_UNIQUE)
-        # df = df.where(pd.notnull(df), None)
-        df = df.replace({np.nan: None})
-        # print(df)
-
-        ncolumns = df.shape[1]
-
-        if ncolumns == 10:
+    def set_input_type(self, header):
+        # The layout is given by the names of the columns, whatever their order
+        if self.xls_col_doi not in header:
+            self.TYPE_INPUT = None
+        elif self.xls_col_repository in header:
             self.TYPE_INPUT = self.TYPE_REPOSITORY_UNION
-        elif ncolumns == 9:
+        elif self.xls_col_title in header:
             self.TYPE_INPUT = self.TYPE_REPOSITORY_UNIQUE
-        elif ncolumns == 2:
+        else:
             self.TYPE_INPUT = self.TYPE_TXT
 
-    def read_xls_summary(self):
-        df = pd.read_excel(io = self.INPUT_FILE, sheet_name = self.XLS_SHEET_UNIQUE)
-        # df = df.where(pd.notnull(df), None)
-        df = df.replace({np.nan: None})
-        # print(df)
+    def get_column_name(self, column):
+        # 'doi', ' DOI ' -> 'DOI'
+        if column is None:
+            return None
+        column = str(column).strip()
+        return self.input_columns.get(column.lower(), column)
+
+    def iter_input_rows(self):
+        # Generator: the header first (list of column names), then one dictionary per row
+        if self.INPUT_FORMAT == 'xlsx':
+            yield from self.iter_xlsx_rows()
+        elif self.INPUT_FORMAT in ['csv', 'tsv']:
+            yield from self.iter_csv_rows(delimiter = ',' if self.INPUT_FORMAT == 'csv' else '\t')
+        elif self.INPUT_FORMAT == 'jsonl':
+            yield from self.iter_jsonl_rows()
+        elif self.INPUT_FORMAT == 'txt':
+            yield from self.iter_txt_rows()
+
+    def iter_xlsx_rows(self):
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(self.INPUT_FILE, read_only = True, data_only = True)
+        try:
+            rows = workbook[self.XLS_SHEET_UNIQUE].iter_rows(values_only = True)
+            header = [self.get_column_name(column) for column in next(rows, ())]
+            yield header
+            for values in rows:
+                yield {column: value for column, value in zip(header, values) if column is not None}
+        finally:
+            workbook.close()
+
+    def iter_csv_rows(self, delimiter):
+        # Large fields (abstracts) are allowed
+        csv.field_size_limit(2 ** 31 - 1)
+        with open(self.INPUT_FILE, newline = '', encoding = 'utf-8-sig') as f:
+            rows = csv.reader(f, delimiter = delimiter)
+            header = [self.get_column_name(column) for column in next(rows, [])]
+            yield header
+            for values in rows:
+                yield {column: value if value != '' else None for column, value in zip(header, values)}
+
+    def iter_jsonl_rows(self):
+        # The keys of the first object are the header
+        header = None
+        with open(self.INPUT_FILE, encoding = 'utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                row = {self.get_column_name(column): value if value != '' else None for column, value in json.loads(line).items()}
+                if header is None:
+                    header = list(row)
+                    yield header
+                yield row
+        if header is None:
+            yield []
+
+    def iter_txt_rows(self):
+        # One DOI per line, lines starting with '#' are comments
+        yield [self.xls_col_doi]
+        with open(self.INPUT_FILE, encoding = 'utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield {self.xls_col_doi: line}
+
+    def read_input_file(self):
+        # .xlsx files are read whole (the names of the pdfs depend on the whole Year column), the other formats
+        # return a generator and the downloads start with the first rows
+        rows = self.iter_input_rows()
+        self.set_input_type(next(rows, []))
+        if self.TYPE_INPUT is None:
+            rows.close()
+            return []
+
+        if self.INPUT_FORMAT == 'xlsx':
+            papers = list(self.iter_papers(rows))
+            self.set_paper_names(papers)
+            self.input_count = len(papers)
+            return papers
+        return self.metrics.time_iter('read', self.iter_papers(rows, named = True))
+
+    def iter_papers(self, rows, named = False):
+        index = 0
+        for row in rows:
+            if self.is_empty_row(row.values()):
+                continue
+            index += 1
+            paper = self.make_paper(index, row)
+            if named:
+                self.set_paper_name(paper)
+            yield paper
+
+    def is_empty_row(self, values):
+        for value in values:
+            if value is not None:
+                return False
+        return True
 
-        file_collection = {}
-        for index, row in df.iterrows():
-            collection = {}
-            if self.TYPE_INPUT == self.TYPE_TXT:
-                collection.update({self.xls_col_item: row[self.xls_col_item],
-                                   self.xls_col_doi: row[self.xls_col_doi]})
-            else:
-                collection.update({self.xls_col_item: row[self.xls_col_item],
-                                   self.xls_col_title: row[self.xls_col_title],
-                                   self.xls_col_abstract: row[self.xls_col_abstract],
-                                   self.xls_col_year: row[self.xls_col_year],
-                                   self.xls_col_doi: row[self.xls_col_doi],
-                                   self.xls_col_document_type: row[self.xls_col_document_type],
-                                   self.xls_col_languaje: row[self.xls_col_languaje],
-                                   self.xls_col_cited_by: row[self.xls_col_cited_by],
-                                   self.xls_col_authors: row[self.xls_col_authors],
-                                   self.xls_col_repository: row[self.xls_col_repository]})
-
-            file_collection.update({index + 1: collection})
-
-        return file_collection
-
-    def write_file_control(self, doi, status):
+    def make_paper(self, index, row):
+        paper = Paper(index = index,
+                      item = row.get(self.xls_col_item),
+                      doi = self.clean_doi(row.get(self.xls_col_doi)))
+        paper.doi_key = self.normalize_doi(paper.doi)
+
+        if self.TYPE_INPUT != self.TYPE_TXT:
+            paper.title = row.get(self.xls_col_title)
+            paper.abstract = row.get(self.xls_col_abstract)
+            paper.year = row.get(self.xls_col_year)
+            paper.document_type = row.get(self.xls_col_document_type)
+            paper.language = row.get(self.xls_col_languaje)
+            paper.cited_by = row.get(self.xls_col_cited_by)
+            paper.authors = row.get(self.xls_col_authors)
+            paper.repository = row.get(self.xls_col_repository)
+
+        return paper
+
+    def set_paper_names(self, papers):
+        # pandas used to read a numeric Year column with blanks as floats ('2019.0.Title.pdf'), the names are kept so older collections still resume
+        years = [paper.year for paper in papers]
+        float_years = None in years and all(isinstance(year, (int, float)) and not isinstance(year, bool) for year in years if year is not None)
+
+        for paper in papers:
+            self.set_paper_name(paper, float_years)
+
+    def set_paper_name(self, paper, float_years = False):
         if self.TYPE_INPUT == self.TYPE_TXT:
-            open(self.SUMMARY_FILE_CONTROL, 'a').write('%s\t%s\n' % (doi, status))
+            paper.folder = self.FOLDER_TXT
+            paper.pdf_name = '%s.pdf' % self.check_title('%s.%s' % (paper.index, self.default_txt_title))
+            paper.ctrl_key = paper.doi
+        else:
+            if float_years and paper.year is not None:
+                paper.year = float(paper.year)
+            _year = self.STATUS_NO_YEAR if paper.year is None else paper.year
+            paper.folder = self.default_document_type if paper.document_type is None else paper.document_type
+            paper.pdf_name = '%s.pdf' % self.check_title('%s.%s' % (_year, paper.title))
+            paper.ctrl_key = '%s.%s' % (paper.folder, paper.pdf_name)
+
+    def clean_doi(self, doi):
+        if doi is None:
+            return None
+        doi = str(doi).strip()
+        return doi if doi else None
+
+    def normalize_doi(self, doi):
+        # 'https://doi.org/10.1000/ABC ' -> '10.1000/abc', DOIs are case insensitive
+        if doi is None:
+            return None
+        doi = self.re_doi_prefix.sub('', doi.strip())
+        doi = ''.join(doi.split()).lower()
+        return doi if doi else None
+
+    def write_file_control(self, ctrl_title, status, doi = None, attempted = False, error = None, size = None, duration = None, path = None):
+        if ctrl_title is None:
+            return
+        self.state_store.save(ctrl_key = ctrl_title,
+                              doi = doi,
+                              status = status,
+                              attempted = attempted,
+                              error = error,
+                              size = size,
+                              duration = duration,
+                              path = path)
+
+    def open_state_store(self):
+        # The workers of a queue commit every change, an open transaction would lock the others out
+        shared = self.QUEUE_RUN is not None
+        self.state_store = StateStore(self.STATE_FILE, batch_size = 1 if shared else 50, shared = shared)
+        if self.state_store.is_empty() and self.check_path(self.SUMMARY_FILE_CONTROL):
+            imported = self.state_store.import_control_file(self.SUMMARY_FILE_CONTROL)
+            self.show_print("Records imported from %s: %s" % (self.SUMMARY_FILE_CONTROL, imported), [self.LOG_FILE])
+
+    def open_doi_cache(self):
+        if self.USE_CACHE and self.BACKEND == 'native':
+            shared = self.QUEUE_RUN is not None
+            self.doi_cache = DoiCache(self.CACHE_FILE, ttl = self.CACHE_TTL, negative_ttl = self.CACHE_NEGATIVE_TTL, max_entries = self.CACHE_MAX_ENTRIES,
+                                      batch_size = 1 if shared else 50, shared = shared)
+
+    def close_doi_cache(self):
+        if self.doi_cache is not None:
+            self.doi_cache.close()
+            self.doi_cache = None
+
+    def open_work_queue(self):
+        if self.QUEUE_RUN is not None:
+            self.work_queue = WorkQueue(os.path.join(self.OUTPUT_PATH, self.QUEUE_FILE % self.QUEUE_RUN), self.WORKER_ID, lease_time = self.LEASE_TIME)
+
+    def close_work_queue(self):
+        if self.work_queue is not None:
+            self.work_queue.close()
+            self.work_queue = None
+
+    def close_state_store(self):
+        if self.state_store is not None:
+            self.state_store.close()
+            self.state_store = None
+
+    def open_archive(self):
+        if self.ARCHIVE is not None:
+            self.archive = PaperArchive(os.path.join(self.OUTPUT_PATH, self.ARCHIVE_FILE % self.ARCHIVE), self.ARCHIVE)
+            if self.archive.recovered:
+                self.show_print("The archive %s wasn't closed, complete files found: %s" % (self.archive.PATH, self.archive.recovered), [self.LOG_FILE], font = self.YELLOW)
+                self.show_print("", [self.LOG_FILE])
+
+    def close_archive(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def open_manifest(self):
+        if self.LAYOUT != self.LAYOUT_FLAT:
+            self.manifest = Manifest(self.MANIFEST_FILE, shared = self.QUEUE_RUN is not None)
+
+    def close_manifest(self):
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
 
-    def save_summary_xls(self, data_paper, data_status):
+    def update_control(self, dict_ctrl, ctrl_title, status):
+        with self.lock_control:
+            dict_ctrl.update({ctrl_title: status})
+
+    def get_host_limiter(self, url):
+        host = urlparse(url).netloc
+        with self.lock_hosts:
+            if host not in self.host_limiters:
+                self.host_limiters.update({host: HostLimiter(host, max_limit = self.MAX_PER_HOST, rate = self.RATE_PER_HOST, on_decrease = self.show_limit_decrease)})
+            return self.host_limiters[host]
+
+    def show_limit_decrease(self, host, old_limit, new_limit):
+        self.show_print("Errors or throttling on %s, concurrent requests limit: %.1f -> %.1f" % (host, old_limit, new_limit), [self.LOG_FILE], font = self.YELLOW, console = not self.QUIET)
+
+    def get_summary_columns(self):
         if self.TYPE_INPUT == self.TYPE_TXT:
             _xls_columns = self.xls_columns_txt.copy()
         else:
+            _xls_columns = self.xls_columns_csv.copy()
             if self.TYPE_INPUT == self.TYPE_REPOSITORY_UNION:
-                self.xls_columns_csv.append(self.xls_col_repository)
-            self.xls_columns_csv.append(self.xls_col_pdf_name)
+                _xls_columns.append(self.xls_col_repository)
+            _xls_columns.append(self.xls_col_pdf_name)
+        _xls_columns.append(self.xls_col_attempts)
 
-            _xls_columns = self.xls_columns_csv.copy()
+        return _xls_columns
 
+    def get_summary_row(self, irow, paper, status, abstract = None):
+        if self.TYPE_INPUT == self.TYPE_TXT:
+            return [irow, paper.doi, status, paper.attempts]
+
+        col_pdf_name = None
+        if status == self.STATUS_OK:
+            col_pdf_name = paper.pdf_name if self.LAYOUT == self.LAYOUT_FLAT else self.get_pdf_path(paper)
+        row = [irow, paper.title, abstract, paper.year, paper.doi, paper.folder,
+               paper.language, paper.cited_by, status, paper.authors]
+        if self.TYPE_INPUT == self.TYPE_REPOSITORY_UNION:
+            row.append(paper.repository)
+        row.extend([col_pdf_name, paper.attempts])
+
+        return row
+
+    def get_sidecar_columns(self):
+        # The summary columns, then the key of the paper in the state store and the path of its pdf once downloaded
+        return self.get_summary_columns() + [self.csv_col_key, self.csv_col_path]
+
+    def get_sidecar_header(self):
+        if not self.check_path(self.CSV_FILE):
+            return None
+        with open(self.CSV_FILE, newline = '', encoding = 'utf-8') as f:
+            return next(csv.reader(f), None)
+
+    def open_summary_sidecar(self, dict_ctrl):
+        self.summary_ctrl = dict_ctrl
+        self.summary_attempts = None
+        self.summary_read = 0
+        self.summary_input_read = False
+
+        # The rows of a run that was stopped are kept, the Items this run reads again get new rows
+        columns = self.get_sidecar_columns()
+        append = self.get_sidecar_header() == columns
+        self.summary_sidecar = open(self.CSV_FILE, 'a' if append else 'w', newline = '', encoding = 'utf-8')
+        if not append:
+            csv.writer(self.summary_sidecar).writerow(columns)
+        self.summary_sidecar.flush()
+
+        if self.SUMMARY_CHECKPOINT > 0 and self.SUMMARY_XLS:
+            self.checkpoint_stop = threading.Event()
+            self.checkpoint_thread = threading.Thread(target = self.run_checkpoints, name = 'summary-checkpoint', daemon = True)
+            self.checkpoint_thread.start()
+
+    def add_summary_row(self, paper, abstract = None):
+        # One line when the paper is read (the only one with the abstract) and one each time it finishes, the last line of an Item wins
+        if self.summary_sidecar is None:
+            return
+        path = None
+        if self.TYPE_INPUT != self.TYPE_TXT:
+            path = paper.pdf_name if self.LAYOUT == self.LAYOUT_FLAT else self.get_pdf_path(paper)
+        row = self.get_summary_row(paper.index, paper, self.summary_ctrl.get(paper.ctrl_key), abstract) + [paper.ctrl_key, path]
+        with self.lock_summary:
+            csv.writer(self.summary_sidecar).writerow(row)
+            self.summary_sidecar.flush()
+
+    def run_checkpoints(self):
+        while not self.checkpoint_stop.wait(self.SUMMARY_CHECKPOINT):
+            self.checkpoint_summary()
+
+    def checkpoint_summary(self, final = False):
+        if self.summary_ctrl is None or not (self.SUMMARY_XLS or final):
+            return
+        # The checkpoint thread and the main thread (before the retries, at the end) never write the .xlsx at the same time
+        with self.lock_checkpoint:
+            self.metrics.time_call('summary', self.save_summary_xls, self.summary_ctrl, final)
+
+    def close_summary(self):
+        # Also called when the run is interrupted, the .xlsx keeps the partial results
+        if self.summary_ctrl is None:
+            return
+        if self.checkpoint_thread is not None:
+            self.checkpoint_stop.set()
+            self.checkpoint_thread.join()
+            self.checkpoint_thread = None
+        if self.summary_sidecar is not None:
+            with self.lock_summary:
+                self.summary_sidecar.close()
+                self.summary_sidecar = None
+        self.checkpoint_summary(final = True)
+        self.summary_ctrl = None
+        self.summary_attempts = None
+
+    def iter_sidecar_lines(self):
+        # Only the lines written when it's called, a line the workers are still writing isn't read
+        with self.lock_summary:
+            size = os.fstat(self.summary_sidecar.fileno()).st_size if self.summary_sidecar is not None else os.path.getsize(self.CSV_FILE)
+        read = 0
+        with open(self.CSV_FILE, 'rb') as f:
+            for line in f:
+                read += len(line)
+                if read > size:
+                    return
+                yield line.decode('utf-8')
+
+    def iter_summary_rows(self, limit = None):
+        # Rows of the sidecar in sheet order, sorted in a temporary database on disk: the last row of an Item
+        # wins and keeps the abstract of the first one. Items above limit are dropped (a shorter input file)
+        connection = sqlite3.connect('')
+        try:
+            connection.execute('CREATE TABLE rows (item INTEGER PRIMARY KEY, abstract TEXT, row TEXT)')
+            reader = csv.reader(self.iter_sidecar_lines())
+            header = next(reader, None)
+            col_abstract = None
+            if header == self.get_sidecar_columns():
+                col_abstract = header.index(self.xls_col_abstract) if self.xls_col_abstract in header else None
+                def iter_rows():
+                    for row in reader:
+                        if len(row) != len(header) or not row[0].isdigit():
+                            # The last line of a run that was killed while writing it
+                            continue
+                        if limit is not None and int(row[0]) > limit:
+                            continue
+                        abstract = None
+                        if col_abstract is not None:
+                            abstract = row[col_abstract] or None
+                            row[col_abstract] = ''
+                        yield (int(row[0]), abstract, json.dumps(row))
+                connection.executemany('''INSERT INTO rows (item, abstract, row) VALUES (?, ?, ?)
+                                          ON CONFLICT (item) DO UPDATE SET row = excluded.row,
+                                                                           abstract = COALESCE(abstract, excluded.abstract)''', iter_rows())
+            for _, abstract, row in connection.execute('SELECT item, abstract, row FROM rows ORDER BY item'):
+                row = json.loads(row)
+                if abstract is not None:
+                    row[col_abstract] = abstract
+                yield row
+        finally:
+            connection.close()
+
+    def get_summary_value(self, column, value):
+        # The sidecar has text, the numbers of the input file are numbers again in the .xlsx
+        if value == '':
+            return None
+        if column in self.xls_numeric_columns:
+            for number in [int, float]:
+                try:
+                    return number(value)
+                except ValueError:
+                    pass
+        return value
+
+    def save_summary_xls(self, data_status, final = False):
+        # The .xlsx is rebuilt from the sidecar; the final one also rewrites the sidecar with one line per Item
+        _xls_columns = self.get_summary_columns()
+        col_status = _xls_columns.index(self.xls_col_download)
+        col_pdf_name = _xls_columns.index(self.xls_col_pdf_name) if self.xls_col_pdf_name in _xls_columns else None
+        col_attempts = _xls_columns.index(self.xls_col_attempts)
+
+        workbook = None
+        if self.SUMMARY_XLS:
+            workbook, worksheet, cell_format_row, temporal = self.open_summary_xls()
+        sidecar = None
+        if final:
+            sidecar_temporal = '%s%s' % (self.CSV_FILE, self.PARTIAL_EXTENSION)
+            sidecar = open(sidecar_temporal, 'w', newline = '', encoding = 'utf-8')
+            sidecar_writer = csv.writer(sidecar)
+            sidecar_writer.writerow(self.get_sidecar_columns())
+
+        irow = 0
+        for row in self.iter_summary_rows(self.summary_read if final and self.summary_input_read else None):
+            key, path = row[-2:]
+            # The statuses of the run (the merged ones of every worker of a queue) decide, not the one of the last line
+            if key in data_status:
+                row[col_status] = data_status[key] or ''
+            if col_pdf_name is not None:
+                row[col_pdf_name] = path if row[col_status] == self.STATUS_OK else ''
+            if self.summary_attempts is not None:
+                row[col_attempts] = str(max(int(row[col_attempts] or 0), self.summary_attempts.get(key, 0)))
+            irow += 1
+            if workbook is not None:
+                worksheet.write_row(irow, 0, [self.get_summary_value(column, value) for column, value in zip(_xls_columns, row)], cell_format_row)
+            if sidecar is not None:
+                sidecar_writer.writerow(row)
+
+        if workbook is not None:
+            workbook.close()
+            os.replace(temporal, self.XLS_FILE)
+        if sidecar is not None:
+            sidecar.close()
+            os.replace(sidecar_temporal, self.CSV_FILE)
+
+    def open_summary_xls(self):
+        import xlsxwriter
+
+        _xls_columns = self.get_summary_columns()
         _last_col = len(_xls_columns) - 1
 
-        workbook = xlsxwriter.Workbook(self.XLS_FILE)
+        # Rows are flushed to disk as they are written (constant memory) into a temporal file,
+        # an interrupted checkpoint never leaves a broken summary
+        temporal = '%s%s' % (self.XLS_FILE, self.PARTIAL_EXTENSION)
+        workbook = xlsxwriter.Workbook(temporal, {'constant_memory': True})
         worksheet = workbook.add_worksheet(self.XLS_SHEET_UNIQUE)
         worksheet.freeze_panes(row = 1, col = 0) # Freeze the first row.
         worksheet.autofilter(first_row = 0, first_col = 0, last_row = 0, last_col = _last_col) # 'A1:H1'
@@ -284,6 +1031,7 @@ class SCIhub:
             worksheet.set_column(first_col = 0, last_col = 0, width = 7)  # Column A:A
             worksheet.set_column(first_col = 1, last_col = 1, width = 30) # Column B:B
             worksheet.set_column(first_col = 2, last_col = 2, width = 13) # Column C:C
+            worksheet.set_column(first_col = 3, last_col = 3, width = 9)  # Column D:D
         else:
             worksheet.set_column(first_col = 0, last_col = 0, width = 7)  # Column A:A
             worksheet.set_column(first_col = 1, last_col = 1, width = 30) # Column B:B
@@ -298,338 +1046,2432 @@ class SCIhub:
             if self.TYPE_INPUT == self.TYPE_REPOSITORY_UNION:
                 worksheet.set_column(first_col = 10, last_col = 10, width = 13) # Column K:K
                 worksheet.set_column(first_col = 11, last_col = 11, width = 30) # Column L:L
+                worksheet.set_column(first_col = 12, last_col = 12, width = 9)  # Column M:M
             else:
                 worksheet.set_column(first_col = 10, last_col = 10, width = 30) # Column K:K
+                worksheet.set_column(first_col = 11, last_col = 11, width = 9)  # Column L:L
 
         cell_format_row = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-        icol = 0
-        for irow, item in data_paper.items():
-            if self.TYPE_INPUT == self.TYPE_TXT:
-                col_doi = item[self.xls_col_doi]
-                ctrl_title = col_doi
-            else:
-                col_title = item[self.xls_col_title]
-                col_abstract = item[self.xls_col_abstract]
-                col_year = item[self.xls_col_year]
-                col_doi = item[self.xls_col_doi]
-                col_document_type = item[self.xls_col_document_type]
-                col_document_type = self.default_document_type if col_document_type is None else col_document_type
-                col_languaje = item[self.xls_col_languaje]
-                col_cited_by = item[self.xls_col_cited_by]
-                col_authors = item[self.xls_col_authors]
-                if self.TYPE_INPUT == self.TYPE_REPOSITORY_UNION:
-                    col_repository = item[self.xls_col_repository]
-
-                _col_year = self.STATUS_NO_YEAR if col_year is None else col_year
-                _year_title = '%s.%s' % (_col_year, col_title)
-                ctrl_title = '%s.%s.pdf' % (col_document_type, self.check_title(_year_title))
-
-                col_pdf_name = None
-                if data_status[ctrl_title] == self.STATUS_OK:
-                    col_pdf_name = item[self.xls_col_pdf_name]
-
-            if self.TYPE_INPUT == self.TYPE_TXT:
-                worksheet.write(irow, icol + 0, irow, cell_format_row)
-                worksheet.write(irow, icol + 1, col_doi, cell_format_row)
-                worksheet.write(irow, icol + 2, data_status[ctrl_title], cell_format_row)
-            else:
-                worksheet.write(irow, icol + 0, irow, cell_format_row)
-                worksheet.write(irow, icol + 1, col_title, cell_format_row)
-                worksheet.write(irow, icol + 2, col_abstract, cell_format_row)
-                worksheet.write(irow, icol + 3, col_year, cell_format_row)
-                worksheet.write(irow, icol + 4, col_doi, cell_format_row)
-                worksheet.write(irow, icol + 5, col_document_type, cell_format_row)
-                worksheet.write(irow, icol + 6, col_languaje, cell_format_row)
-                worksheet.write(irow, icol + 7, col_cited_by, cell_format_row)
-                worksheet.write(irow, icol + 8, data_status[ctrl_title], cell_format_row)
-                worksheet.write(irow, icol + 9, col_authors, cell_format_row)
-                if self.TYPE_INPUT == self.TYPE_REPOSITORY_UNION:
-                    worksheet.write(irow, icol + 10, col_repository, cell_format_row)
-                    worksheet.write(irow, icol + 11, col_pdf_name, cell_format_row)
-                else:
-                    worksheet.write(irow, icol + 10, col_pdf_name, cell_format_row)
-        workbook.close()
-
-    def save_summary_text(self, dict_control):
-        if self.TYPE_INPUT == self.TYPE_TXT:
-            self.remove_file(self.SUMMARY_FILE_CONTROL)
-            if len(dict_control) > 0:
-                self.save_text_file(dictionary = dict_control, file = self.SUMMARY_FILE_CONTROL, title = 'Status')
+        return (workbook, worksheet, cell_format_row, temporal)
 
     def remove_file(self, file):
         if self.check_path(file):
             os.remove(file)
 
-    def save_text_file(self, dictionary, file, title):
-        with open(file, 'w') as f:
-            f.write('Index\t%s\n' % title)
-            for i, value in dictionary.items():
-                f.write('%s\t%s\n' % (i, value))
-        f.close()
-
-    def get_expected_files(self, dictionary):
-        folders = {}
-        for idx, item in dictionary.items():
-            _document_type = item[self.xls_col_document_type]
-            _document_type = self.default_document_type if _document_type is None else _document_type
-            _year = item[self.xls_col_year]
-            _year = self.STATUS_NO_YEAR if _year is None else _year 
-            _title = item[self.xls_col_title]
-            _year_title = '%s.%s' % (_year, _title)
-            _title = self.check_title(_year_title)
-            pdfname = '%s.pdf' % (_title)
-
-            item.update({self.xls_col_pdf_name: pdfname})
-
-            if _document_type not in folders:
-                documents = [pdfname]
-            else:
-                documents = folders[_document_type].copy()
-                documents.append(pdfname)
-
-            folders.update({_document_type: documents})
+    def remove_partial(self, part_pdf):
+        self.remove_file(part_pdf)
+        self.remove_file('%s%s' % (part_pdf, self.PARTIAL_META_EXTENSION))
 
-        return folders
-
-    def get_downloaded_files(self, dictionary = None):
+    def get_downloaded_files(self):
         summary_ctrl = {}
-        if self.TYPE_INPUT == self.TYPE_TXT:
-            if self.check_path(self.SUMMARY_FILE_CONTROL):
-                with open(self.SUMMARY_FILE_CONTROL, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if not line.startswith('Index'):
-                            line = line.split('\t')
-                            summary_ctrl.update({line[0]: line[1]})
-                f.close()
-            else:
-                open(self.SUMMARY_FILE_CONTROL, 'w').close()
+        if self.manifest is not None:
+            # The manifest decides what is downloaded, the folders aren't listed
+            for ctrl_name, status in self.state_store.get_statuses().items():
+                if status != self.STATUS_OK:
+                    summary_ctrl.update({ctrl_name: status})
+
+            self.manifest_files = self.manifest.get_files()
+            self.manifest_index = set(self.manifest_files)
+        elif self.TYPE_INPUT == self.TYPE_TXT:
+            summary_ctrl.update(self.state_store.get_statuses())
         else:
-            self.remove_directory(self.FOLDER_TEMP)
-            self.create_directory(self.FOLDER_TEMP)
-
-            for folder, files in dictionary.items():
-                this_folder = os.path.join(self.OUTPUT_PATH, folder)
-                if self.check_path(this_folder):
-                    shutil.move(this_folder, self.FOLDER_TEMP)
-
-            for folder, files in dictionary.items():
-                for file in files:
-                    this_file = os.path.join(self.FOLDER_TEMP, folder, file)
-                    if self.check_path(this_file):
-                        real_folder = os.path.join(self.OUTPUT_PATH, folder)
-                        self.create_directory(real_folder)
-                        shutil.move(this_file, real_folder)
-                        ctrl_name = '%s.%s' % (folder, file)
-                        summary_ctrl.update({ctrl_name: self.STATUS_OK})
-
-            self.remove_directory(self.FOLDER_TEMP)
+            # The pdfs on disk decide what is downloaded (see update_status), the store keeps the other statuses
+            for ctrl_name, status in self.state_store.get_statuses().items():
+                if status != self.STATUS_OK:
+                    summary_ctrl.update({ctrl_name: status})
+
+            # The members of the archive are read from its directory (zip) or headers (tar), not from the folders
+            self.file_index = self.archive.get_index() if self.archive is not None else self.index_output_files()
 
         return summary_ctrl
 
-    def update_status(self, dictionary, dict_ctrl):
-        for _, item in dictionary.items():
-            if self.TYPE_INPUT == self.TYPE_TXT:
-                _doi = item[self.xls_col_doi]
-                _status = dict_ctrl[_doi] if _doi in dict_ctrl else None
-            else:
-                _document_type = item[self.xls_col_document_type]
-                _document_type = self.default_document_type if _document_type is None else _document_type
-                _year = item[self.xls_col_year]
-                _year = self.STATUS_NO_YEAR if _year is None else _year 
-                _title = item[self.xls_col_title]
-                _year_title = '%s.%s' % (_year, _title)
-                _title = self.check_title(_year_title)
-                pdfname = '%s.%s.pdf' % (_document_type, _title)
-                _status = dict_ctrl[pdfname] if pdfname in dict_ctrl else None
-            item.update({self.STATUS_NAME: _status})
-
-    def download_pdf(self, dict_information, dict_ctrl):
-        record_count = len(dict_information)
-        summary_not_availables = {}
-        summary_non_existents = {}
-        for idx, item in dict_information.items():
-            doi = item[self.xls_col_doi]
-            status = item[self.STATUS_NAME]
+    def get_pdf_path(self, paper):
+        # Path of the pdf relative to the output folder
+        if self.LAYOUT == self.LAYOUT_FLAT:
+            return os.path.join(paper.folder, paper.pdf_name)
+        digest = self.get_doi_hash(paper.doi_key)
+        shard = digest[:2] if self.LAYOUT == 'hash' else self.get_year_folder(paper.year)
+        return os.path.join(self.FOLDER_FILES, shard, '%s.pdf' % digest)
+
+    def get_doi_hash(self, doi_key):
+        return hashlib.sha1(doi_key.encode('utf-8')).hexdigest()
+
+    def get_out_pdf(self, paper):
+        # In the archive, the path of the member after the path of the archive
+        return os.path.join(self.archive.PATH if self.archive is not None else self.OUTPUT_PATH, self.get_pdf_path(paper))
+
+    def get_member(self, out_pdf):
+        return os.path.relpath(out_pdf, self.archive.PATH).replace(os.sep, '/')
+
+    def has_pdf(self, out_pdf):
+        if self.archive is not None:
+            return self.get_member(out_pdf) in self.archive
+        return self.check_path(out_pdf)
+
+    def get_pdf_size(self, out_pdf):
+        if self.archive is not None:
+            return self.archive.get_size(self.get_member(out_pdf))
+        return os.path.getsize(out_pdf)
+
+    def save_pdf(self, part_pdf, out_pdf):
+        # The verified .part file goes to its place; returns the SHA-256 when it was computed
+        if self.archive is not None:
+            self.archive.add_file(self.get_member(out_pdf), part_pdf)
+            self.remove_file(part_pdf)
+        elif self.CONTENT_STORE:
+            return self.store_content(part_pdf, out_pdf)
+        else:
+            os.replace(part_pdf, out_pdf)
+        return None
 
-            if self.TYPE_INPUT == self.TYPE_TXT:
-                title = 'Article'
-                document_type = self.FOLDER_TXT
-                message = "[%s/%s] Analyzing the DOI: %s" % (idx, record_count, doi)
-                year = idx
-                ctrl_title = doi
-            else:
-                title = item[self.xls_col_title]
-                document_type = item[self.xls_col_document_type]
-                document_type = self.default_document_type if document_type is None else document_type
-                message = "[%s/%s] Analyzing the Paper: %s" % (idx, record_count, title)
-                year = item[self.xls_col_year]
-                year = self.STATUS_NO_YEAR if year is None else year
-                _year_title = '%s.%s' % (year, title)
-                ctrl_title = '%s.%s.pdf' % (document_type, self.check_title(_year_title))
-
-            self.show_print(message, [self.LOG_FILE], font = self.YELLOW)
-
-            if status == self.STATUS_OK:
-                self.show_print("[%s/%s] Paper already downloaded" % (idx, record_count), [self.LOG_FILE], font = self.GREEN)
-                self.show_print("", [self.LOG_FILE])
+    def copy_pdf(self, source_pdf, out_pdf):
+        if self.archive is not None:
+            self.archive.copy(self.get_member(out_pdf), *self.archive.get_location(self.get_member(source_pdf)))
+        else:
+            self.create_directory(os.path.dirname(out_pdf))
+            self.link_file(source_pdf, out_pdf)
+
+    def get_year_folder(self, year):
+        try:
+            return str(int(float(str(year).strip())))
+        except ValueError:
+            return self.STATUS_NO_YEAR
+
+    def is_downloaded(self, paper):
+        if self.manifest is not None:
+            return paper.doi_key is not None and paper.doi_key in self.manifest_index
+        return self.TYPE_INPUT != self.TYPE_TXT and paper.pdf_name in self.file_index.get(paper.folder, ())
+
+    def get_file_hash(self, file):
+        digest = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def add_manifest(self, paper, out_pdf, digest = None):
+        # One transaction per pdf: the manifest never points to a file that isn't complete
+        if self.manifest is None:
+            return
+        path = os.path.relpath(out_pdf, self.OUTPUT_PATH)
+        name = os.path.join(paper.folder, paper.pdf_name)
+        if self.manifest_files.get(paper.doi_key) == path:
+            # Another paper with the same DOI, same file
+            self.manifest.add_name(name, paper.doi_key)
+        else:
+            self.manifest.add(paper.doi_key, path, os.path.getsize(out_pdf), digest or self.get_file_hash(out_pdf), name)
+            with self.lock_control:
+                self.manifest_files.update({paper.doi_key: path})
+        if self.NAME_LINKS:
+            self.link_name(out_pdf, os.path.join(self.OUTPUT_PATH, name))
+
+    def link_name(self, out_pdf, name_pdf):
+        # Relative symbolic link, the output folder can be moved
+        self.create_directory(os.path.dirname(name_pdf))
+        temporal = '%s%s' % (name_pdf, self.PARTIAL_EXTENSION)
+        self.remove_file(temporal)
+        try:
+            os.symlink(os.path.relpath(out_pdf, os.path.dirname(name_pdf)), temporal)
+            os.replace(temporal, name_pdf)
+        except OSError:
+            # Without symbolic links (Windows) the name stays in the manifest
+            pass
+
+    def prune_manifest_files(self):
+        # The names and the files of the manifest that aren't in the input file, no folder is listed
+        for name in self.manifest.get_names():
+            if self.state_store.has_run_name(name):
                 continue
-            elif status == self.STATUS_NONEXISTENT:
-                self.show_print("[%s/%s] Paper without DOI" % (idx, record_count), [self.LOG_FILE], font = self.GREEN)
-                self.show_print("", [self.LOG_FILE])
-                summary_non_existents.update({idx: title})
+            if os.path.islink(os.path.join(self.OUTPUT_PATH, name)):
+                os.remove(os.path.join(self.OUTPUT_PATH, name))
+            self.manifest.remove_name(name)
+        removed = 0
+        for doi_key, path in self.manifest.get_files().items():
+            if not self.state_store.has_run_doi(doi_key):
+                self.remove_file(os.path.join(self.OUTPUT_PATH, path))
+                self.manifest.remove(doi_key)
+                self.manifest_files.pop(doi_key, None)
+                self.manifest_index.discard(doi_key)
+                removed += 1
+        return removed
+
+    def index_output_files(self):
+        # One pass over the output tree: {folder: {file names}}
+        index = {}
+        if not self.check_path(self.OUTPUT_PATH):
+            return index
+        with os.scandir(self.OUTPUT_PATH) as folders:
+            for folder in folders:
+                if folder.is_dir() and folder.name not in [self.FOLDER_PARTIAL, self.FOLDER_STORE]:
+                    with os.scandir(folder.path) as files:
+                        index.update({folder.name: {file.name for file in files if file.is_file()}})
+        return index
+
+    def prune_output_files(self):
+        # Only the folders of the papers of the input file are pruned
+        removed = 0
+        for folder, files in list(self.file_index.items()):
+            if not self.state_store.has_run_folder(folder):
                 continue
-            else:
-                # For Status: None and Not available
-                if doi:
-                    try:
-                        directory = os.path.join(self.OUTPUT_PATH, document_type)
-                        self.create_directory(directory)
-
-                        self.show_print("[%s/%s] Downloading paper..." % (idx, record_count), [self.LOG_FILE], font = self.GREEN)
-                        pdfname = '%s.%s' % (year, title)
-                        pdfname = self.check_title(pdfname)
-
-                        # self.run_scidownl(doi = doi, out = directory, filename = pdfname)
-
-                        out_pdf = os.path.join(directory, '%s.pdf' % pdfname)
-                        scihub_download(keyword = doi, paper_type = "doi", out = out_pdf)
-
-                        if not os.path.exists(out_pdf):
-                            assert False, 'Failed to download the paper'
-
-                        if not self.check_integrity(out_pdf):
-                            self.remove_file(out_pdf)
-                            self.show_print("[%s/%s] The file is corrupted, it was deleted." % (idx, record_count), [self.LOG_FILE], font = self.YELLOW)
-                            assert False, 'Failed to download the paper'
-
-                        self.show_print("", [self.LOG_FILE])
-                        dict_ctrl.update({ctrl_title: self.STATUS_OK})
-                        self.write_file_control(ctrl_title, self.STATUS_OK)
-                    except Exception:
-                        self.show_print("[%s/%s] Download link not available, please try after sometime" % (idx, record_count), [self.LOG_FILE], font = self.YELLOW)
-                        self.show_print("[%s/%s] Also try prepending 'http://dx.doi.org/' to input" % (idx, record_count), [self.LOG_FILE], font = self.YELLOW)
-                        self.show_print("", [self.LOG_FILE])
-                        summary_not_availables.update({idx: doi})
-                        if status is None:
-                            dict_ctrl.update({ctrl_title: self.STATUS_NOT_AVAILABLE})
-                            self.write_file_control(ctrl_title, self.STATUS_NOT_AVAILABLE)
+            expected = set()
+            for file in files:
+                if self.state_store.has_run_name(os.path.join(folder, file)):
+                    expected.add(file)
                 else:
-                    self.show_print("[%s/%s] Paper without DOI" % (idx, record_count), [self.LOG_FILE], font = self.YELLOW)
-                    self.show_print("", [self.LOG_FILE])
-                    summary_non_existents.update({idx: title})
-                    dict_ctrl.update({ctrl_title: self.STATUS_NONEXISTENT})
-                    self.write_file_control(ctrl_title, self.STATUS_NONEXISTENT)
+                    self.remove_file(os.path.join(self.OUTPUT_PATH, folder, file))
+                    removed += 1
+            self.file_index.update({folder: expected})
+        return removed
+
+    def update_status(self, papers, dict_ctrl):
+        # Generator: the papers are registered in the state store and the summary, and get their status as they are read
+        for paper in papers:
+            if self.is_downloaded(paper):
+                dict_ctrl.update({paper.ctrl_key: self.STATUS_OK})
+            paper.status = dict_ctrl.get(paper.ctrl_key)
+            self.state_store.add_run_paper(paper.index, paper.doi_key, paper.ctrl_key, paper.folder, paper.pdf_name, paper.year)
+            # The abstract goes to the sidecar, the paper doesn't keep it
+            self.add_summary_row(paper, paper.abstract)
+            paper.abstract = None
+            self.summary_read = paper.index
+            yield paper
+        self.summary_input_read = True
+
+    def iter_run_papers(self):
+        # The papers read by this run, with what their files need (no title, authors...)
+        for paper_index, doi_key, ctrl_key, folder, pdf_name, year in self.state_store.iter_run_papers():
+            yield self.make_run_paper(paper_index, doi_key, ctrl_key, folder, pdf_name, year)
+
+    def make_run_paper(self, paper_index, doi_key, ctrl_key, folder, pdf_name, year):
+        paper = Paper(paper_index)
+        paper.doi_key = doi_key
+        paper.ctrl_key = ctrl_key
+        paper.folder = folder
+        paper.pdf_name = pdf_name
+        paper.year = year
+        return paper
+
+    def start_progress(self):
+        if self.PROGRESS > 0 and self.progress_thread is None:
+            self.progress_stop = threading.Event()
+            self.progress_thread = threading.Thread(target = self.run_progress, daemon = True)
+            self.progress_thread.start()
+
+    def run_progress(self):
+        while not self.progress_stop.wait(self.PROGRESS):
+            report = self.metrics.write(self.METRICS_JSON_FILE, self.METRICS_PROM_FILE)
+            statuses = ', '.join(['%s: %s' % (status, count) for status, count in sorted(report['statuses'].items(), key = lambda item: str(item[0]))])
+            self.show_print("Progress: %s papers/DOIs (%s), %.2f papers/s, %.1f MB" % (report['papers'], statuses or '-', report['papers_per_second'], report['bytes'] / 1024 / 1024),
+                            [self.LOG_FILE], console = not self.QUIET)
+
+    def close_metrics(self):
+        # Also called when the run is interrupted, the files keep the partial metrics
+        if self.progress_thread is not None:
+            self.progress_stop.set()
+            self.progress_thread.join()
+            self.progress_thread = None
+        if self.metrics is not None and self.OUTPUT_PATH is not None:
+            self.metrics.write(self.METRICS_JSON_FILE, self.METRICS_PROM_FILE, final = True)
+            self.metrics = None
+
+    def parse_order(self, spec):
+        # 'Cited By:desc,Year:desc', 'Document Type:Article|Review' (those values first, in that order)
+        order = []
+        for part in spec.split(','):
+            column, _, direction = part.partition(':')
+            attribute = self.order_attributes.get(column.strip().lower())
+            if attribute is None:
+                return None
+            direction = direction.strip()
+            if direction.lower() in ['', 'asc']:
+                order.append((attribute, False, None))
+            elif direction.lower() == 'desc':
+                order.append((attribute, True, None))
+            else:
+                order.append((attribute, False, [value.strip().lower() for value in direction.split('|')]))
+        return order
+
+    def parse_size(self, size):
+        # '500M', '2G', '1.5GB' -> bytes
+        match = self.re_size.match(size)
+        if match is None:
+            return None
+        return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' '))
+
+    def get_order_value(self, value, preferred):
+        # (0, number) before (1, text), so numbers in text columns (.csv) compare as numbers
+        if preferred is not None:
+            value = str(value).strip().lower()
+            return preferred.index(value) if value in preferred else len(preferred)
+        try:
+            return (0, float(str(value).strip()))
+        except ValueError:
+            return (1, str(value).strip().lower())
+
+    def sort_papers(self, papers):
+        # One stable sort per key, from the last one; papers without a value go last whatever the direction
+        for attribute, descending, preferred in reversed(self.ORDER):
+            present = [paper for paper in papers if getattr(paper, attribute) not in [None, '']]
+            missing = [paper for paper in papers if getattr(paper, attribute) in [None, '']]
+            present.sort(key = lambda paper: self.get_order_value(getattr(paper, attribute), preferred), reverse = descending)
+            papers = present + missing
+        return papers
+
+    def get_budget_reason(self):
+        # Checked before each paper, the papers in progress finish
+        if self.budget_reason is None:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.budget_reason = 'time limit of %s s' % self.MAX_TIME
+            elif self.MAX_BYTES > 0 and self.bytes_downloaded >= self.MAX_BYTES:
+                self.budget_reason = 'byte limit of %s bytes' % self.MAX_BYTES
+        return self.budget_reason
+
+    def add_downloaded_bytes(self, size):
+        with self.lock_control:
+            self.bytes_downloaded += size
+
+    def get_downloader(self):
+        if self.downloader is None:
+            self.downloader = self.BACKENDS[self.BACKEND](self)
+        return self.downloader
+
+    def close_downloader(self):
+        if self.downloader is not None:
+            self.downloader.close()
+            self.downloader = None
+
+    def start_mirror_pool(self):
+        if self.mirror_pool is not None:
+            # One pool per run, the next input files of a batch keep the latencies and circuit breakers
+            return
+        self.mirror_pool = MirrorPool(self.SCIHUB_MIRRORS, failures = self.MIRROR_FAILURES, cooldown = self.MIRROR_COOLDOWN)
+
+    def choose_mirror(self):
+        # The mirrors are probed by the first paper that needs one: a run whose papers are all downloaded
+        # or cached doesn't wait for them
+        if not self.mirrors_probed:
+            with self.lock_probe:
+                if not self.mirrors_probed:
+                    self.show_print("Checking the Sci-Hub mirrors...", [self.LOG_FILE], font = self.GREEN, console = not self.QUIET)
+                    self.mirror_pool.probe(timeout = self.PROBE_TIMEOUT)
+                    for line in self.mirror_pool.get_stats():
+                        self.show_print("  %s" % line, [self.LOG_FILE], console = not self.QUIET)
+                    self.mirrors_probed = True
+        return self.mirror_pool.choose()
+
+    def download_pdf(self, papers, dict_ctrl):
+        self.get_downloader()
+        self.start_mirror_pool()
+        self.start_verify_pool()
+        self.retry_queue = RetryQueue(base_delay = self.RETRY_BASE_DELAY, max_delay = self.RETRY_MAX_DELAY)
+        record_count = self.input_count
+        self.open_summary_sidecar(dict_ctrl)
+        self.start_progress()
+
+        papers = self.update_status(papers, dict_ctrl)
+        if self.ORDER is not None:
+            # The order needs the whole input, the sheet order is kept in the summary
+            papers = self.sort_papers(list(papers))
+            record_count = self.summary_read
+        if self.work_queue is not None:
+            # Every worker reads the whole input, the DOIs it downloads are claimed from the shared queue
+            papers = self.iter_claimed_papers(list(papers))
+            record_count = self.summary_read
+        elif self.input_count is not None or self.ORDER is not None:
+            # The whole input is known, the papers already downloaded are preferred as sources of the repeated DOIs
+            papers = list(papers)
+        self.duplicate_count = 0
+        self.run_records(self.collapse_duplicates(papers), record_count, dict_ctrl)
+        record_count = self.summary_read
+        if self.duplicate_count > 0:
+            self.show_print("Repeated DOIs, downloaded only once: %s" % self.duplicate_count, [self.LOG_FILE])
+            self.show_print("", [self.LOG_FILE])
+        if len(self.retry_queue) > 0:
+            self.checkpoint_summary()
+
+        # Deferred retries of the temporary failures, the latest result of a paper wins
+        retried = 0
+        while len(self.retry_queue) > 0 and self.get_budget_reason() is None:
+            papers = self.retry_queue.pop_ready(deadline = self.deadline)
+            if not papers:
+                # The time limit came before the next retry
+                continue
+            # A paper is counted on its first retry
+            retried += len([paper for paper in papers if paper.attempts == 1])
+            self.show_print("Retrying %s papers/DOIs that failed with a temporary error..." % len(papers), [self.LOG_FILE], font = self.GREEN)
+            self.show_print("", [self.LOG_FILE])
+            self.run_records(papers, record_count, dict_ctrl)
+
+        self.link_duplicates(record_count, dict_ctrl)
+        self.add_batch_files(dict_ctrl)
+
+        if self.budget_reason is not None:
+            self.show_print("The %s was reached, papers/DOIs not attempted: %s, retries dropped: %s" % (self.budget_reason, len(self.budget_skipped), len(self.retry_queue)),
+                            [self.LOG_FILE], font = self.YELLOW)
+            self.show_print("", [self.LOG_FILE])
+
+        if self.PRUNE and self.manifest is not None:
+            removed = self.prune_manifest_files()
+            self.show_print("Files not in the input file deleted: %s" % removed, [self.LOG_FILE])
+            self.show_print("", [self.LOG_FILE])
+        elif self.PRUNE and self.TYPE_INPUT != self.TYPE_TXT:
+            removed = self.prune_output_files()
+            self.show_print("Files not in the input file deleted: %s" % removed, [self.LOG_FILE])
+            self.show_print("", [self.LOG_FILE])
+
+        self.wait_text_index()
+        if self.work_queue is not None:
+            self.merge_work_queue(dict_ctrl)
+
+        # The last result of each paper this worker analyzed (not the ones of the other workers of a queue)
+        report = self.metrics.get_report()
+        not_available = report['statuses'].get(self.STATUS_NOT_AVAILABLE, 0)
+        non_existent = report['statuses'].get(self.STATUS_NONEXISTENT, 0)
 
         self.show_print("[SUMMARY]", [self.LOG_FILE], font = self.GREEN)
-        self.show_print("  Papers/DOIs analyzed: %s" % record_count, [self.LOG_FILE], font = self.GREEN)
-        self.show_print("    Papers/DOIs downloaded: %s (see %s)" % (record_count - len(summary_not_availables) - len(summary_non_existents), self.OUTPUT_PATH), [self.LOG_FILE], font = self.GREEN)
-        self.save_summary_xls(dict_information, dict_ctrl)
-        self.save_summary_text(dict_ctrl)
-        self.show_print("  For more details see the file: %s" % self.XLS_FILE, [self.LOG_FILE], font = self.GREEN)
-
-    def run_scidownl(self, doi, out, filename):
-        # scidownl download --doi 10.1145/3375633 --out article.pdf
-        # scidownl download --doi 10.1007/s11356-021-17048-7 --out article.pdf
-        # scidownl download --doi 10.1002/jctb.6956 --out article.pdf
-        # scidownl download --doi 10.1016/j.wasman.2022.05.023 --out article.pdf
-
-        command = ["scidownl download",
-                   "--doi \"%s\"" % doi,
-                   "--out \"%s\"" % os.path.join(out, filename)]
-
-        # Command execution
-        _command = " ".join(command)
-        try:
-            p = subprocess.Popen(_command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        except Exception as e:
-            self.show_print("Error %s while executing command %s" % (e, _command), [self.LOG_FILE], font = self.YELLOW)
-
-        successful = False
-        success_words = ["Successfully", "download"]
-        for line in iter(p.stdout.readline, b''):
-            _line = line.decode('utf-8').rstrip()
-            # _line = line.decode('cp1252').rstrip()
-            if successful is False and self.search_word_array(success_words, _line):
-                successful = True
-            self.show_print(_line, [self.LOG_FILE])
-
-        assert successful, 'ERROR'
-
-    def search_word_array(self, words = [], string = None):
-        for item in words:
-            if item not in string:
+        self.show_print("  Papers/DOIs analyzed: %s" % report['papers'], [self.LOG_FILE], font = self.GREEN)
+        self.show_print("    Papers/DOIs downloaded: %s (see %s)" % (report['papers'] - not_available - non_existent, self.OUTPUT_PATH), [self.LOG_FILE], font = self.GREEN)
+        self.show_print("    Papers/DOIs retried: %s" % retried, [self.LOG_FILE], font = self.GREEN)
+        if self.budget_reason is not None:
+            self.show_print("  Papers/DOIs not attempted (%s): %s" % (self.budget_reason, len(self.budget_skipped)), [self.LOG_FILE], font = self.GREEN)
+        if self.work_queue is not None:
+            self.show_print("  Work queue: %s" % self.work_queue.get_stats(), [self.LOG_FILE], font = self.GREEN)
+        if self.doi_cache is not None:
+            self.show_print("  DOI cache: %s" % self.doi_cache.get_stats(), [self.LOG_FILE], font = self.GREEN)
+        if self.text_index is not None:
+            self.show_print("  Full-text index: %s" % self.get_text_stats(), [self.LOG_FILE], font = self.GREEN)
+        if self.manifest is not None:
+            self.show_print("  Manifest: %s files (%s)" % (len(self.manifest_files), self.MANIFEST_FILE), [self.LOG_FILE], font = self.GREEN)
+        if self.archive is not None:
+            self.show_print("  Archive: %s files (%s)" % (len(self.archive.get_names()), self.archive.PATH), [self.LOG_FILE], font = self.GREEN)
+        self.show_print("  Sci-Hub mirrors:", [self.LOG_FILE], font = self.GREEN)
+        for line in self.mirror_pool.get_stats():
+            self.show_print("    %s" % line, [self.LOG_FILE], font = self.GREEN)
+        self.show_print("  Hosts:", [self.LOG_FILE], font = self.GREEN)
+        for _, limiter in sorted(self.host_limiters.items()):
+            self.show_print("    %s" % limiter.get_stats(), [self.LOG_FILE], font = self.GREEN)
+        self.close_summary()
+        self.show_print("  Stages: %s" % self.metrics.get_stages(), [self.LOG_FILE], font = self.GREEN)
+        self.show_print("  Metrics: %s, %s" % (self.METRICS_JSON_FILE, self.METRICS_PROM_FILE), [self.LOG_FILE], font = self.GREEN)
+        self.close_metrics()
+        if self.SUMMARY_XLS:
+            self.show_print("  For more details see the file: %s" % self.XLS_FILE, [self.LOG_FILE], font = self.GREEN)
+        else:
+            self.show_print("  Other workers are still running, the last one writes the file: %s" % self.XLS_FILE, [self.LOG_FILE], font = self.GREEN)
+
+    def iter_claimed_papers(self, papers):
+        # Generator: the papers of the DOIs this worker claims, a few at a time
+        claimable = {}
+        for paper in papers:
+            if paper.doi_key is not None and paper.status not in [self.STATUS_OK, self.STATUS_NONEXISTENT]:
+                claimable.setdefault(paper.doi_key, []).append(paper)
+        # The DOIs are claimed in the order of the papers (--order)
+        self.work_queue.add([(doi_key, position) for position, doi_key in enumerate(claimable)])
+
+        while self.get_budget_reason() is None:
+            # Out of budget the DOIs are left to the other workers
+            doi_keys = self.work_queue.claim(self.WORKERS * 2)
+            if not doi_keys:
+                if self.work_queue.is_drained():
+                    break
+                time.sleep(self.QUEUE_POLL)
+                continue
+            for doi_key in doi_keys:
+                if doi_key not in claimable:
+                    # Already downloaded when this worker read the output folder
+                    self.work_queue.complete(doi_key, self.STATUS_OK)
+                yield from claimable.get(doi_key, [])
+
+    def merge_work_queue(self, dict_ctrl):
+        # The state store has the results of every worker, the pdfs on disk decide what is downloaded
+        with self.state_store.lock:
+            self.state_store.commit()
+        self.work_queue.finish()
+        if not self.work_queue.try_merge():
+            return
+
+        self.show_print("Every DOI of the queue is done, merging the results of the workers...", [self.LOG_FILE], font = self.GREEN)
+        self.show_print("", [self.LOG_FILE])
+        merged_ctrl = self.get_downloaded_files()
+        # The attempts of the papers the other workers downloaded are in the shared store, not in this worker's records
+        self.summary_attempts = self.state_store.get_attempts()
+        for paper in self.iter_run_papers():
+            if self.is_downloaded(paper):
+                merged_ctrl.update({paper.ctrl_key: self.STATUS_OK})
+            elif paper.doi_key is None:
+                merged_ctrl.update({paper.ctrl_key: self.STATUS_NONEXISTENT})
+        with self.lock_control:
+            dict_ctrl.clear()
+            dict_ctrl.update(merged_ctrl)
+        self.SUMMARY_XLS = True
+
+    def collapse_duplicates(self, papers):
+        # Generator: the first paper of each DOI is downloaded, the others are kept in the state store and get a link to its file
+        if isinstance(papers, list):
+            for paper in papers:
+                if paper.doi_key is not None and paper.status == self.STATUS_OK:
+                    self.state_store.add_source(paper.doi_key, paper.index)
+
+        for paper in papers:
+            if paper.doi_key is None or paper.status in [self.STATUS_OK, self.STATUS_NONEXISTENT]:
+                if paper.doi_key is not None and paper.status == self.STATUS_OK:
+                    self.state_store.add_source(paper.doi_key, paper.index)
+                yield paper
+            elif self.state_store.add_source(paper.doi_key, paper.index):
+                yield paper
+            else:
+                self.state_store.add_duplicate(paper.index, self.dump_paper(paper))
+                self.duplicate_count += 1
+
+    def dump_paper(self, paper):
+        return json.dumps({name: getattr(paper, name) for name in Paper.__slots__ if name not in ['abstract', 'metrics_record']}, default = str)
+
+    def load_paper(self, text):
+        fields = json.loads(text)
+        paper = Paper(fields.pop('index'))
+        for name, value in fields.items():
+            setattr(paper, name, value)
+        return paper
+
+    def link_duplicates(self, record_count, dict_ctrl):
+        for paper in self.state_store.iter_duplicates():
+            paper = self.load_paper(paper)
+            source = self.make_run_paper(*self.state_store.get_run_paper(self.state_store.get_source(paper.doi_key)))
+            if source.index in self.budget_skipped:
+                self.budget_skipped.add(paper.index)
+                continue
+            log = RecordLog(self, paper, record_count)
+            if self.TYPE_INPUT == self.TYPE_TXT:
+                log.show_print("Analyzing the DOI: %s" % paper.doi, font = self.YELLOW)
+            else:
+                log.show_print("Analyzing the Paper: %s" % paper.title, font = self.YELLOW)
+
+            source_pdf = self.get_out_pdf(source)
+            out_pdf = self.get_out_pdf(paper)
+            if dict_ctrl.get(source.ctrl_key) == self.STATUS_OK and self.has_pdf(source_pdf):
+                if out_pdf != source_pdf:
+                    self.copy_pdf(source_pdf, out_pdf)
+                self.add_manifest(paper, out_pdf)
+                log.show_print("Same DOI as the paper %s, the file was reused" % source.index, font = self.GREEN)
+                self.update_control(dict_ctrl, paper.ctrl_key, self.STATUS_OK)
+                self.write_file_control(paper.ctrl_key, self.STATUS_OK, doi = paper.doi, size = self.get_pdf_size(out_pdf), path = out_pdf)
+                result = self.STATUS_OK
+            else:
+                log.show_print("Same DOI as the paper %s, which is not available" % source.index, font = self.YELLOW)
+                if paper.status is None:
+                    self.update_control(dict_ctrl, paper.ctrl_key, self.STATUS_NOT_AVAILABLE)
+                self.write_file_control(paper.ctrl_key, self.STATUS_NOT_AVAILABLE, doi = paper.doi)
+                result = self.STATUS_NOT_AVAILABLE
+            log.show_print("")
+            self.metrics.add_paper(paper, result)
+            self.add_summary_row(paper)
+
+    def add_batch_files(self, dict_ctrl):
+        # The next input files of a batch link these pdfs instead of downloading them again
+        for paper in self.iter_run_papers():
+            if paper.doi_key is not None and dict_ctrl.get(paper.ctrl_key) == self.STATUS_OK and paper.doi_key not in self.batch_files:
+                if self.archive is None:
+                    self.batch_files.update({paper.doi_key: self.get_out_pdf(paper)})
+                elif self.has_pdf(self.get_out_pdf(paper)):
+                    # (archive, offset, bytes): the member is copied from the archive of the earlier input file
+                    self.batch_files.update({paper.doi_key: self.archive.get_location(self.get_member(self.get_out_pdf(paper)))})
+
+    def reuse_batch_file(self, paper, out_pdf):
+        source_pdf = self.batch_files.get(paper.doi_key)
+        if self.archive is not None:
+            if source_pdf is None or source_pdf[0] == self.archive.PATH:
                 return False
+            self.archive.copy(self.get_member(out_pdf), *source_pdf)
+        else:
+            if source_pdf is None or source_pdf == out_pdf or not self.check_path(source_pdf):
+                return False
+            self.create_directory(os.path.dirname(out_pdf))
+            self.link_file(source_pdf, out_pdf)
+        with self.lock_control:
+            self.batch_reused += 1
         return True
 
-    def get_command(self, cmd):
-        p = subprocess.Popen(cmd, shell = True, stdin = None, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-        (checkStdout, checkStderr) = p.communicate()
-        checkStdout = checkStdout.decode('utf-8').strip()
-        checkStderr = checkStderr.decode('utf-8').strip()
-
-        output_list = []
-        if checkStdout:
-            for line in checkStdout.splitlines():
-                for word in line.strip().split():
-                    output_list.append(word.strip())
-        else:
-            output_list.append('ERROR')
+    def link_file(self, source, target):
+        # Hard link, or symbolic link, or copy, whatever the file system allows
+        temporal = '%s%s' % (target, self.PARTIAL_EXTENSION)
+        self.remove_file(temporal)
+        try:
+            os.link(source, temporal)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(source), temporal)
+            except OSError:
+                shutil.copy2(source, temporal)
+        os.replace(temporal, target)
 
-        return ' '.join(output_list)
+    def store_content(self, part_pdf, out_pdf):
+        digest = self.get_file_hash(part_pdf)
 
-    def check_integrity(self, file):
-        with open(file, 'rb') as f:
+        stored_pdf = os.path.join(self.OUTPUT_PATH, self.FOLDER_STORE, digest[:2], '%s.pdf' % digest)
+        if self.check_path(stored_pdf):
+            self.remove_file(part_pdf)
+        else:
+            self.create_directory(os.path.dirname(stored_pdf))
+            os.replace(part_pdf, stored_pdf)
+        self.link_file(stored_pdf, out_pdf)
+        return digest
+
+    def fetch_cached(self, paper, part_pdf, pdf_url, mirror):
+        # (True, content type) when the cached link gave the pdf; (False, None) when it failed, its entry was dropped.
+        # The request goes to the host of the pdf: it waits for its limiter, but its latency isn't a Sci-Hub latency
+        paper.mirror = mirror
+        limiter = self.get_host_limiter(pdf_url)
+        limiter.acquire()
+        try:
+            content_type = self.downloader.download_cached(paper.doi_key, part_pdf, pdf_url, mirror)
+        except Exception:
+            return (False, None)
+        finally:
+            limiter.release()
+        return (True, content_type)
+
+    def download_from_mirror(self, paper, part_pdf):
+        mirror = self.choose_mirror()
+        if mirror is None:
+            raise TransientDownloadError('There is no Sci-Hub mirror available')
+
+        paper.mirror = mirror
+        limiter = self.get_host_limiter(mirror)
+        limiter.acquire()
+        _start = time.time()
+        try:
+            content_type = self.downloader.download(doi = paper.doi_key, out_pdf = part_pdf, scihub_url = mirror)
+        except PaperNotFoundError:
+            # The mirror answered, it just doesn't have the paper
+            self.mirror_pool.report_success(mirror, time.time() - _start)
+            limiter.release(latency = time.time() - _start)
+            raise
+        except Exception:
+            self.mirror_pool.report_failure(mirror)
+            limiter.release(error = True)
+            raise
+        if os.path.exists(part_pdf):
+            self.mirror_pool.report_success(mirror, time.time() - _start)
+        limiter.release(latency = time.time() - _start)
+        return content_type
+
+    def run_records(self, papers, record_count, dict_ctrl):
+        # The results go to the state store, the summary sidecar and the run metrics as the papers finish
+        if self.WORKERS > 1:
+            # Only a few papers per worker are queued, the input can be a generator of any size
+            executor = self.get_executor()
+            futures = set()
             try:
-                pdf = PdfReader(f)
-                info = pdf.metadata
-                if info:
-                    return True
-                else:
-                    return False
-            except Exception as e:
-                return False
+                for paper in papers:
+                    futures.add(executor.submit(self.download_record, paper, record_count, dict_ctrl))
+                    if len(futures) >= self.WORKERS * 2:
+                        done, futures = wait(futures, return_when = FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                # The papers in progress finish, the queued ones are dropped
+                self.close_executor(cancel = True)
+                raise
+        else:
+            for paper in papers:
+                self.download_record(paper, record_count, dict_ctrl)
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = self.WORKERS)
+        return self.executor
+
+    def close_executor(self, cancel = False):
+        if self.executor is not None:
+            self.executor.shutdown(wait = True, cancel_futures = cancel)
+            self.executor = None
+
+    def is_transient_error(self, error):
+        import requests
+
+        if isinstance(error, PaperNotFoundError):
+            return False
+        if isinstance(error, TransientDownloadError):
+            return True
+        return isinstance(error, (requests.exceptions.Timeout,
+                                  requests.exceptions.ConnectionError,
+                                  requests.exceptions.ChunkedEncodingError,
+                                  ConnectionError,
+                                  TimeoutError))
+
+    def download_record(self, paper, record_count, dict_ctrl):
+        if paper.status not in [self.STATUS_OK, self.STATUS_NONEXISTENT] and self.get_budget_reason() is not None:
+            with self.lock_control:
+                self.budget_skipped.add(paper.index)
+            return None
+        # With several workers the lines of a paper are written together when it finishes
+        log = RecordLog(self, paper, record_count, buffered = self.WORKERS > 1)
+        try:
+            result = self.process_record(paper, log, dict_ctrl)
+        finally:
+            log.flush()
+        if self.work_queue is not None and paper.doi_key is not None and paper not in self.retry_queue:
+            self.work_queue.complete(paper.doi_key, result)
+        self.metrics.add_paper(paper, result)
+        self.add_summary_row(paper)
+        if result == self.STATUS_OK and self.text_index is not None and paper.doi_key is not None:
+            out_pdf = os.path.join(self.OUTPUT_PATH, self.get_pdf_path(paper))
+            if self.check_path(out_pdf):
+                self.add_text(paper, out_pdf)
+        return result
+
+    def process_record(self, paper, log, dict_ctrl):
+        doi = paper.doi
+        status = paper.status
+        ctrl_title = paper.ctrl_key
 
-def main():
-    try:
-        start = oscihub.start_time()
-        menu()
+        if self.TYPE_INPUT == self.TYPE_TXT:
+            log.show_print("Analyzing the DOI: %s" % doi, font = self.YELLOW)
+        else:
+            log.show_print("Analyzing the Paper: %s" % paper.title, font = self.YELLOW)
+
+        if status == self.STATUS_OK:
+            log.show_print("Paper already downloaded", font = self.GREEN)
+            log.show_print("")
+            return self.STATUS_OK
+        elif status == self.STATUS_NONEXISTENT:
+            log.show_print("Paper without DOI", font = self.GREEN)
+            log.show_print("")
+            return self.STATUS_NONEXISTENT
+
+        # For Status: None and Not available
+        if not doi:
+            log.show_print("Paper without DOI", font = self.YELLOW)
+            log.show_print("")
+            self.update_control(dict_ctrl, ctrl_title, self.STATUS_NONEXISTENT)
+            self.write_file_control(ctrl_title, self.STATUS_NONEXISTENT, doi = doi)
+            return self.STATUS_NONEXISTENT
+
+        _start_record = time.time()
+        try:
+            out_pdf = self.get_out_pdf(paper)
+            if self.archive is None:
+                self.create_directory(os.path.dirname(out_pdf))
+
+            if self.reuse_batch_file(paper, out_pdf):
+                log.show_print("Same DOI as a paper of an earlier input file, the file was reused", font = self.GREEN)
+                log.show_print("")
+                self.add_manifest(paper, out_pdf)
+                self.update_control(dict_ctrl, ctrl_title, self.STATUS_OK)
+                self.write_file_control(ctrl_title, self.STATUS_OK, doi = doi, size = self.get_pdf_size(out_pdf), path = out_pdf)
+                return self.STATUS_OK
+
+            log.show_print("Downloading paper...", font = self.GREEN)
+
+            # The transfer goes to a .part file outside the document type folders, it is renamed when it is complete.
+            # It is named by DOI: a partial file of another paper (same title, same row of another DOI list) is never resumed
+            part_pdf = os.path.join(self.OUTPUT_PATH, self.FOLDER_PARTIAL, '%s%s' % (self.get_doi_hash(paper.doi_key), self.PARTIAL_EXTENSION))
+            self.create_directory(os.path.dirname(part_pdf))
+
+            paper.attempts += 1
+            # The DOI cache comes before the mirrors: a hit takes no mirror and no Sci-Hub request, and reports no latency
+            cached = self.downloader.get_cached(paper.doi_key)
+            fetched, content_type = self.fetch_cached(paper, part_pdf, *cached) if cached is not None else (False, None)
+            if not fetched:
+                content_type = self.download_from_mirror(paper, part_pdf)
+
+            if not os.path.exists(part_pdf):
+                raise PaperNotFoundError('Failed to download the paper')
+
+            valid, reason = self.metrics.time_call('verify', self.check_integrity, part_pdf, content_type)
+            if not valid:
+                self.remove_partial(part_pdf)
+                if self.doi_cache is not None:
+                    # The next attempt resolves the DOI again instead of fetching the same link
+                    self.doi_cache.remove(paper.doi_key)
+                log.show_print("The file is corrupted (%s), it was deleted." % reason, font = self.YELLOW)
+                raise TransientDownloadError('The file is corrupted: %s' % reason)
+
+            digest = self.save_pdf(part_pdf, out_pdf)
+            self.remove_partial(part_pdf)
+            self.add_manifest(paper, out_pdf, digest)
+
+            log.show_print("")
+            paper.size = self.get_pdf_size(out_pdf)
+            paper.duration = time.time() - _start_record
+            self.add_downloaded_bytes(paper.size)
+            self.update_control(dict_ctrl, ctrl_title, self.STATUS_OK)
+            self.write_file_control(ctrl_title, self.STATUS_OK, doi = doi, attempted = True,
+                                    size = paper.size,
+                                    duration = paper.duration,
+                                    path = out_pdf)
+            return self.STATUS_OK
+        except Exception as e:
+            paper.duration = time.time() - _start_record
+            if self.is_transient_error(e) and paper.attempts <= self.RETRIES:
+                delay = self.retry_queue.push(paper, paper.attempts)
+                self.metrics.add_retry()
+                log.show_print("Temporary error (%s), new attempt in %.0f s" % (str(e) or e.__class__.__name__, delay), font = self.YELLOW)
+            else:
+                log.show_print("Download link not available, please try after sometime", font = self.YELLOW)
+                log.show_print("Also try prepending 'http://dx.doi.org/' to input", font = self.YELLOW)
+            log.show_print("")
+            if status is None:
+                self.update_control(dict_ctrl, ctrl_title, self.STATUS_NOT_AVAILABLE)
+            self.write_file_control(ctrl_title, self.STATUS_NOT_AVAILABLE, doi = doi, attempted = True,
+                                    error = str(e) or e.__class__.__name__,
+                                    duration = paper.duration)
+            return self.STATUS_NOT_AVAILABLE
+
+    def check_integrity(self, file, content_type = None):
+        valid, reason = self.check_pdf_structure(file, content_type)
+        if valid and self.verify_pool is not None:
+            # The full parse is CPU bound, it runs in another process so it doesn't hold the download threads
+            valid, reason = self.verify_pool.submit(deep_check_pdf, file).result()
+        return valid, reason
+
+    def check_pdf_structure(self, file, content_type = None):
+        if content_type:
+            _content_type = content_type.split(';')[0].strip().lower()
+            if _content_type not in self.PDF_CONTENT_TYPES:
+                return False, 'unexpected content type: %s' % _content_type
 
-        oscihub.LOG_FILE = os.path.join(oscihub.OUTPUT_PATH, oscihub.LOG_NAME)
-        oscihub.XLS_FILE = os.path.join(oscihub.OUTPUT_PATH, oscihub.XLS_FILE)
-        oscihub.FOLDER_TEMP = os.path.join(oscihub.OUTPUT_PATH, oscihub.FOLDER_TEMP)
-        oscihub.SUMMARY_FILE_CONTROL = os.path.join(oscihub.OUTPUT_PATH, oscihub.SUMMARY_FILE_CONTROL)
-        oscihub.set_xls_type()
-        if oscihub.TYPE_INPUT is None:
-            oscihub.show_print("Incorrect format: the excel file don't have the correct number of columns: %s" % oscihub.XLS_FILE, [oscihub.LOG_FILE], font = oscihub.YELLOW)
-            # raise Exception("Incorrect format: the excel file don't have the correct number of columns")
-            exit()
+        try:
+            size = os.path.getsize(file)
+        except OSError as e:
+            return False, 'unreadable file: %s' % e
+        if size < self.PDF_MIN_SIZE:
+            return False, 'file too small: %s bytes' % size
 
-        oscihub.show_print("#############################################################################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
-        oscihub.show_print("############################## Download papers ##############################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
-        oscihub.show_print("#############################################################################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
+        with open(file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                if data.find(b'%PDF-', 0, self.PDF_HEADER_WINDOW) == -1:
+                    return False, 'missing %PDF- header'
+                trailer_start = max(0, size - self.PDF_TRAILER_WINDOW)
+                if data.rfind(b'%%EOF', trailer_start) == -1:
+                    return False, 'missing %%EOF trailer, the file is truncated'
+                if data.rfind(b'startxref', trailer_start) == -1:
+                    return False, 'missing startxref'
+        return True, None
+
+    def start_verify_pool(self):
+        if self.DEEP_CHECK and self.verify_pool is None:
+            self.verify_pool = ProcessPoolExecutor(max_workers = min(self.WORKERS, os.cpu_count() or 1))
+
+    def close_verify_pool(self):
+        if self.verify_pool is not None:
+            self.verify_pool.shutdown()
+            self.verify_pool = None
+
+    def open_text_index(self):
+        if self.FULL_TEXT:
+            shared = self.QUEUE_RUN is not None
+            self.text_index = TextIndex(self.TEXT_INDEX_FILE, batch_size = 1 if shared else 50, shared = shared)
+            self.text_sizes = self.text_index.get_sizes()
+            processes = os.cpu_count() or 1
+            self.text_pool = ProcessPoolExecutor(max_workers = processes)
+            self.text_queue = queue.Queue(maxsize = processes * 4)
+            self.text_thread = threading.Thread(target = self.run_text_index, daemon = True)
+            self.text_thread.start()
+
+    def add_text(self, paper, file):
+        # Producer: only the pdfs that are new or changed since they were indexed
+        if self.text_index is None or paper.doi_key is None:
+            return
+        size = os.path.getsize(file)
+        with self.lock_text:
+            if self.text_sizes.get(paper.doi_key) == size:
+                self.text_stats['skipped'] += 1
+                return
+            self.text_sizes.update({paper.doi_key: size})
+        future = self.text_pool.submit(extract_pdf_text, file)
+        self.text_queue.put((paper.doi_key, os.path.relpath(file, self.ROOT_OUTPUT_PATH), size, future))
+
+    def run_text_index(self):
+        # Consumer: writes the extractions in the order they were submitted
+        while True:
+            item = self.text_queue.get()
+            try:
+                if item is None:
+                    return
+                doi, file, size, future = item
+                try:
+                    document = future.result()
+                except CancelledError:
+                    continue
+                except Exception as e:
+                    document = {'error': str(e) or e.__class__.__name__}
+                self.text_index.save(doi, file, size, document)
+                with self.lock_text:
+                    self.text_stats['failed' if document.get('error') else 'indexed'] += 1
+                if document.get('seconds') is not None:
+                    self.metrics.add_time('extract', document['seconds'])
+            finally:
+                self.text_queue.task_done()
+
+    def wait_text_index(self):
+        # The extractions of an input file end before its summary
+        if self.text_index is not None:
+            self.text_queue.join()
+            self.text_index.commit()
+
+    def get_text_stats(self):
+        with self.lock_text:
+            stats = dict(self.text_stats)
+        return "indexed: %s, failed: %s, already indexed: %s (%s)" % (stats['indexed'], stats['failed'], stats['skipped'], self.TEXT_INDEX_FILE)
+
+    def close_text_index(self, cancel = False):
+        if self.text_index is not None:
+            if cancel:
+                # Cancelled extractions aren't saved, the next run submits them again
+                self.text_pool.shutdown(wait = False, cancel_futures = True)
+            self.text_queue.put(None)
+            self.text_thread.join()
+            self.text_pool.shutdown()
+            self.text_index.close()
+            self.text_index = None
+
+def extract_pdf_text(file):
+    # Runs in the processes of the text pool: the text of every page and the metadata of the document
+    from PyPDF2 import PdfReader
+
+    # The warnings of PyPDF2 about damaged pdfs go to the index (error), not to the screen
+    logging.getLogger('PyPDF2').setLevel(logging.ERROR)
+    _start = time.time()
+    document = {'pages': None, 'title': None, 'author': None, 'subject': None, 'keywords': None, 'created': None, 'text': '', 'error': None}
+    try:
+        with open(file, 'rb') as f:
+            pdf = PdfReader(f)
+            metadata = pdf.metadata or {}
+            for key, name in [('title', '/Title'), ('author', '/Author'), ('subject', '/Subject'), ('keywords', '/Keywords'), ('created', '/CreationDate')]:
+                if metadata.get(name):
+                    document.update({key: str(metadata.get(name)).strip()})
+            document.update({'pages': len(pdf.pages)})
+            texts = []
+            for page in pdf.pages:
+                try:
+                    texts.append(page.extract_text() or '')
+                except Exception:
+                    # A broken page doesn't lose the text of the others
+                    continue
+            document.update({'text': re.sub(r'\s+', ' ', ' '.join(texts)).strip()})
+    except Exception as e:
+        document.update({'error': 'the pdf could not be parsed: %s' % e})
+    document.update({'seconds': time.time() - _start})
+    return document
 
-        oscihub.show_print("Reading the .xls file: %s" % oscihub.XLS_FILE, [oscihub.LOG_FILE], font = oscihub.GREEN)
-        input_information = oscihub.read_xls_summary()
-        oscihub.show_print("  Records found: %s" % len(input_information), [oscihub.LOG_FILE])
-        oscihub.show_print("", [oscihub.LOG_FILE])
+def deep_check_pdf(file):
+    from PyPDF2 import PdfReader
 
-        if oscihub.TYPE_INPUT == oscihub.TYPE_TXT:
-            summary_ctrl = oscihub.get_downloaded_files()
+    try:
+        with open(file, 'rb') as f:
+            pdf = PdfReader(f)
+            if len(pdf.pages) == 0:
+                return False, 'the pdf has no pages'
+    except Exception as e:
+        return False, 'the pdf could not be parsed: %s' % e
+    return True, None
+
+class LogWriter:
+
+    def __init__(self, path, batch_size = 500):
+        self.BATCH_SIZE = batch_size
+        self.queue = queue.Queue()
+        self.file = open(path, 'a', encoding = 'utf-8')
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def write(self, lines):
+        self.queue.put(lines)
+
+    def run(self):
+        closing = False
+        while not closing:
+            lines = self.queue.get()
+            if lines is None:
+                break
+            batch = list(lines)
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    lines = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if lines is None:
+                    closing = True
+                    break
+                batch.extend(lines)
+            self.file.write(''.join(['%s\n' % line for line in batch]))
+            self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class RecordLog:
+
+    def __init__(self, oscihub, paper, record_count, buffered = False):
+        self.oscihub = oscihub
+        # Index and DOI on every line, the lines of the workers are mixed in the log
+        position = "%s/%s" % (paper.index, record_count) if record_count is not None else str(paper.index)
+        self.prefix = "[%s %s]" % (position, paper.doi) if paper.doi else "[%s]" % position
+        self.buffered = buffered
+        self.messages = []
+
+    def show_print(self, message, font = None):
+        if message:
+            message = "%s %s" % (self.prefix, message)
+        if self.buffered:
+            self.messages.append((message, font, time.strftime('%Y-%m-%d %H:%M:%S')))
         else:
-            pdf_by_folders = oscihub.get_expected_files(input_information)
-            summary_ctrl = oscihub.get_downloaded_files(pdf_by_folders)
+            self.oscihub.show_print(message, [self.oscihub.LOG_FILE], font = font, console = not self.oscihub.QUIET)
+
+    def flush(self):
+        if self.messages:
+            self.oscihub.show_print_batch(self.messages, [self.oscihub.LOG_FILE], console = not self.oscihub.QUIET)
+            self.messages = []
+
+class Paper:
+    __slots__ = ('index', 'item', 'doi', 'title', 'year', 'document_type', 'language', 'cited_by', 'authors', 'repository',
+                 'abstract', 'doi_key', 'folder', 'pdf_name', 'ctrl_key', 'status', 'attempts', 'mirror', 'size', 'duration', 'metrics_record')
+
+    def __init__(self, index, item = None, doi = None):
+        self.index = index
+        self.item = item
+        self.doi = doi
+        self.doi_key = None  # Normalized DOI, used to find repeated papers
+        self.title = None
+        self.abstract = None # Only until the paper is written to the summary sidecar
+        self.year = None
+        self.document_type = None
+        self.language = None
+        self.cited_by = None
+        self.authors = None
+        self.repository = None
+        self.folder = None   # Document type folder of the pdf
+        self.pdf_name = None # Year.Title.pdf
+        self.ctrl_key = None # Key of the paper in the state store
+        self.status = None
+        self.attempts = 0    # Download attempts in this run
+        self.mirror = None   # Mirror of the last attempt
+        self.size = None     # Bytes of the pdf
+        self.duration = None # Seconds of the last attempt
+        self.metrics_record = None # What the last attempt added to the run metrics
+
+class RunMetrics:
 
-        oscihub.update_status(input_information, summary_ctrl)
-        oscihub.download_pdf(input_information, summary_ctrl)
+    def __init__(self):
+        self.STAGES = ['read', 'index', 'resolve', 'transfer', 'verify', 'extract', 'summary']
+        self.PREFIX = 'download_papers'
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.stages = {stage: [0.0, 0] for stage in self.STAGES} # Seconds (summed over the workers), calls
+        self.retries = 0
+
+        # Running totals of the last result of each paper, a snapshot doesn't go over the papers
+        self.papers = 0
+        self.bytes = 0
+        self.statuses = {}
+        self.mirrors = {}
+        # Latencies in buckets 10% wide from 1 ms, the percentiles are the upper bounds of their buckets
+        self.LATENCY_BUCKETS = [0.001 * 1.1 ** i for i in range(200)]
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.latency_max = None
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stages[stage][0] += seconds
+            self.stages[stage][1] += 1
+
+    def time_call(self, stage, function, *args, **kwargs):
+        _start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.add_time(stage, time.time() - _start)
+
+    def time_iter(self, stage, items):
+        # Generator: the time spent producing each item counts, not the time the consumer keeps it
+        while True:
+            _start = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.time() - _start)
+            yield item
+
+    def add_paper(self, paper, status):
+        # A paper that is retried replaces the result of its previous attempt
+        record = (status, paper.duration, paper.size or 0, paper.mirror)
+        with self.lock:
+            if paper.metrics_record is not None:
+                self.count_record(paper.metrics_record, -1)
+            self.count_record(record, 1)
+            paper.metrics_record = record
+
+    def count_record(self, record, sign):
+        status, latency, size, mirror = record
+        self.papers += sign
+        self.bytes += sign * size
+        self.statuses.update({status: self.statuses.get(status, 0) + sign})
+        if self.statuses[status] == 0:
+            del self.statuses[status]
+        if mirror is not None:
+            values = self.mirrors.setdefault(mirror, {'papers': 0, 'bytes': 0})
+            values['papers'] += sign
+            values['bytes'] += sign * size
+        if latency is not None:
+            self.latency_counts[bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += sign
+            self.latency_sum += sign * latency
+            self.latency_count += sign
+            if sign > 0 and (self.latency_max is None or latency > self.latency_max):
+                self.latency_max = latency
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def get_percentile(self, fraction):
+        # Called with the lock held
+        if self.latency_count <= 0:
+            return None
+        rank = int(round(fraction * (self.latency_count - 1)))
+        seen = 0
+        for bucket, count in enumerate(self.latency_counts):
+            seen += count
+            if seen > rank:
+                break
+        if bucket == len(self.LATENCY_BUCKETS):
+            return self.latency_max
+        return min(self.LATENCY_BUCKETS[bucket], self.latency_max)
+
+    def get_report(self, final = False):
+        with self.lock:
+            stages = {stage: {'seconds': round(seconds, 6), 'calls': calls} for stage, (seconds, calls) in self.stages.items()}
+            latency = {'p50': self.get_percentile(0.5),
+                       'p90': self.get_percentile(0.9),
+                       'p99': self.get_percentile(0.99),
+                       'max': self.latency_max,
+                       'sum': self.latency_sum,
+                       'count': self.latency_count}
+            papers = self.papers
+            total_bytes = self.bytes
+            statuses = dict(self.statuses)
+            mirrors = {mirror: dict(values) for mirror, values in self.mirrors.items() if values['papers'] > 0}
+            retries = self.retries
+        elapsed = max(time.time() - self.started_at, 1e-6)
+
+        return {'final': final,
+                'started_at': self.started_at,
+                'updated_at': time.time(),
+                'elapsed_seconds': elapsed,
+                'papers': papers,
+                'statuses': statuses,
+                'bytes': total_bytes,
+                'retries': retries,
+                'papers_per_second': papers / elapsed,
+                'bytes_per_second': total_bytes / elapsed,
+                'latency_seconds': latency,
+                'stages': stages,
+                'mirrors': mirrors}
+
+    def get_label(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def get_prometheus(self, report):
+        # Text exposition format, for the textfile collector of node_exporter
+        lines = []
+        def add(name, kind, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (self.PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (self.PREFIX, name, kind))
+            for labels, value in samples:
+                labels = ','.join(['%s="%s"' % (label, self.get_label(label_value)) for label, label_value in labels])
+                lines.append('%s_%s%s %s' % (self.PREFIX, name, '{%s}' % labels if labels else '', repr(float(value))))
+
+        add('papers_total', 'counter', 'Papers finished, by status', [([('status', status)], count) for status, count in sorted(report['statuses'].items())])
+        add('bytes_total', 'counter', 'Bytes of the pdfs downloaded', [([], report['bytes'])])
+        add('retries_total', 'counter', 'Papers queued again after a temporary error', [([], report['retries'])])
+        add('papers_per_second', 'gauge', 'Papers finished per second since the start', [([], report['papers_per_second'])])
+        add('bytes_per_second', 'gauge', 'Bytes downloaded per second since the start', [([], report['bytes_per_second'])])
+        latency = report['latency_seconds']
+        samples = [([('quantile', quantile)], latency[key]) for quantile, key in [('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99')] if latency[key] is not None]
+        add('paper_seconds', 'summary', 'Time of the last attempt of each paper', samples)
+        lines.append('%s_paper_seconds_sum %s' % (self.PREFIX, repr(float(latency['sum']))))
+        lines.append('%s_paper_seconds_count %s' % (self.PREFIX, repr(float(latency['count']))))
+        add('stage_seconds_total', 'counter', 'Seconds spent in each stage, summed over the workers', [([('stage', stage)], values['seconds']) for stage, values in report['stages'].items()])
+        add('stage_calls_total', 'counter', 'Calls of each stage', [([('stage', stage)], values['calls']) for stage, values in report['stages'].items()])
+        add('mirror_papers_total', 'counter', 'Papers of the last attempt by mirror', [([('mirror', mirror)], values['papers']) for mirror, values in sorted(report['mirrors'].items())])
+        add('mirror_bytes_total', 'counter', 'Bytes downloaded by mirror', [([('mirror', mirror)], values['bytes']) for mirror, values in sorted(report['mirrors'].items())])
+        add('elapsed_seconds', 'gauge', 'Seconds since the start of the run', [([], report['elapsed_seconds'])])
+        add('last_update_timestamp_seconds', 'gauge', 'Time of this snapshot', [([], report['updated_at'])])
+        add('finished', 'gauge', '1 when the run is finished', [([], 1 if report['final'] else 0)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file, prometheus_file, final = False):
+        # Temporal files replaced at once, a reader never sees half a file
+        report = self.get_report(final)
+        for file, content in [(json_file, json.dumps(report, indent = 1)), (prometheus_file, self.get_prometheus(report))]:
+            temporal = '%s.tmp' % file
+            with open(temporal, 'w', encoding = 'utf-8') as f:
+                f.write(content)
+            os.replace(temporal, file)
+        return report
+
+    def get_stages(self):
+        with self.lock:
+            return ', '.join(['%s: %.1f s' % (stage, seconds) for stage, (seconds, _) in self.stages.items()])
+
+class StateStore:
+
+    def __init__(self, path, batch_size = 50, shared = False):
+        self.BATCH_SIZE = batch_size
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        # One connection shared by the download threads (guarded by the lock), WAL lets other processes read and write.
+        # Files shared with workers on other hosts (work queue) use the rollback journal, WAL needs a local file system
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode = %s' % ('DELETE' if shared else 'WAL'))
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS papers (ctrl_key TEXT PRIMARY KEY,
+                                                                      doi TEXT,
+                                                                      status TEXT,
+                                                                      attempts INTEGER NOT NULL DEFAULT 0,
+                                                                      last_error TEXT,
+                                                                      bytes INTEGER,
+                                                                      duration REAL,
+                                                                      file_path TEXT,
+                                                                      updated_at REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_papers_doi ON papers (doi)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_papers_status ON papers (status)')
+        self.connection.commit()
+
+        # The papers of the input file read by this run, in a private temporary database on disk: the end of the run
+        # (repeated DOIs, pruning, merge of a queue) goes over them without a Paper per row in memory
+        self.CHUNK_SIZE = 1000
+        self.run_connection = sqlite3.connect('', check_same_thread = False, isolation_level = None)
+        self.run_connection.execute('PRAGMA journal_mode = OFF')
+        self.run_connection.execute('PRAGMA synchronous = OFF')
+        self.run_connection.execute('''CREATE TABLE papers (paper_index INTEGER PRIMARY KEY,
+                                                            doi_key TEXT,
+                                                            ctrl_key TEXT,
+                                                            folder TEXT,
+                                                            pdf_name TEXT,
+                                                            name TEXT,
+                                                            year)''')
+        self.run_connection.execute('CREATE INDEX idx_papers_doi_key ON papers (doi_key)')
+        self.run_connection.execute('CREATE INDEX idx_papers_folder ON papers (folder)')
+        self.run_connection.execute('CREATE INDEX idx_papers_name ON papers (name)')
+        # First paper of each DOI, the one that is downloaded; the other papers of the DOI wait for it
+        self.run_connection.execute('CREATE TABLE sources (doi_key TEXT PRIMARY KEY, paper_index INTEGER)')
+        self.run_connection.execute('CREATE TABLE duplicates (paper_index INTEGER PRIMARY KEY, paper TEXT)')
+
+    def add_run_paper(self, paper_index, doi_key, ctrl_key, folder, pdf_name, year):
+        with self.lock:
+            self.run_connection.execute('INSERT OR REPLACE INTO papers (paper_index, doi_key, ctrl_key, folder, pdf_name, name, year) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (paper_index, doi_key, ctrl_key, folder, pdf_name, os.path.join(folder, pdf_name), year))
+
+    def get_run_paper(self, paper_index):
+        with self.lock:
+            return self.run_connection.execute('SELECT paper_index, doi_key, ctrl_key, folder, pdf_name, year FROM papers WHERE paper_index = ?',
+                                               (paper_index,)).fetchone()
+
+    def iter_run_papers(self):
+        # A chunk at a time, the other statements of the run can go between two of them
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.run_connection.execute('''SELECT paper_index, doi_key, ctrl_key, folder, pdf_name, year FROM papers
+                                                      WHERE paper_index > ? ORDER BY paper_index LIMIT ?''', (last, self.CHUNK_SIZE)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last = rows[-1][0]
+
+    def has_run_name(self, name):
+        with self.lock:
+            return self.run_connection.execute('SELECT 1 FROM papers WHERE name = ? LIMIT 1', (name,)).fetchone() is not None
+
+    def has_run_folder(self, folder):
+        with self.lock:
+            return self.run_connection.execute('SELECT 1 FROM papers WHERE folder = ? LIMIT 1', (folder,)).fetchone() is not None
+
+    def has_run_doi(self, doi_key):
+        with self.lock:
+            return self.run_connection.execute('SELECT 1 FROM papers WHERE doi_key = ? LIMIT 1', (doi_key,)).fetchone() is not None
+
+    def add_source(self, doi_key, paper_index):
+        # False when the DOI already has its source
+        with self.lock:
+            return self.run_connection.execute('INSERT OR IGNORE INTO sources (doi_key, paper_index) VALUES (?, ?)', (doi_key, paper_index)).rowcount == 1
+
+    def get_source(self, doi_key):
+        with self.lock:
+            row = self.run_connection.execute('SELECT paper_index FROM sources WHERE doi_key = ?', (doi_key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_duplicate(self, paper_index, paper):
+        with self.lock:
+            self.run_connection.execute('INSERT OR REPLACE INTO duplicates (paper_index, paper) VALUES (?, ?)', (paper_index, paper))
+
+    def iter_duplicates(self):
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.run_connection.execute('SELECT paper_index, paper FROM duplicates WHERE paper_index > ? ORDER BY paper_index LIMIT ?',
+                                                   (last, self.CHUNK_SIZE)).fetchall()
+            if not rows:
+                return
+            yield from [paper for _, paper in rows]
+            last = rows[-1][0]
+
+    def save(self, ctrl_key, doi = None, status = None, attempted = False, error = None, size = None, duration = None, path = None):
+        with self.lock:
+            self.connection.execute('''INSERT INTO papers (ctrl_key, doi, status, attempts, last_error, bytes, duration, file_path, updated_at)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT (ctrl_key) DO UPDATE SET doi = COALESCE(excluded.doi, doi),
+                                                                            status = excluded.status,
+                                                                            attempts = attempts + excluded.attempts,
+                                                                            last_error = excluded.last_error,
+                                                                            bytes = excluded.bytes,
+                                                                            duration = excluded.duration,
+                                                                            file_path = excluded.file_path,
+                                                                            updated_at = excluded.updated_at''',
+                                    (ctrl_key, doi, status, 1 if attempted else 0, error, size, duration, path, time.time()))
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE:
+                self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def get_statuses(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT ctrl_key, status FROM papers WHERE status IS NOT NULL'))
+
+    def get_attempts(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT ctrl_key, attempts FROM papers'))
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM papers LIMIT 1').fetchone() is None
+
+    def import_control_file(self, file):
+        imported = 0
+        with open(file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('Index'):
+                    line = line.split('\t')
+                    self.save(ctrl_key = line[0], doi = line[0], status = line[1])
+                    imported += 1
+        with self.lock:
+            self.commit()
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.connection.close()
+            self.run_connection.close()
+
+class DoiCache:
+
+    def __init__(self, path, ttl, negative_ttl, max_entries, batch_size = 50, shared = False):
+        self.TTL = ttl
+        self.NEGATIVE_TTL = negative_ttl
+        self.MAX_ENTRIES = max_entries
+        self.EVICT_TO = int(max_entries * 0.9) # Eviction during the run leaves room, so it doesn't run on every new DOI
+        self.BATCH_SIZE = batch_size
+        self.pending = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode = %s' % ('DELETE' if shared else 'WAL'))
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS dois (doi TEXT PRIMARY KEY,
+                                                                    pdf_url TEXT,
+                                                                    mirror TEXT,
+                                                                    created_at REAL NOT NULL,
+                                                                    accessed_at REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_dois_accessed_at ON dois (accessed_at)')
+        self.connection.commit()
+        self.entries = self.connection.execute('SELECT COUNT(*) FROM dois').fetchone()[0]
+
+    def get_key(self, doi):
+        return doi.strip().lower()
+
+    def get(self, doi):
+        # Returns (found, pdf_url, mirror) or None when the DOI is not cached or expired
+        now = time.time()
+        key = self.get_key(doi)
+        with self.lock:
+            row = self.connection.execute('SELECT pdf_url, mirror, created_at FROM dois WHERE doi = ?', (key,)).fetchone()
+            if row is not None:
+                pdf_url, mirror, created_at = row
+                ttl = self.TTL if pdf_url is not None else self.NEGATIVE_TTL
+                if now - created_at < ttl:
+                    self.connection.execute('UPDATE dois SET accessed_at = ? WHERE doi = ?', (now, key))
+                    self.add_pending()
+                    if pdf_url is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return (pdf_url is not None, pdf_url, mirror)
+            self.misses += 1
+        return None
+
+    def put(self, doi, pdf_url, mirror):
+        # pdf_url None caches a paper that is not in Sci-Hub
+        now = time.time()
+        key = self.get_key(doi)
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM dois WHERE doi = ?', (key,)).fetchone() is None:
+                self.entries += 1
+            self.connection.execute('INSERT OR REPLACE INTO dois (doi, pdf_url, mirror, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                                    (key, pdf_url, mirror, now, now))
+            self.add_pending()
+            if self.entries > self.MAX_ENTRIES:
+                self.evict(self.EVICT_TO)
+
+    def remove(self, doi):
+        with self.lock:
+            self.entries -= self.connection.execute('DELETE FROM dois WHERE doi = ?', (self.get_key(doi),)).rowcount
+            self.add_pending()
+
+    def add_pending(self):
+        self.pending += 1
+        if self.pending >= self.BATCH_SIZE:
+            self.connection.commit()
+            self.pending = 0
+
+    def evict(self, limit = None):
+        # The expired entries, and the least recently used ones beyond limit (the size limit at close, less when the
+        # cache grows past it during the run)
+        limit = self.MAX_ENTRIES if limit is None else limit
+        now = time.time()
+        self.connection.execute('DELETE FROM dois WHERE (pdf_url IS NOT NULL AND created_at < ?) OR (pdf_url IS NULL AND created_at < ?)',
+                                (now - self.TTL, now - self.NEGATIVE_TTL))
+        count = self.connection.execute('SELECT COUNT(*) FROM dois').fetchone()[0]
+        if count > limit:
+            self.connection.execute('DELETE FROM dois WHERE doi IN (SELECT doi FROM dois ORDER BY accessed_at LIMIT ?)', (count - limit,))
+            count = limit
+        self.entries = count
+
+    def get_stats(self):
+        with self.lock:
+            return "hits: %s (not in Sci-Hub: %s), misses: %s" % (self.hits + self.negative_hits, self.negative_hits, self.misses)
+
+    def close(self):
+        with self.lock:
+            self.evict()
+            self.connection.commit()
+            self.connection.close()
+
+def has_zipfile_internals():
+    # PaperArchive puts recovered members back in the directory of a ZipFile and drops the ones that failed,
+    # through attributes zipfile doesn't document: filelist, NameToInfo, start_dir and fp (tests/test_archive.py)
+    with zipfile.ZipFile(io.BytesIO(), 'a') as archive:
+        return isinstance(getattr(archive, 'filelist', None), list) and isinstance(getattr(archive, 'NameToInfo', None), dict) and \
+               isinstance(getattr(archive, 'start_dir', None), int) and hasattr(getattr(archive, 'fp', None), 'truncate')
+
+class PaperArchive:
+
+    def __init__(self, path, archive_format):
+        self.PATH = path
+        self.FORMAT = archive_format # zip or tar, the pdfs are stored without compression
+        self.CHUNK_SIZE = 1024 * 1024
+        self.lock = threading.Lock()
+        self.locations = {} # Member name -> (offset of the data, bytes)
+        self.recovered = 0  # Complete members found after a run that didn't close the archive
+
+        if self.FORMAT == 'zip':
+            self.open_zip()
+        else:
+            self.open_tar()
+
+    def open_zip(self):
+        entries = []
+        if os.path.exists(self.PATH) and not self.is_complete_zip():
+            entries = self.recover_zip()
+        self.archive = zipfile.ZipFile(self.PATH, 'a', compression = zipfile.ZIP_STORED, allowZip64 = True)
+        # Without central directory zipfile starts a new archive after the members found, they are added to its directory
+        for zinfo in entries:
+            self.archive.filelist.append(zinfo)
+            self.archive.NameToInfo.update({zinfo.filename: zinfo})
+        self.recovered = len(entries) # 0 for an archive that was closed
+
+    def is_complete_zip(self):
+        # A run that was killed overwrote the central directory with its first new member
+        try:
+            with zipfile.ZipFile(self.PATH) as archive:
+                archive.infolist()
+            return True
+        except (zipfile.BadZipFile, OSError):
+            return False
+
+    def recover_zip(self):
+        # The local headers, one after another; the first incomplete member and what follows it are cut
+        entries = []
+        with open(self.PATH, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + zipfile.sizeFileHeader <= size:
+                f.seek(offset)
+                header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+                signature, _, _, flag_bits, compress_type, dos_time, dos_date, crc, compress_size, file_size, name_length, extra_length = header
+                # zipfile writes the sizes in the local header when the member is complete
+                if signature != zipfile.stringFileHeader or compress_type != zipfile.ZIP_STORED or compress_size != file_size or compress_size in [0, 0xffffffff]:
+                    break
+                name = f.read(name_length)
+                end = offset + zipfile.sizeFileHeader + name_length + extra_length + compress_size
+                if end > size:
+                    break
+                zinfo = zipfile.ZipInfo(name.decode('utf-8' if flag_bits & 0x800 else 'cp437'),
+                                        ((dos_date >> 9) + 1980, (dos_date >> 5) & 0xf, dos_date & 0x1f, dos_time >> 11, (dos_time >> 5) & 0x3f, (dos_time & 0x1f) * 2))
+                zinfo.flag_bits = flag_bits
+                zinfo.compress_type = compress_type
+                zinfo.CRC = crc
+                zinfo.compress_size = compress_size
+                zinfo.file_size = file_size
+                zinfo.header_offset = offset
+                zinfo.external_attr = 0o644 << 16
+                entries.append(zinfo)
+                self.locations.update({zinfo.filename: (end - compress_size, compress_size)})
+                offset = end
+            f.truncate(offset)
+        return entries
+
+    def open_tar(self):
+        # The members are read without their data; a member cut by a killed run and the end of archive blocks are cut
+        end = 0
+        if os.path.exists(self.PATH):
+            size = os.path.getsize(self.PATH)
+            closed = False
+            try:
+                with tarfile.open(self.PATH, 'r:') as archive:
+                    for member in archive:
+                        if member.offset_data + member.size > size:
+                            break
+                        self.locations.update({member.name: (member.offset_data, member.size)})
+                        end = member.offset_data + self.get_tar_size(member.size)
+                    else:
+                        closed = self.has_tar_end(end)
+            except tarfile.TarError:
+                pass
+            if not closed:
+                self.recovered = len(self.locations)
+        self.file = open(self.PATH, 'r+b' if os.path.exists(self.PATH) else 'w+b')
+        self.file.seek(end)
+        self.file.truncate()
+        self.archive = tarfile.open(fileobj = self.file, mode = 'w', format = tarfile.PAX_FORMAT)
+
+    def has_tar_end(self, offset):
+        # The two zero blocks written on close; a killed run ends after its last flushed member, or in the middle of one
+        with open(self.PATH, 'rb') as f:
+            f.seek(offset)
+            return f.read(2 * tarfile.BLOCKSIZE) == tarfile.NUL * 2 * tarfile.BLOCKSIZE
+
+    def get_tar_size(self, size):
+        return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+    def get_names(self):
+        with self.lock:
+            if self.FORMAT == 'zip':
+                return self.archive.namelist()
+            return list(self.locations)
+
+    def get_index(self):
+        # {folder: {file names}}, like the index of the output folder
+        index = {}
+        for name in self.get_names():
+            folder, _, file_name = name.rpartition('/')
+            index.setdefault(folder, set()).add(file_name)
+        return index
+
+    def __contains__(self, name):
+        with self.lock:
+            if self.FORMAT == 'zip':
+                return name in self.archive.NameToInfo
+            return name in self.locations
+
+    def get_size(self, name):
+        with self.lock:
+            if self.FORMAT == 'zip':
+                return self.archive.getinfo(name).file_size
+            return self.locations[name][1]
+
+    def get_location(self, name):
+        # (archive, offset of the data, bytes), to copy the member without reading the archive again
+        with self.lock:
+            if self.FORMAT == 'tar':
+                return (self.PATH, ) + self.locations[name]
+            if name not in self.locations:
+                zinfo = self.archive.getinfo(name)
+                with open(self.PATH, 'rb') as f:
+                    f.seek(zinfo.header_offset)
+                    header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+                offset = zinfo.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+                self.locations.update({name: (offset, zinfo.file_size)})
+            return (self.PATH, ) + self.locations[name]
+
+    def add_file(self, name, file):
+        with open(file, 'rb') as f:
+            self.add(name, f, os.fstat(f.fileno()).st_size)
+
+    def copy(self, name, path, offset, size):
+        # A member of this archive or of another one (batch)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.add(name, f, size)
+
+    def add(self, name, source, size):
+        # The members are written one at a time, the archive is flushed after each one
+        with self.lock:
+            if (name in self.archive.NameToInfo) if self.FORMAT == 'zip' else (name in self.locations):
+                return
+            if self.FORMAT == 'zip':
+                zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+                zinfo.compress_type = zipfile.ZIP_STORED
+                zinfo.file_size = size
+                zinfo.external_attr = 0o644 << 16
+                start = self.archive.start_dir
+                try:
+                    with self.archive.open(zinfo, 'w') as target:
+                        remaining = size
+                        while remaining > 0:
+                            chunk = source.read(min(self.CHUNK_SIZE, remaining))
+                            if not chunk:
+                                raise OSError('unexpected end of file: %s' % name)
+                            target.write(chunk)
+                            remaining -= len(chunk)
+                except Exception:
+                    # zipfile keeps what was written as a member, it is dropped (disk full, short source)
+                    if self.archive.NameToInfo.get(name) is zinfo:
+                        self.archive.filelist.remove(zinfo)
+                        del self.archive.NameToInfo[name]
+                    self.archive.start_dir = start
+                    self.archive.fp.seek(start)
+                    self.archive.fp.truncate()
+                    raise
+                self.archive.fp.flush()
+            else:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = size
+                tarinfo.mtime = time.time()
+                tarinfo.mode = 0o644
+                start = self.archive.offset
+                try:
+                    self.archive.addfile(tarinfo, source)
+                except Exception:
+                    self.archive.offset = start
+                    self.file.seek(start)
+                    self.file.truncate()
+                    raise
+                self.locations.update({name: (self.archive.offset - self.get_tar_size(size), size)})
+                self.file.flush()
+
+    def close(self):
+        # The central directory (zip) or the end of archive blocks (tar)
+        with self.lock:
+            self.archive.close()
+            if self.FORMAT == 'tar':
+                self.file.close()
+
+class Manifest:
+
+    def __init__(self, path, shared = False):
+        self.lock = threading.Lock()
+
+        # Every change is its own transaction, a crash leaves the manifest of the last complete pdf
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode = %s' % ('DELETE' if shared else 'WAL'))
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS files (doi TEXT PRIMARY KEY,
+                                                                     file_path TEXT NOT NULL,
+                                                                     bytes INTEGER,
+                                                                     sha256 TEXT,
+                                                                     updated_at REAL)''')
+        # Names of the papers in the flat layout (Article/Year.Title.pdf), several names can have the same DOI
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY,
+                                                                     doi TEXT NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_names_doi ON names (doi)')
+        self.connection.commit()
+
+    def get_files(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT doi, file_path FROM files'))
+
+    def add(self, doi, path, size, digest, name):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO files (doi, file_path, bytes, sha256, updated_at) VALUES (?, ?, ?, ?, ?)',
+                                        (doi, path, size, digest, time.time()))
+                self.connection.execute('INSERT OR REPLACE INTO names (name, doi) VALUES (?, ?)', (name, doi))
+
+    def add_name(self, name, doi):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO names (name, doi) VALUES (?, ?)', (name, doi))
+
+    def get_names(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT name, doi FROM names'))
+
+    def remove_name(self, name):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM names WHERE name = ?', (name,))
+
+    def remove(self, doi):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM files WHERE doi = ?', (doi,))
+                self.connection.execute('DELETE FROM names WHERE doi = ?', (doi,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class TextIndex:
+
+    def __init__(self, path, batch_size = 50, shared = False):
+        self.BATCH_SIZE = batch_size
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        # Only the writer thread of the text pool and the final commit use the connection
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode = %s' % ('DELETE' if shared else 'WAL'))
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY,
+                                                                         doi TEXT NOT NULL UNIQUE,
+                                                                         file_path TEXT,
+                                                                         bytes INTEGER,
+                                                                         pages INTEGER,
+                                                                         title TEXT,
+                                                                         author TEXT,
+                                                                         subject TEXT,
+                                                                         keywords TEXT,
+                                                                         created TEXT,
+                                                                         error TEXT,
+                                                                         indexed_at REAL)''')
+        # Text of documents.id: SELECT doi FROM documents WHERE id IN (SELECT rowid FROM texts WHERE texts MATCH ?)
+        self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5 (title, body)')
+        self.connection.commit()
+
+    def get_sizes(self):
+        # DOI -> bytes of the pdf that was indexed, a pdf of another size is indexed again
+        with self.lock:
+            return dict(self.connection.execute('SELECT doi, bytes FROM documents'))
+
+    def save(self, doi, path, size, document):
+        with self.lock:
+            self.connection.execute('''INSERT INTO documents (doi, file_path, bytes, pages, title, author, subject, keywords, created, error, indexed_at)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT (doi) DO UPDATE SET file_path = excluded.file_path,
+                                                                       bytes = excluded.bytes,
+                                                                       pages = excluded.pages,
+                                                                       title = excluded.title,
+                                                                       author = excluded.author,
+                                                                       subject = excluded.subject,
+                                                                       keywords = excluded.keywords,
+                                                                       created = excluded.created,
+                                                                       error = excluded.error,
+                                                                       indexed_at = excluded.indexed_at''',
+                                    (doi, path, size, document.get('pages'), document.get('title'), document.get('author'), document.get('subject'),
+                                     document.get('keywords'), document.get('created'), document.get('error'), time.time()))
+            rowid = self.connection.execute('SELECT id FROM documents WHERE doi = ?', (doi,)).fetchone()[0]
+            self.connection.execute('DELETE FROM texts WHERE rowid = ?', (rowid,))
+            if not document.get('error'):
+                self.connection.execute('INSERT INTO texts (rowid, title, body) VALUES (?, ?, ?)', (rowid, document.get('title') or '', document.get('text') or ''))
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE:
+                self.connection.commit()
+                self.pending = 0
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class WorkQueue:
+
+    def __init__(self, path, worker, lease_time = 300):
+        self.WORKER = worker
+        self.LEASE_TIME = lease_time # Seconds, the DOIs of a worker that stops renewing its leases are claimed again
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.claimed = 0
+        self.reclaimed = 0
+        self.completed = 0
+
+        # Workers on other hosts may share the file over the network, where WAL doesn't work: rollback journal and
+        # explicit transactions (BEGIN IMMEDIATE takes the write lock before reading what to claim)
+        self.connection = sqlite3.connect(path, timeout = 60, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS items (doi TEXT PRIMARY KEY,
+                                                                     seq INTEGER NOT NULL,
+                                                                     state TEXT NOT NULL DEFAULT 'pending',
+                                                                     worker TEXT,
+                                                                     lease_until REAL,
+                                                                     status TEXT,
+                                                                     updated_at REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_items_state ON items (state, seq)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY,
+                                                                       heartbeat REAL NOT NULL,
+                                                                       finished INTEGER NOT NULL DEFAULT 0)''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+        self.execute_write(['INSERT OR REPLACE INTO workers (worker, heartbeat, finished) VALUES (?, ?, 0)'], [(self.WORKER, time.time())])
+        self.thread = threading.Thread(target = self.run_heartbeat, daemon = True)
+        self.thread.start()
+
+    def execute_write(self, statements, parameters):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for statement, params in zip(statements, parameters):
+                    self.connection.execute(statement, params)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def add(self, items):
+        # items: [(doi, seq)], every worker adds the DOIs it reads, the ones already in the queue are kept as they are
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany('INSERT OR IGNORE INTO items (doi, seq) VALUES (?, ?)', items)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def claim(self, count):
+        # The pending DOIs in input order, and the ones whose lease expired (their worker crashed)
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute('''SELECT doi, state FROM items
+                                                  WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)
+                                                  ORDER BY seq LIMIT ?''', (now, count)).fetchall()
+                self.connection.executemany("UPDATE items SET state = 'leased', worker = ?, lease_until = ?, updated_at = ? WHERE doi = ?",
+                                            [(self.WORKER, now + self.LEASE_TIME, now, doi) for doi, _ in rows])
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.claimed += len(rows)
+            self.reclaimed += len([doi for doi, state in rows if state == 'leased'])
+        return [doi for doi, _ in rows]
+
+    def complete(self, doi, status):
+        self.execute_write(["UPDATE items SET state = 'done', status = ?, lease_until = NULL, updated_at = ? WHERE doi = ? AND worker = ?"],
+                           [(status, time.time(), doi, self.WORKER)])
+        with self.lock:
+            self.completed += 1
+
+    def is_drained(self):
+        # Nothing left to claim now: the DOIs still leased by other workers are theirs while they renew the lease
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM items WHERE state = 'pending' OR (state = 'leased' AND worker != ?) LIMIT 1",
+                                           (self.WORKER,)).fetchone() is None
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(self.LEASE_TIME / 3):
+            now = time.time()
+            self.execute_write(["UPDATE items SET lease_until = ? WHERE state = 'leased' AND worker = ?",
+                                'UPDATE workers SET heartbeat = ? WHERE worker = ?'],
+                               [(now + self.LEASE_TIME, self.WORKER), (now, self.WORKER)])
+
+    def finish(self):
+        self.stopped.set()
+        self.thread.join()
+        self.execute_write(['UPDATE workers SET finished = 1, heartbeat = ? WHERE worker = ?'], [(time.time(), self.WORKER)])
+
+    def try_merge(self):
+        # True for only one worker: the one that finishes when every DOI is done and the other workers are finished (or dead)
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                unfinished = self.connection.execute("SELECT 1 FROM items WHERE state != 'done' LIMIT 1").fetchone()
+                running = self.connection.execute('SELECT 1 FROM workers WHERE finished = 0 AND worker != ? AND heartbeat >= ? LIMIT 1',
+                                                  (self.WORKER, now - self.LEASE_TIME)).fetchone()
+                merged = self.connection.execute("SELECT value FROM meta WHERE key = 'merged_by'").fetchone()
+                merge = unfinished is None and running is None and merged is None
+                if merge:
+                    self.connection.execute("INSERT INTO meta (key, value) VALUES ('merged_by', ?)", (self.WORKER,))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return merge
+
+    def get_stats(self):
+        with self.lock:
+            states = dict(self.connection.execute('SELECT state, COUNT(*) FROM items GROUP BY state'))
+            return "claimed by this worker: %s (expired leases: %s), completed: %s, queue: %s pending, %s leased, %s done" % (self.claimed,
+                                                                                                                          self.reclaimed,
+                                                                                                                          self.completed,
+                                                                                                                          states.get('pending', 0),
+                                                                                                                          states.get('leased', 0),
+                                                                                                                          states.get('done', 0))
+
+    def close(self):
+        # An interrupted worker gives its DOIs back at once instead of waiting for the leases to expire
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.thread.join()
+        self.execute_write(["UPDATE items SET state = 'pending', worker = NULL, lease_until = NULL WHERE state = 'leased' AND worker = ?",
+                            'UPDATE workers SET finished = 1 WHERE worker = ?'],
+                           [(self.WORKER,), (self.WORKER,)])
+        with self.lock:
+            self.connection.close()
+
+class DownloadError(Exception):
+    pass
+
+class PaperNotFoundError(DownloadError):
+    pass
+
+class TransientDownloadError(DownloadError):
+    pass
+
+class RetryQueue:
+
+    def __init__(self, base_delay = 5, max_delay = 300):
+        self.BASE_DELAY = base_delay
+        self.MAX_DELAY = max_delay
+        self.lock = threading.Lock()
+        self.heap = []
+        self.pending = set() # The papers of the heap, checked once per finished paper in the distributed mode
+        self.sequence = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def __contains__(self, paper):
+        with self.lock:
+            return paper in self.pending
+
+    def push(self, paper, attempt):
+        # Exponential backoff with jitter, so the retries don't hit the mirrors all at once
+        delay = min(self.MAX_DELAY, self.BASE_DELAY * 2 ** (attempt - 1))
+        delay = delay + random.uniform(0, delay / 2)
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.sequence, paper))
+            self.pending.add(paper)
+        return delay
+
+    def pop_ready(self, deadline = None):
+        # Waits for the earliest retry, then takes every paper that is due; no paper when the deadline comes first
+        with self.lock:
+            if not self.heap:
+                return []
+            wait = self.heap[0][0] - time.time()
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+        if wait > 0:
+            time.sleep(wait)
+
+        papers = []
+        now = time.time()
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                papers.append(heapq.heappop(self.heap)[2])
+                self.pending.discard(papers[-1])
+        return sorted(papers, key = lambda paper: paper.index)
+
+class TokenBucket:
+
+    def __init__(self, rate, burst = 1):
+        self.RATE = rate # Tokens per second, 0 for no limit
+        self.BURST = max(1, burst)
+        self.tokens = self.BURST
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.RATE <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.BURST, self.tokens + (now - self.updated_at) * self.RATE)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.RATE
+            time.sleep(wait)
+
+class HostLimiter:
+
+    def __init__(self, host, max_limit = 4, rate = 0, on_decrease = None):
+        # AIMD: +1 request per window of successes while the latency holds, halved on errors or throttling
+        self.HOST = host
+        self.MIN_LIMIT = 1
+        self.MAX_LIMIT = max(1, max_limit)
+        self.DECREASE_FACTOR = 0.5
+        self.DECREASE_INTERVAL = 2 # Seconds, errors of requests that were already in flight only count once
+        self.LATENCY_FACTOR = 3    # Latency above this multiple of the best observed one stops the increase
+        self.SMOOTHING = 0.2
+
+        self.bucket = TokenBucket(rate, burst = self.MAX_LIMIT)
+        self.on_decrease = on_decrease
+        self.condition = threading.Condition()
+        self.limit = float(self.MIN_LIMIT)
+        self.in_flight = 0
+        self.latency = None
+        self.best_latency = None
+        self.decreased_at = 0
+        self.started_at = time.time()
+        self.successes = 0
+        self.errors = 0
+        self.decreases = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        self.bucket.acquire()
+
+    def release(self, latency = None, error = False):
+        decreased = None
+        with self.condition:
+            self.in_flight -= 1
+            if error:
+                self.errors += 1
+                now = time.time()
+                if now - self.decreased_at >= self.DECREASE_INTERVAL:
+                    decreased = (self.limit, max(self.MIN_LIMIT, self.limit * self.DECREASE_FACTOR))
+                    self.limit = decreased[1]
+                    self.decreased_at = now
+                    self.decreases += 1
+            else:
+                self.successes += 1
+                if latency is not None:
+                    self.latency = latency if self.latency is None else self.SMOOTHING * latency + (1 - self.SMOOTHING) * self.latency
+                    self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+                if self.latency is None or self.latency <= self.LATENCY_FACTOR * self.best_latency:
+                    self.limit = min(self.MAX_LIMIT, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+        if decreased is not None and self.on_decrease is not None:
+            self.on_decrease(self.HOST, decreased[0], decreased[1])
+
+    def get_stats(self):
+        with self.condition:
+            elapsed = max(time.time() - self.started_at, 1e-6)
+            return "%s: concurrent requests limit: %.1f/%s, requests per minute: %.1f, errors: %s, limit cuts: %s, latency: %s" % (self.HOST,
+                                                                                                                                self.limit,
+                                                                                                                                self.MAX_LIMIT,
+                                                                                                                                60 * (self.successes + self.errors) / elapsed,
+                                                                                                                                self.errors,
+                                                                                                                                self.decreases,
+                                                                                                                                '-' if self.latency is None else '%.2f s' % self.latency)
+
+class MirrorPool:
+
+    def __init__(self, urls, failures = 3, cooldown = 300):
+        self.FAILURES = failures
+        self.COOLDOWN = cooldown
+        self.SMOOTHING = 0.3 # Weight of the last request in the latency average
+
+        self.lock = threading.Lock()
+        self.mirrors = {}
+        for url in urls:
+            self.mirrors.update({url: {'latency': None,
+                                       'healthy': True,
+                                       'consecutive_failures': 0,
+                                       'opened_at': None,
+                                       'successes': 0,
+                                       'failures': 0,
+                                       'total_latency': 0.0}})
+
+    def probe(self, timeout = 10):
+        with ThreadPoolExecutor(max_workers = max(1, len(self.mirrors))) as executor:
+            list(executor.map(lambda url: self.probe_mirror(url, timeout), list(self.mirrors)))
+
+    def probe_mirror(self, url, timeout):
+        import requests
+
+        _start = time.time()
+        try:
+            response = requests.get(url, timeout = timeout)
+            healthy = response.status_code < 500
+        except Exception:
+            healthy = False
+
+        with self.lock:
+            mirror = self.mirrors[url]
+            mirror['healthy'] = healthy
+            if healthy:
+                mirror['latency'] = time.time() - _start
+            else:
+                self.open_breaker(mirror)
+
+    def is_available(self, mirror, now):
+        if mirror['opened_at'] is None:
+            return True
+        # Half-open: after the cooldown the mirror gets a new chance
+        return now - mirror['opened_at'] >= self.COOLDOWN
+
+    def choose(self):
+        now = time.time()
+        with self.lock:
+            candidates = [(mirror['latency'] if mirror['latency'] is not None else float('inf'), url)
+                          for url, mirror in self.mirrors.items() if self.is_available(mirror, now)]
+            if not candidates:
+                # Every circuit is open: the mirror opened first gets a half-open trial. Waiting for the cooldown
+                # would outlast the retries, and every paper would fail without a request
+                candidates = [(mirror['opened_at'], url) for url, mirror in self.mirrors.items()]
+            if not candidates:
+                return None
+            return min(candidates)[1]
+
+    def open_breaker(self, mirror):
+        mirror['opened_at'] = time.time()
+
+    def report_success(self, url, latency):
+        with self.lock:
+            mirror = self.mirrors[url]
+            mirror['successes'] += 1
+            mirror['total_latency'] += latency
+            mirror['consecutive_failures'] = 0
+            mirror['opened_at'] = None
+            mirror['healthy'] = True
+            if mirror['latency'] is None:
+                mirror['latency'] = latency
+            else:
+                mirror['latency'] = self.SMOOTHING * latency + (1 - self.SMOOTHING) * mirror['latency']
+
+    def report_failure(self, url):
+        with self.lock:
+            mirror = self.mirrors[url]
+            mirror['failures'] += 1
+            mirror['consecutive_failures'] += 1
+            if mirror['consecutive_failures'] >= self.FAILURES or mirror['opened_at'] is not None:
+                self.open_breaker(mirror)
+                mirror['healthy'] = False
+
+    def get_stats(self):
+        now = time.time()
+        lines = []
+        with self.lock:
+            for url, mirror in self.mirrors.items():
+                requests_done = mirror['successes'] + mirror['failures']
+                mean_latency = mirror['total_latency'] / mirror['successes'] if mirror['successes'] > 0 else None
+                if mirror['opened_at'] is None:
+                    state = 'healthy' if mirror['healthy'] else 'unhealthy'
+                elif self.is_available(mirror, now):
+                    state = 'circuit half-open'
+                else:
+                    state = 'circuit open'
+                lines.append("%s: %s, requests: %s, ok: %s, failed: %s, latency: %s, mean latency: %s" % (url,
+                                                                                                        state,
+                                                                                                        requests_done,
+                                                                                                        mirror['successes'],
+                                                                                                        mirror['failures'],
+                                                                                                        '-' if mirror['latency'] is None else '%.2f s' % mirror['latency'],
+                                                                                                        '-' if mean_latency is None else '%.2f s' % mean_latency))
+        return lines
+
+class ScidownlBackend:
+
+    def __init__(self, oscihub):
+        import requests
+        from scidownl import scihub_download
+
+        self.oscihub = oscihub
+        self.scihub_download = scihub_download
+        self.HTTPError = requests.exceptions.HTTPError
+
+    def get_cached(self, doi):
+        # scidownl resolves every DOI again
+        return None
+
+    def download(self, doi, out_pdf, scihub_url = None):
+        # scidownl doesn't raise when the paper is missing, it just doesn't write the file. Its resolve and transfer can't be told apart
+        # It also adds .pdf to the names that don't end in pdf (X.part -> X.part.pdf), so it gets a name that does and the file is renamed
+        scidownl_pdf = '%s.pdf' % out_pdf
+        if os.path.exists(scidownl_pdf):
+            os.remove(scidownl_pdf)
+        try:
+            self.oscihub.metrics.time_call('transfer', self.scihub_download, keyword = doi, paper_type = "doi", scihub_url = scihub_url, out = scidownl_pdf)
+        except self.HTTPError as e:
+            # The few errors scidownl lets through are retried and count against the mirror; connection errors already are transient
+            raise TransientDownloadError('HTTP error: %s' % e)
+        if os.path.exists(scidownl_pdf):
+            os.replace(scidownl_pdf, out_pdf)
+        return None
+
+    def close(self):
+        pass
+
+class NativeBackend:
+
+    def __init__(self, oscihub):
+        import requests
+
+        self.oscihub = oscihub
+        self.TIMEOUT = oscihub.TIMEOUT
+        self.CHUNK_SIZE = 64 * 1024
+        self.USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0'
+
+        # Tags that carry the pdf link in the Sci-Hub page: <embed id="pdf" src="...">, <iframe id="pdf" src="...">
+        self.re_pdf_tag = re.compile(r'<(?:embed|iframe)[^>]*?\bid\s*=\s*["\']pdf["\'][^>]*>', re.IGNORECASE)
+        self.re_embed_tag = re.compile(r'<embed[^>]*type\s*=\s*["\']application/pdf["\'][^>]*>', re.IGNORECASE)
+        self.re_src = re.compile(r'\bsrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+        # One keep-alive pool for the whole run, shared by every worker
+        pool_size = max(oscihub.WORKERS, oscihub.MAX_PER_HOST)
+        adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': self.USER_AGENT})
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_cached(self, doi):
+        # (pdf url, mirror) of a DOI resolved before, None when it isn't cached; a paper Sci-Hub doesn't have raises
+        cache = self.oscihub.doi_cache
+        cached = cache.get(doi) if cache is not None else None
+        if cached is None:
+            return None
+        found, pdf_url, mirror = cached
+        if not found:
+            raise PaperNotFoundError('The paper is not available in Sci-Hub (cached): %s' % doi)
+        return (pdf_url, mirror)
+
+    def download_cached(self, doi, out_pdf, pdf_url, mirror):
+        try:
+            return self.oscihub.metrics.time_call('transfer', self.fetch, pdf_url, out_pdf, referer = mirror)
+        except Exception:
+            # Expired link (a web page instead of the pdf), server or connection error: the DOI is resolved again now,
+            # otherwise every retry and every run would go back to the same link until the entry expires
+            self.oscihub.doi_cache.remove(doi)
+            raise
+
+    def download(self, doi, out_pdf, scihub_url):
+        # Resolves the DOI in the mirror, the cache was checked before the mirror was chosen
+        cache = self.oscihub.doi_cache
+        try:
+            pdf_url = self.oscihub.metrics.time_call('resolve', self.resolve, doi, scihub_url)
+        except PaperNotFoundError:
+            if cache is not None:
+                cache.put(doi, None, scihub_url)
+            raise
+        if cache is not None:
+            cache.put(doi, pdf_url, scihub_url)
+        return self.oscihub.metrics.time_call('transfer', self.fetch, pdf_url, out_pdf, referer = scihub_url)
+
+    def resolve(self, doi, scihub_url):
+        response = self.session.post(scihub_url, data = {'request': doi}, timeout = self.TIMEOUT)
+        if response.status_code != 200:
+            self.raise_status_error('Sci-Hub answered with status %s' % response.status_code, response.status_code)
+        pdf_url = self.extract_pdf_url(response.text, scihub_url)
+        if pdf_url is None:
+            if self.is_captcha(response.text):
+                raise TransientDownloadError('Sci-Hub answered with a captcha page')
+            raise PaperNotFoundError('The paper is not available in Sci-Hub: %s' % doi)
+        return pdf_url
+
+    def is_captcha(self, html):
+        return 'captcha' in html.lower()
+
+    def raise_status_error(self, message, status_code):
+        if status_code == 429 or status_code >= 500:
+            raise TransientDownloadError(message)
+        raise DownloadError(message)
+
+    def extract_pdf_url(self, html, scihub_url):
+        tag = self.re_pdf_tag.search(html) or self.re_embed_tag.search(html)
+        if tag is None:
+            return None
+        src = self.re_src.search(tag.group(0))
+        if src is None:
+            return None
+
+        url = src.group(1).split('#')[0].strip()
+        if url.startswith('//'):
+            url = '%s:%s' % (urlparse(scihub_url).scheme or 'https', url)
+        return urljoin(scihub_url, url)
+
+    def fetch(self, pdf_url, out_pdf, referer = None):
+        headers = {'Referer': referer} if referer else {}
+
+        # Resume a previous partial transfer of the same url, if the server still has the same file (If-Range)
+        meta_file = '%s%s' % (out_pdf, self.oscihub.PARTIAL_META_EXTENSION)
+        offset = os.path.getsize(out_pdf) if os.path.exists(out_pdf) else 0
+        validator = self.get_resume_validator(meta_file, pdf_url) if offset > 0 else None
+        if validator is not None:
+            headers.update({'Range': 'bytes=%s-' % offset, 'If-Range': validator})
+        else:
+            offset = 0
+
+        with self.session.get(pdf_url, headers = headers, stream = True, timeout = self.TIMEOUT) as response:
+            if response.status_code == 416 and offset > 0:
+                # Nothing left to ask for, the partial file is already complete
+                return None
+            if response.status_code not in [200, 206]:
+                self.raise_status_error('The pdf request answered with status %s' % response.status_code, response.status_code)
+            content_type = response.headers.get('Content-Type', '')
+            if 'html' in content_type:
+                raise TransientDownloadError('The pdf request answered with a web page instead of a pdf')
+
+            if response.status_code == 206 and self.get_range_start(response) != offset:
+                raise DownloadError('The server answered with an unexpected range: %s' % response.headers.get('Content-Range'))
+
+            # A 200 is the whole file: the server ignored the range, or the file changed since the partial transfer
+            mode = 'ab' if response.status_code == 206 and offset > 0 else 'wb'
+            if mode == 'wb':
+                self.save_resume_validator(meta_file, pdf_url, response)
+            with open(out_pdf, mode) as f:
+                for chunk in response.iter_content(chunk_size = self.CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+            return content_type
+
+    def get_resume_validator(self, meta_file, pdf_url):
+        # ETag, or Last-Modified when the ETag is weak (not allowed in If-Range); None starts the transfer again
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != pdf_url:
+            return None
+        etag = meta.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return meta.get('last_modified')
+
+    def save_resume_validator(self, meta_file, pdf_url, response):
+        with open(meta_file, 'w') as f:
+            json.dump({'url': pdf_url,
+                       'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}, f)
+
+    def get_range_start(self, response):
+        # Content-Range: bytes 1000-4999/5000
+        content_range = response.headers.get('Content-Range', '')
+        match = re.match(r'bytes\s+(\d+)-', content_range)
+        return int(match.group(1)) if match else None
+
+    def close(self):
+        self.session.close()
+
+def run_input(input_file, output_path):
+    _start = oscihub.start_time()
+    oscihub.set_input(input_file, output_path)
+    input_information = oscihub.metrics.time_call('read', oscihub.read_input_file)
+    if oscihub.TYPE_INPUT is None:
+        oscihub.show_print("Incorrect format: the input file doesn't have a DOI column: %s" % oscihub.INPUT_FILE, [oscihub.LOG_FILE], font = oscihub.YELLOW)
+        # raise Exception("Incorrect format: the input file doesn't have a DOI column")
+        return
+
+    oscihub.show_print("#############################################################################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
+    oscihub.show_print("############################## Download papers ##############################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
+    oscihub.show_print("#############################################################################", [oscihub.LOG_FILE], font = oscihub.BIGREEN)
+
+    oscihub.show_print("Reading the input file: %s" % oscihub.INPUT_FILE, [oscihub.LOG_FILE], font = oscihub.GREEN)
+    if oscihub.input_count is not None:
+        oscihub.show_print("  Records found: %s" % oscihub.input_count, [oscihub.LOG_FILE])
+    elif oscihub.ORDER is not None:
+        oscihub.show_print("  Records are read before the papers are downloaded, to sort them (--order)", [oscihub.LOG_FILE])
+    else:
+        oscihub.show_print("  Records are read while the papers are downloaded", [oscihub.LOG_FILE])
+    oscihub.show_print("", [oscihub.LOG_FILE])
+
+    oscihub.open_state_store()
+    oscihub.open_manifest()
+    oscihub.open_archive()
+    oscihub.open_work_queue()
+    summary_ctrl = oscihub.metrics.time_call('index', oscihub.get_downloaded_files)
+    oscihub.download_pdf(input_information, summary_ctrl)
+    oscihub.close_work_queue()
+    oscihub.close_archive()
+    oscihub.close_manifest()
+    oscihub.close_state_store()
+
+    oscihub.show_print("", [oscihub.LOG_FILE])
+    oscihub.show_print(oscihub.finish_time(_start, "Elapsed time"), [oscihub.LOG_FILE])
+
+def close_run():
+    oscihub.close_executor(cancel = True)
+    oscihub.close_downloader()
+    oscihub.close_verify_pool()
+    oscihub.close_text_index(cancel = True)
+    oscihub.close_summary()
+    oscihub.close_metrics()
+    oscihub.close_work_queue()
+    oscihub.close_doi_cache()
+    oscihub.close_archive()
+    oscihub.close_manifest()
+    oscihub.close_state_store()
 
+def main():
+    # kill/SIGTERM stops the run like Ctrl-C, so the summary is still written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        start = oscihub.start_time()
+        menu()
+        if oscihub.MAX_TIME > 0:
+            # One budget for the whole run, also in a batch
+            oscihub.deadline = start + oscihub.MAX_TIME
+
+        # The worker pool, the connections, the mirrors and the DOI cache are shared by every input file of a batch
+        oscihub.CACHE_FILE = os.path.join(oscihub.ROOT_OUTPUT_PATH, oscihub.CACHE_FILE)
+        oscihub.TEXT_INDEX_FILE = os.path.join(oscihub.ROOT_OUTPUT_PATH, oscihub.TEXT_INDEX_FILE)
+        oscihub.open_doi_cache()
+        oscihub.open_text_index()
+        inputs = oscihub.get_input_outputs()
+        for iinput, (input_file, output_path) in enumerate(inputs, start = 1):
+            if len(inputs) > 1:
+                oscihub.show_print("[%s/%s] Input file: %s -> %s" % (iinput, len(inputs), input_file, output_path), font = oscihub.BIGREEN)
+            run_input(input_file, output_path)
+        oscihub.close_executor()
+        oscihub.close_downloader()
+        oscihub.close_verify_pool()
+        oscihub.close_text_index()
+        oscihub.close_doi_cache()
+
+        if len(inputs) > 1:
+            oscihub.show_print("", [oscihub.LOG_FILE])
+            oscihub.show_print("Input files: %s" % len(inputs), [oscihub.LOG_FILE])
+            oscihub.show_print("Papers/DOIs reused from an earlier input file: %s" % oscihub.batch_reused, [oscihub.LOG_FILE])
+            oscihub.show_print(oscihub.finish_time(start, "Total elapsed time"), [oscihub.LOG_FILE])
+        oscihub.show_print("Done!", [oscihub.LOG_FILE])
+    except KeyboardInterrupt:
         oscihub.show_print("", [oscihub.LOG_FILE])
+        oscihub.show_print("Interrupted, saving the partial results...", [oscihub.LOG_FILE], font = oscihub.YELLOW)
+        close_run()
         oscihub.show_print(oscihub.finish_time(start, "Elapsed time"), [oscihub.LOG_FILE])
-        oscihub.show_print("Done!", [oscihub.LOG_FILE])
     except Exception as e:
+        close_run()
         oscihub.show_print("\n%s" % traceback.format_exc(), [oscihub.LOG_FILE], font = oscihub.RED)
         oscihub.show_print(oscihub.finish_time(start, "Elapsed time"), [oscihub.LOG_FILE])
         oscihub.show_print("Done!", [oscihub.LOG_FILE])
+    finally:
+        oscihub.close_logs()
 
 if __name__ == '__main__':
     oscihub = SCIhub()
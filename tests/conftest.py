@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+
+import download_papers
+
+@pytest.fixture
+def oscihub(tmp_path):
+    # A fresh SCIhub for each test, also set as the global one of download_papers (menu() and run_input() use it)
+    instance = download_papers.SCIhub()
+    instance.OUTPUT_PATH = str(tmp_path)
+    instance.ROOT_OUTPUT_PATH = str(tmp_path)
+    instance.QUIET = True
+    instance.metrics = download_papers.RunMetrics()
+    download_papers.oscihub = instance
+    yield instance
+    instance.close_logs()
+
+@pytest.fixture
+def start_mirror():
+    # Local Sci-Hub stand-ins of the benchmarks, on free ports: start_mirror(latency = 0.1, error_rate = 0.5, ...)
+    import mirror_server
+
+    servers = []
+    def start(**config):
+        config.setdefault('pdf_size', 4096)
+        server = mirror_server.start_server(mirror_server.MirrorConfig(**config))
+        server.url = 'http://127.0.0.1:%s' % server.server_port
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def mirror(start_mirror):
+    return start_mirror()
+
+@pytest.fixture
+def native_backend(oscihub):
+    backend = download_papers.NativeBackend(oscihub)
+    yield backend
+    backend.close()
+
+@pytest.fixture
+def run_main(oscihub, monkeypatch):
+    # Runs download_papers.main() with these arguments; short retry delays and cooldowns for the stand-ins,
+    # other settings as keywords: run_main('-i', ..., MIRROR_COOLDOWN = 30)
+    def run(*arguments, **settings):
+        oscihub.RETRY_BASE_DELAY = 0.01
+        oscihub.RETRY_MAX_DELAY = 0.05
+        oscihub.MIRROR_COOLDOWN = 0.05
+        for name, value in settings.items():
+            setattr(oscihub, name, value)
+        monkeypatch.setattr(sys, 'argv', ['download_papers.py'] + [str(argument) for argument in arguments])
+        download_papers.main()
+    return run
+
+def get_statuses(output):
+    # {DOI: (status, attempts)} of the state store of an output folder
+    import sqlite3
+
+    connection = sqlite3.connect(os.path.join(str(output), 'summary_control.sqlite'))
+    rows = connection.execute('SELECT doi, status, attempts FROM papers').fetchall()
+    connection.close()
+    return {doi: (status, attempts) for doi, status, attempts in rows}
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import io
+import shutil
+import tarfile
+import zipfile
+
+import pytest
+
+import download_papers
+
+def get_pdf(number):
+    return b'%PDF-1.4\n' + (b'%d' % number) * 2000 + b'\n%%EOF\n'
+
+def add_pdfs(archive, numbers):
+    for number in numbers:
+        pdf = get_pdf(number)
+        archive.add('Article/%s.pdf' % number, io.BytesIO(pdf), len(pdf))
+
+def read_members(path, archive_format):
+    if archive_format == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            assert archive.testzip() is None
+            return {name: archive.read(name) for name in archive.namelist()}
+    with tarfile.open(path) as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive}
+
+def kill(archive, path, cut = 0):
+    # Copy of the archive as a killed run leaves it: the members flushed, no directory, the last one cut
+    killed = '%s.killed' % path
+    shutil.copyfile(path, killed)
+    if cut:
+        with open(killed, 'r+b') as f:
+            f.seek(0, 2)
+            f.truncate(f.tell() - cut)
+    archive.close()
+    return killed
+
+def test_zipfile_internals():
+    # Fails on a version of Python whose zipfile changed the attributes PaperArchive uses
+    assert download_papers.has_zipfile_internals()
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar'])
+def test_closed_archive_is_reopened(tmp_path, archive_format):
+    path = str(tmp_path / ('papers.%s' % archive_format))
+    archive = download_papers.PaperArchive(path, archive_format)
+    add_pdfs(archive, [1, 2])
+    archive.close()
+
+    archive = download_papers.PaperArchive(path, archive_format)
+    assert archive.recovered == 0
+    assert archive.get_index() == {'Article': {'1.pdf', '2.pdf'}}
+    add_pdfs(archive, [2, 3])
+    archive.close()
+    assert read_members(path, archive_format) == {'Article/%s.pdf' % number: get_pdf(number) for number in [1, 2, 3]}
+
+    # An empty archive that was closed isn't recovered either
+    empty = str(tmp_path / ('empty.%s' % archive_format))
+    download_papers.PaperArchive(empty, archive_format).close()
+    archive = download_papers.PaperArchive(empty, archive_format)
+    assert archive.recovered == 0
+    archive.close()
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar'])
+@pytest.mark.parametrize('cut', [0, 1000])
+def test_killed_archive_is_recovered(tmp_path, archive_format, cut):
+    path = str(tmp_path / ('papers.%s' % archive_format))
+    archive = download_papers.PaperArchive(path, archive_format)
+    add_pdfs(archive, [1, 2, 3])
+    killed = kill(archive, path, cut = cut)
+
+    archive = download_papers.PaperArchive(killed, archive_format)
+    found = [1, 2] if cut else [1, 2, 3]
+    assert archive.recovered == len(found)
+    assert archive.get_index() == {'Article': {'%s.pdf' % number for number in found}}
+    add_pdfs(archive, [3, 4])
+    archive.close()
+    assert read_members(killed, archive_format) == {'Article/%s.pdf' % number: get_pdf(number) for number in [1, 2, 3, 4]}
+
+@pytest.mark.parametrize('archive_format', ['zip', 'tar'])
+def test_failed_member_is_dropped(tmp_path, archive_format):
+    path = str(tmp_path / ('papers.%s' % archive_format))
+    archive = download_papers.PaperArchive(path, archive_format)
+    add_pdfs(archive, [1])
+    pdf = get_pdf(2)
+    with pytest.raises(Exception):
+        # A source shorter than its size, like a disk that is full in the middle of the member
+        archive.add('Article/2.pdf', io.BytesIO(pdf[:1000]), len(pdf))
+    assert 'Article/2.pdf' not in archive
+    add_pdfs(archive, [3])
+    archive.close()
+    assert read_members(path, archive_format) == {'Article/%s.pdf' % number: get_pdf(number) for number in [1, 3]}
+
+def test_copy_between_archives(tmp_path):
+    # Batch mode: a member of the archive of an earlier input file is copied by location
+    source = download_papers.PaperArchive(str(tmp_path / 'first.zip'), 'zip')
+    add_pdfs(source, [1])
+    target = download_papers.PaperArchive(str(tmp_path / 'second.tar'), 'tar')
+    target.copy('Review/1.pdf', *source.get_location('Article/1.pdf'))
+    source.close()
+    target.close()
+    assert read_members(str(tmp_path / 'second.tar'), 'tar') == {'Review/1.pdf': get_pdf(1)}
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import sys
+import sqlite3
+import types
+
+import pytest
+import requests
+
+import download_papers
+from conftest import get_statuses
+
+PDF = b'%PDF-1.4\n' + b'0' * 1024 + b'\n%%EOF\n'
+
+def scidownl_download(keyword, paper_type, scihub_url, out):
+    # Naming rule of scidownl 1.0.2 (scidownl/core/task.py): .pdf is added to the names that don't end in pdf
+    if not out.endswith('pdf'):
+        out = out + '.pdf'
+    if keyword == '10.5555/missing':
+        return
+    if keyword == '10.5555/error':
+        raise requests.exceptions.HTTPError('503 Server Error')
+    with open(out, 'wb') as f:
+        f.write(PDF)
+
+@pytest.fixture
+def scidownl_backend(oscihub, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'scidownl', types.SimpleNamespace(scihub_download = scidownl_download))
+    return download_papers.ScidownlBackend(oscihub)
+
+def test_scidownl_writes_the_part_file(scidownl_backend, tmp_path):
+    part_pdf = str(tmp_path / 'paper.pdf.part')
+    assert scidownl_backend.download('10.5555/found', part_pdf) is None
+    with open(part_pdf, 'rb') as f:
+        assert f.read() == PDF
+    assert os.listdir(str(tmp_path)) == ['paper.pdf.part']
+
+def test_scidownl_missing_paper_writes_nothing(scidownl_backend, tmp_path):
+    part_pdf = str(tmp_path / 'paper.pdf.part')
+    scidownl_backend.download('10.5555/missing', part_pdf)
+    assert not os.path.exists(part_pdf)
+
+def test_scidownl_stale_file_is_not_reused(scidownl_backend, tmp_path):
+    # A file left by a killed run isn't taken for the paper when scidownl doesn't find it
+    part_pdf = str(tmp_path / 'paper.pdf.part')
+    with open(part_pdf + '.pdf', 'wb') as f:
+        f.write(PDF[:100])
+    scidownl_backend.download('10.5555/missing', part_pdf)
+    assert not os.path.exists(part_pdf)
+    assert not os.path.exists(part_pdf + '.pdf')
+
+def test_scidownl_http_error_is_transient(scidownl_backend, tmp_path):
+    with pytest.raises(download_papers.TransientDownloadError):
+        scidownl_backend.download('10.5555/error', str(tmp_path / 'paper.pdf.part'))
+
+def get_pdf_url(mirror, doi):
+    return '%s/pdf/%s.pdf' % (mirror.url, doi.replace('/', '%2F'))
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_fetch_resumes_the_same_file(native_backend, mirror, tmp_path):
+    part_pdf = str(tmp_path / 'paper.part')
+    pdf_url = get_pdf_url(mirror, '10.5555/a')
+    native_backend.fetch(pdf_url, part_pdf)
+    pdf = mirror.config.get_pdf('10.5555/a')
+    assert read_file(part_pdf) == pdf
+
+    with open(part_pdf, 'r+b') as f:
+        f.truncate(1000)
+    sent = mirror.config.counters['bytes']
+    native_backend.fetch(pdf_url, part_pdf)
+    assert read_file(part_pdf) == pdf
+    assert mirror.config.counters['bytes'] - sent == len(pdf) - 1000
+
+@pytest.mark.parametrize('meta', [None,
+                                  {'url': 'other', 'etag': None, 'last_modified': None},
+                                  {'url': 'same', 'etag': '"changed"', 'last_modified': None}])
+def test_fetch_starts_again_from_another_partial_file(native_backend, mirror, tmp_path, meta):
+    # 3 kB of another paper: no url and ETag, another url, or the same url and a file that changed since
+    part_pdf = str(tmp_path / 'paper.part')
+    pdf_url = get_pdf_url(mirror, '10.5555/a')
+    with open(part_pdf, 'wb') as f:
+        f.write(mirror.config.get_pdf('10.5555/b')[:3000])
+    if meta is not None:
+        meta['url'] = pdf_url if meta['url'] == 'same' else get_pdf_url(mirror, '10.5555/b')
+        with open(part_pdf + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    native_backend.fetch(pdf_url, part_pdf)
+    assert read_file(part_pdf) == mirror.config.get_pdf('10.5555/a')
+    with open(part_pdf + '.json') as f:
+        assert json.load(f)['url'] == pdf_url
+
+def test_partial_files_are_named_by_doi(oscihub):
+    assert oscihub.get_doi_hash('10.5555/a') != oscihub.get_doi_hash('10.5555/b')
+
+def test_expired_cached_link_is_resolved_again(oscihub, native_backend, mirror, tmp_path):
+    # The cached link answers with a web page: its entry is dropped, the DOI is resolved again and the cache updated
+    oscihub.doi_cache = download_papers.DoiCache(str(tmp_path / 'doi_cache.sqlite'), ttl = 3600, negative_ttl = 3600, max_entries = 100)
+    oscihub.doi_cache.put('10.5555/a', '%s/expired' % mirror.url, mirror.url)
+    part_pdf = str(tmp_path / 'paper.part')
+
+    pdf_url, cached_mirror = native_backend.get_cached('10.5555/a')
+    with pytest.raises(Exception):
+        native_backend.download_cached('10.5555/a', part_pdf, pdf_url, cached_mirror)
+    assert native_backend.get_cached('10.5555/a') is None
+    native_backend.download('10.5555/a', part_pdf, mirror.url)
+    assert read_file(part_pdf) == mirror.config.get_pdf('10.5555/a')
+    assert oscihub.doi_cache.get('10.5555/a')[1] == get_pdf_url(mirror, '10.5555/a')
+    oscihub.close_doi_cache()
+
+def test_cache_hits_report_no_latency(oscihub, run_main, mirror, tmp_path):
+    # A paper cached as missing takes no request and a cached link no Sci-Hub page; neither counts as a mirror latency
+    output = tmp_path / 'output'
+    output.mkdir()
+    cache = download_papers.DoiCache(str(output / 'doi_cache.sqlite'), ttl = 3600, negative_ttl = 3600, max_entries = 100)
+    cache.put('10.5555/cached', get_pdf_url(mirror, '10.5555/cached'), mirror.url)
+    cache.put('10.5555/missing', None, mirror.url)
+    cache.close()
+    input_file = tmp_path / 'dois.txt'
+    input_file.write_text('10.5555/cached\n10.5555/missing\n')
+    pages = mirror.config.counters['pages']
+
+    run_main('-i', input_file, '-o', output, '-b', 'native', '-m', mirror.url, '-r', 1, '-q')
+    statuses = get_statuses(output)
+    assert statuses['10.5555/cached'][0] == 'Ok'
+    assert statuses['10.5555/missing'][0] != 'Ok'
+    assert mirror.config.counters['pages'] == pages
+    assert mirror.config.counters['pdfs'] == 1
+    limiter = oscihub.get_host_limiter(mirror.url)
+    assert limiter.best_latency is None
+    assert limiter.successes == 1
+    # No paper needed a mirror: they weren't probed
+    assert not oscihub.mirrors_probed
+    assert oscihub.mirror_pool.mirrors[mirror.url]['latency'] is None
+
+@pytest.mark.parametrize('config, error', [({'missing_rate': 1.0}, download_papers.PaperNotFoundError),
+                                           ({'captcha_rate': 1.0}, download_papers.TransientDownloadError),
+                                           ({'error_rate': 1.0}, download_papers.TransientDownloadError)])
+def test_resolve_errors(native_backend, start_mirror, config, error):
+    server = start_mirror(**config)
+    with pytest.raises(error):
+        native_backend.resolve('10.5555/a', server.url)
+
+def test_resolve(native_backend, mirror):
+    assert native_backend.resolve('10.5555/a', mirror.url) == get_pdf_url(mirror, '10.5555/a')
+
+def test_run_with_retries(run_main, start_mirror, tmp_path):
+    # Server errors and truncated pdfs are retried until every paper is downloaded; a new run requests nothing
+    server = start_mirror(error_rate = 0.2, truncated_rate = 0.2, seed = 1)
+    dois = ['10.5555/run.%s' % number for number in range(10)]
+    input_file = tmp_path / 'dois.txt'
+    input_file.write_text('\n'.join(dois) + '\n')
+    output = tmp_path / 'output'
+
+    run_main('-i', input_file, '-o', output, '-b', 'native', '-m', server.url, '-w', 4, '-r', 10, '--rate', 0, '-q')
+    statuses = get_statuses(output)
+    assert {doi: status for doi, (status, _) in statuses.items()} == {doi: 'Ok' for doi in dois}
+    assert sum([attempts for _, attempts in statuses.values()]) > len(dois)
+    assert sorted(os.listdir(str(output / 'Papers'))) == sorted(['%s.Article.pdf' % number for number in range(1, 11)])
+    assert os.listdir(str(output / '.partial')) == []
+
+    pdfs = server.config.counters['pdfs']
+    run_main('-i', input_file, '-o', output, '-b', 'native', '-m', server.url, '-q')
+    assert server.config.counters['pdfs'] == pdfs
+
+def test_record_lines_have_the_index_and_doi(oscihub):
+    log = download_papers.RecordLog(oscihub, download_papers.Paper(3, doi = '10.5555/a'), 10, buffered = True)
+    log.show_print('Downloading paper...')
+    assert log.messages[0][0] == '[3/10 10.5555/a] Downloading paper...'
+    log = download_papers.RecordLog(oscihub, download_papers.Paper(4), None, buffered = True)
+    log.show_print('Paper without DOI')
+    assert log.messages[0][0] == '[4] Paper without DOI'
+
+@pytest.mark.parametrize('layout', ['flat', 'hash'])
+def test_repeated_dois_and_prune(oscihub, run_main, mirror, tmp_path, layout):
+    # A repeated DOI is downloaded once and linked for the other papers; --prune deletes what the input file doesn't have anymore
+    input_file = tmp_path / 'papers.csv'
+    output = tmp_path / 'output'
+    rows = [('Paper %s' % number, '10.5555/repeated.%s' % (number % 3)) for number in range(6)]
+    input_file.write_text('Title,DOI,Year,Document Type\n' + ''.join(['%s,%s,2020,Article\n' % row for row in rows]))
+    run_main('-i', input_file, '-o', output, '-m', mirror.url, '-w', 2, '--layout', layout, '-q')
+    assert mirror.config.counters['pdfs'] == 3
+    connection = sqlite3.connect(str(output / 'summary_control.sqlite'))
+    statuses = dict(connection.execute('SELECT ctrl_key, status FROM papers'))
+    connection.close()
+    assert [statuses['Article.2020.%s.pdf' % title] for title, _ in rows] == ['Ok'] * 6
+    if layout == 'flat':
+        assert sorted(os.listdir(str(output / 'Article'))) == sorted(['2020.%s.pdf' % title for title, _ in rows])
+    assert oscihub.state_store is None
+
+    input_file.write_text('Title,DOI,Year,Document Type\n' + ''.join(['%s,%s,2020,Article\n' % row for row in rows[:2]]))
+    run_main('-i', input_file, '-o', output, '-m', mirror.url, '--layout', layout, '--prune', '-q')
+    assert mirror.config.counters['pdfs'] == 3
+    if layout == 'flat':
+        assert sorted(os.listdir(str(output / 'Article'))) == ['2020.Paper 0.pdf', '2020.Paper 1.pdf']
+    else:
+        manifest = download_papers.Manifest(str(output / 'manifest.sqlite'))
+        assert sorted(manifest.get_files()) == ['10.5555/repeated.0', '10.5555/repeated.1']
+        manifest.close()
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+import download_papers
+
+def test_size_limit_is_kept_during_the_run(tmp_path):
+    cache = download_papers.DoiCache(str(tmp_path / 'doi_cache.sqlite'), ttl = 3600, negative_ttl = 3600, max_entries = 100)
+    for number in range(1000):
+        cache.put('10.5555/%s' % number, 'http://mirror/%s.pdf' % number, 'http://mirror')
+        assert cache.entries <= 100
+    assert cache.connection.execute('SELECT COUNT(*) FROM dois').fetchone()[0] == cache.entries
+
+    # The least recently used entries go first
+    assert cache.get('10.5555/999') is not None
+    assert cache.get('10.5555/0') is None
+    cache.put('10.5555/999', None, 'http://mirror')
+    cache.remove('10.5555/998')
+    assert cache.connection.execute('SELECT COUNT(*) FROM dois').fetchone()[0] == cache.entries
+    cache.close()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import download_papers
+
+def add(metrics, index, status, latency, size = None, mirror = None):
+    paper = download_papers.Paper(index)
+    paper.duration = latency
+    paper.size = size
+    paper.mirror = mirror
+    metrics.add_paper(paper, status)
+    return paper
+
+def test_retried_paper_replaces_its_last_result():
+    metrics = download_papers.RunMetrics()
+    paper = add(metrics, 1, 'Not available', 0.5, mirror = 'http://a')
+    add(metrics, 2, 'Ok', 1.0, size = 100, mirror = 'http://a')
+    paper.duration = 2.0
+    paper.size = 300
+    paper.mirror = 'http://b'
+    metrics.add_paper(paper, 'Ok')
+
+    report = metrics.get_report()
+    assert report['papers'] == 2
+    assert report['statuses'] == {'Ok': 2}
+    assert report['bytes'] == 400
+    assert report['mirrors'] == {'http://a': {'papers': 1, 'bytes': 100}, 'http://b': {'papers': 1, 'bytes': 300}}
+    assert report['latency_seconds']['count'] == 2
+    assert report['latency_seconds']['sum'] == 3.0
+
+def test_latency_percentiles_within_a_bucket():
+    metrics = download_papers.RunMetrics()
+    for index in range(1, 1001):
+        add(metrics, index, 'Ok', index / 100.0)
+    latency = metrics.get_report()['latency_seconds']
+    for key, exact in [('p50', 5.0), ('p90', 9.0), ('p99', 9.9)]:
+        assert exact <= latency[key] <= exact * 1.1
+    assert latency['max'] == 10.0
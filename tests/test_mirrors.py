@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+
+import download_papers
+from conftest import get_statuses
+
+def open_circuit(pool, url):
+    for _ in range(pool.FAILURES):
+        pool.report_failure(url)
+
+def test_every_circuit_open_gives_a_half_open_trial():
+    # One failed probe per mirror at start-up doesn't leave the run without mirrors for the whole cooldown
+    pool = download_papers.MirrorPool(['http://a', 'http://b'], failures = 1, cooldown = 300)
+    open_circuit(pool, 'http://b')
+    open_circuit(pool, 'http://a')
+    assert pool.choose() == 'http://b'
+
+    # The trial fails: the circuit opens again and the other mirror is the next trial
+    pool.report_failure('http://b')
+    assert pool.choose() == 'http://a'
+    pool.report_success('http://a', 0.1)
+    assert pool.choose() == 'http://a'
+
+def get_closed_url():
+    # A port nothing listens on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%s' % s.getsockname()[1]
+
+def test_probe_ranks_the_mirrors(start_mirror):
+    fast = start_mirror()
+    slow = start_mirror(latency = 0.2)
+    closed = get_closed_url()
+    pool = download_papers.MirrorPool([slow.url, closed, fast.url], failures = 3, cooldown = 0.2)
+    pool.probe(timeout = 2)
+    assert pool.choose() == fast.url
+    assert pool.mirrors[slow.url]['latency'] > pool.mirrors[fast.url]['latency']
+
+    # The mirror that didn't answer has its circuit open, then half-open after the cooldown
+    assert pool.mirrors[closed]['opened_at'] is not None
+    assert not pool.is_available(pool.mirrors[closed], time.time())
+    time.sleep(0.25)
+    assert pool.is_available(pool.mirrors[closed], time.time())
+    assert '%s: circuit half-open' % closed in pool.get_stats()[1]
+
+    # The fast mirror gets slower than the other one: it loses the first place
+    for _ in range(10):
+        pool.report_success(fast.url, 1.0)
+    assert pool.choose() == slow.url
+
+def test_run_moves_away_from_the_failing_mirror(oscihub, run_main, start_mirror, tmp_path):
+    # Every Sci-Hub page of the failing mirror is a 503 (its home page answers, the probe finds it healthy and fastest)
+    failing = start_mirror(error_rate = 1.0)
+    slow = start_mirror(latency = 0.05)
+    dois = ['10.5555/mirror.%s' % number for number in range(20)]
+    input_file = tmp_path / 'dois.txt'
+    input_file.write_text('\n'.join(dois) + '\n')
+
+    run_main('-i', input_file, '-o', tmp_path / 'output', '-b', 'native', '-m', '%s,%s' % (failing.url, slow.url), '-w', 2, '-r', 5, '--rate', 0, '-q',
+             MIRROR_COOLDOWN = 30)
+    assert {doi: status for doi, (status, _) in get_statuses(tmp_path / 'output').items()} == {doi: 'Ok' for doi in dois}
+    assert slow.config.counters['pdfs'] == len(dois)
+    # The circuit opens after MIRROR_FAILURES errors and stays open for the run
+    assert failing.config.counters['errors'] <= 3 + 2
+    assert oscihub.mirrors_probed
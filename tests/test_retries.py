@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import download_papers
+
+def test_pop_ready_stops_at_the_deadline():
+    retry_queue = download_papers.RetryQueue(base_delay = 60, max_delay = 60)
+    paper = download_papers.Paper(1, doi = '10.5555/a')
+    retry_queue.push(paper, 1)
+
+    _start = time.time()
+    assert retry_queue.pop_ready(deadline = _start + 0.1) == []
+    assert time.time() - _start < 1
+    assert paper in retry_queue
+
+def test_pop_ready_takes_the_papers_due():
+    retry_queue = download_papers.RetryQueue(base_delay = 0.01, max_delay = 0.01)
+    papers = [download_papers.Paper(index, doi = '10.5555/%s' % index) for index in [2, 1]]
+    for paper in papers:
+        retry_queue.push(paper, 1)
+    time.sleep(0.05)
+    # In the order of the input file
+    assert retry_queue.pop_ready(deadline = time.time() + 10) == papers[::-1]
+    assert len(retry_queue) == 0
+
+def test_membership_follows_the_heap():
+    retry_queue = download_papers.RetryQueue(base_delay = 0.01, max_delay = 0.01)
+    paper = download_papers.Paper(1, doi = '10.5555/a')
+    other = download_papers.Paper(2, doi = '10.5555/a')
+    retry_queue.push(paper, 1)
+    assert paper in retry_queue
+    assert other not in retry_queue
+    time.sleep(0.05)
+    assert retry_queue.pop_ready() == [paper]
+    assert paper not in retry_queue
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import download_papers
+
+def test_checkpoints_are_written_off_the_download_workers(run_main, start_mirror, tmp_path, monkeypatch):
+    threads = []
+    save_summary_xls = download_papers.SCIhub.save_summary_xls
+    def saved(self, *args):
+        threads.append(threading.current_thread().name)
+        return save_summary_xls(self, *args)
+    monkeypatch.setattr(download_papers.SCIhub, 'save_summary_xls', saved)
+
+    server = start_mirror(latency = 0.1)
+    input_file = tmp_path / 'papers.csv'
+    input_file.write_text('Title,DOI,Year\n' + ''.join(['Paper %s,10.5555/summary.%s,2020\n' % (number, number) for number in range(30)]))
+    run_main('-i', input_file, '-o', tmp_path / 'output', '-b', 'native', '-m', server.url, '-w', 2, '--rate', 0, '--checkpoint', 1, '-q')
+
+    # Checkpoints during the run, then the final summary
+    assert threads.count('summary-checkpoint') >= 1
+    assert threads[-1] == 'MainThread'
+    assert set(threads) == {'summary-checkpoint', 'MainThread'}
+    assert (tmp_path / 'output' / 'summary_download.xlsx').exists()
+
+def read_summary(output):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(str(output / 'summary_download.xlsx'), read_only = True)
+    rows = [list(row) for row in workbook.active.iter_rows(values_only = True)]
+    workbook.close()
+    return rows
+
+def count_lines(file):
+    import csv
+
+    with open(str(file), newline = '', encoding = 'utf-8') as f:
+        return len(list(csv.reader(f))) - 1
+
+def write_input(input_file, numbers):
+    import csv
+
+    with open(str(input_file), 'w', newline = '', encoding = 'utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Title', 'Abstract', 'DOI', 'Year'])
+        for number in numbers:
+            writer.writerow(['Paper %s' % number, 'Abstract of %s,\nwith two lines' % number, '10.5555/sidecar.%s' % number, 2020])
+
+def test_summary_is_built_from_the_sidecar(run_main, mirror, tmp_path, monkeypatch):
+    # The input file is read once, the .xlsx gets the abstracts and results from the sidecar
+    reads = []
+    iter_input_rows = download_papers.SCIhub.iter_input_rows
+    def counted(self):
+        reads.append(self.INPUT_FILE)
+        return iter_input_rows(self)
+    monkeypatch.setattr(download_papers.SCIhub, 'iter_input_rows', counted)
+
+    input_file = tmp_path / 'papers.csv'
+    output = tmp_path / 'output'
+    write_input(input_file, range(1, 6))
+    run_main('-i', input_file, '-o', output, '-m', mirror.url, '-w', 2, '--checkpoint', 1, '-q')
+    assert len(reads) == 1
+    rows = read_summary(output)
+    assert rows[0][:5] == ['Item', 'Title', 'Abstract', 'Year', 'DOI']
+    assert [row[:5] for row in rows[1:]] == [[number, 'Paper %s' % number, 'Abstract of %s,\nwith two lines' % number, 2020, '10.5555/sidecar.%s' % number]
+                                             for number in range(1, 6)]
+    assert [row[8] for row in rows[1:]] == ['Ok'] * 5
+    assert [row[-2] for row in rows[1:]] == ['2020.Paper %s.pdf' % number for number in range(1, 6)]
+    # One line per Item once the run is finished
+    assert count_lines(output / 'summary_download.csv') == 5
+
+    # A new run with a shorter input file: the sidecar is kept, the Items that aren't in the input anymore are dropped
+    write_input(input_file, range(1, 4))
+    run_main('-i', input_file, '-o', output, '-m', mirror.url, '-q')
+    rows = read_summary(output)
+    assert [row[1] for row in rows[1:]] == ['Paper %s' % number for number in range(1, 4)]
+    assert [row[2] for row in rows[1:]] == ['Abstract of %s,\nwith two lines' % number for number in range(1, 4)]
+    assert count_lines(output / 'summary_download.csv') == 3
+
+def test_summary_of_a_stopped_run_keeps_the_rows_of_the_last_one(oscihub, run_main, mirror, tmp_path):
+    input_file = tmp_path / 'papers.csv'
+    output = tmp_path / 'output'
+    write_input(input_file, range(1, 4))
+    run_main('-i', input_file, '-o', output, '-m', mirror.url, '-q')
+
+    # A run of the same output folder that stops after reading the first paper: the .xlsx still has the three of them
+    oscihub.metrics = download_papers.RunMetrics()
+    oscihub.open_summary_sidecar({})
+    paper = download_papers.Paper(1, doi = '10.5555/sidecar.1')
+    paper.title = 'Paper 1 again'
+    oscihub.add_summary_row(paper)
+    oscihub.close_summary()
+    rows = read_summary(output)
+    assert [row[1] for row in rows[1:]] == ['Paper 1 again', 'Paper 2', 'Paper 3']
+    assert rows[1][2] == 'Abstract of 1,\nwith two lines'
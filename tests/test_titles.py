@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+import pytest
+
+def baseline_check_title(title):
+    # SCIhub.check_title of the first version, the names of the pdfs already downloaded depend on it
+    rstr = r"[\/\\\:\*\?\"\“\”\<\>\|\@\°\'\‘\’\®\–\-]" # / \ : * ? " “ ” < > | @ ° ' ‘ ’ ® – -
+    new_title = re.sub(rstr, " ", title)
+    new_title = re.sub("\n", " ", new_title)
+    new_title = re.sub("  ", " ", new_title)
+    new_title = re.sub("  ", " ", new_title)
+    new_title = new_title.replace('(', '')
+    new_title = new_title.replace(')', '')
+
+    if '[' in new_title:
+        new_title = new_title.split('[')[0].strip()
+
+    new_title = new_title[:200].strip()
+
+    return new_title
+
+TITLES = ['Fungal biofilms: a review',
+          'Anti-fungal "activity" of (new) compounds / part 2',
+          'Effects of pH<7 and T>30 °C on growth | yield @ scale',
+          'Title with a line\nbreak and    several     spaces',
+          '“Quoted” title – with ‘marks’ and ® signs',
+          'Title with a translation [Título traducido]',
+          '[Only a bracket title]',
+          '  Leading and trailing spaces  ',
+          'A very long title ' * 20,
+          'Colon::double--dash//slash\\\\backslash**star??question',
+          '']
+
+@pytest.mark.parametrize('title', TITLES)
+def test_check_title_matches_the_baseline(oscihub, title):
+    assert oscihub.check_title(title) == baseline_check_title(title)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import subprocess
+
+import download_papers
+from conftest import ROOT_DIR, get_statuses
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    path = str(tmp_path / 'work_queue_run.sqlite')
+    crashed = download_papers.WorkQueue(path, 'crashed', lease_time = 0.3)
+    crashed.add([('10.5555/a', 1), ('10.5555/b', 2), ('10.5555/c', 3)])
+    assert crashed.claim(2) == ['10.5555/a', '10.5555/b']
+
+    # The leases of a worker that renews them aren't taken
+    worker = download_papers.WorkQueue(path, 'worker', lease_time = 0.3)
+    assert worker.claim(5) == ['10.5555/c']
+    assert not worker.is_drained()
+
+    # The worker stops renewing its leases without giving the DOIs back (killed)
+    crashed.stopped.set()
+    crashed.thread.join()
+    time.sleep(0.5)
+    assert worker.claim(5) == ['10.5555/a', '10.5555/b']
+    assert worker.reclaimed == 2
+    for doi in ['10.5555/a', '10.5555/b', '10.5555/c']:
+        worker.complete(doi, 'Ok')
+    # A late result of the crashed worker doesn't change the DOI it lost
+    crashed.complete('10.5555/a', 'Not available')
+
+    worker.finish()
+    assert worker.is_drained()
+    assert worker.try_merge()
+    assert not worker.try_merge()
+    worker.close()
+    crashed.connection.close()
+
+def test_merged_summary_has_the_attempts_of_every_worker(start_mirror, tmp_path):
+    openpyxl = __import__('openpyxl')
+
+    server = start_mirror(latency = 0.05)
+    dois = ['10.5555/queue.%s' % number for number in range(30)]
+    input_file = tmp_path / 'dois.txt'
+    input_file.write_text('\n'.join(dois) + '\n')
+    output = tmp_path / 'output'
+
+    workers = [subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'download_papers.py'), '-i', str(input_file), '-o', str(output),
+                                 '-b', 'native', '-m', server.url, '--rate', '0', '-w', '2', '-q', '--queue', 'run', '--worker_id', 'w%s' % number],
+                                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+               for number in range(3)]
+    for worker in workers:
+        assert worker.wait(timeout = 120) == 0
+
+    assert {doi: status for doi, (status, _) in get_statuses(output).items()} == {doi: 'Ok' for doi in dois}
+    workbook = openpyxl.load_workbook(str(output / 'summary_download.xlsx'), read_only = True)
+    rows = list(workbook.active.iter_rows(values_only = True))
+    workbook.close()
+    assert rows[0] == ('Item', 'DOI', 'Download', 'Attempts')
+    assert [(row[2], row[3]) for row in rows[1:]] == [('Ok', 1)] * len(dois)